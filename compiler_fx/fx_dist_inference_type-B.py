@@ -18,6 +18,16 @@
 #            torchrun --nproc_per_node=2 --nnodes=2 --node_rank=1
 #                  --master_addr="X.X.X.X" --master_port=29500 fx_dist_inference_type-B.py
 #
+#
+#   Continuous inference (--serve): requests of one sample are queued on rank 0 and batched
+#       dynamically (up to --max-batch requests, or what arrived within --max-wait sec); the
+#       micro-batches are streamed through the stages back to back with asynchronous sends
+#       (up to --max-inflight in the pipeline), and the results are returned in request order.
+#       Rank 0 then reports the throughput (requests/sec) and the latency (p50/p99).
+#
+#            torchrun --nproc_per_node=4 fx_dist_inference_type-B.py --serve --requests 512 --rate 0
+#            torchrun --nproc_per_node=4 fx_dist_inference_type-B.py --serve --max-inflight 1   # one micro-batch at a time
+#
 
 
 import torch
@@ -29,6 +39,12 @@ from torch.optim import Adam
 from torch import fx
 from torch.fx.node import Node
 import time
+import argparse
+import queue
+import random
+import threading
+from collections import deque
+from concurrent.futures import Future
 
 import torch.distributed as dist
 import datetime
@@ -47,6 +63,15 @@ from torch.fx.passes.split_module import split_module
 
 torch.manual_seed(42)
 
+parser = argparse.ArgumentParser()
+parser.add_argument("--serve", action="store_true", help="continuous inference with a request queue on rank 0, and benchmark")
+parser.add_argument("--requests", type=int, default=256, help="number of requests of the benchmark")
+parser.add_argument("--rate", type=float, default=0, help="requests/sec arriving on rank 0 (Poisson), 0: all at once")
+parser.add_argument("--max-batch", type=int, default=16, help="requests per micro-batch at most")
+parser.add_argument("--max-wait", type=float, default=0.005, help="sec a micro-batch waits for more requests")
+parser.add_argument("--max-inflight", type=int, default=4, help="micro-batches in the pipeline at most")
+args = parser.parse_args()
+
 #
 # Total host count
 #
@@ -306,6 +331,7 @@ class FXRun3:
         self.world_size = split_info.world_size
         self.device = device
         self.stage = split_info.stage
+        self.verbose = True
 
     def receive_activation(self, split_node_name, from_rank):
 
@@ -376,6 +402,16 @@ class FXRun3:
         return result
 
 
+    # the nodes of this stage on x, without communication
+    def run_stage(self, x):
+        self.args_iter = iter((x,))
+        self.env["placeholder"] = x
+
+        for node in self.mod.graph.nodes:
+            result = self.fx_ir_run_node2(node)
+        return result
+
+
     def restore_env(self, node: Node) -> Tuple[Tuple, Dict]:
         #print(f"## before restore_env, node:{node}, node.args:{node.args}, node.kwargs:{node.kwargs}")
 
@@ -436,7 +472,8 @@ class FXRun3:
             result =  args[0]
 
         #
-        print(f" ## [rank:{sim_split.rank}], run - node:{node.name}, node.op:{node.op}")
+        if self.verbose == True:
+            print(f" ## [rank:{sim_split.rank}], run - node:{node.name}, node.op:{node.op}")
 
         self.env[node.name] = result
 
@@ -444,24 +481,212 @@ class FXRun3:
 
 
 
+# activation header: [ndim, shape, ...], ndim 0: no more micro-batches
+MAX_DIM = 4
+
+
+#
+# PipelineServer: continuous inference on the stages (FXRun3.run_stage)
+#
+#   rank 0: submit() queues a request and returns a Future; serve() batches the queued requests
+#       into micro-batches, runs stage 0 on them and sends them on without waiting (isend); a
+#       collector thread receives the outputs of the last stage, in micro-batch order, and
+#       completes the Futures of their requests.
+#   other ranks: serve() receives a micro-batch, runs the stage and sends it on without waiting,
+#       until the end marker (the last stage sends to rank 0).
+#
+class PipelineServer:
+
+    def __init__(self, fx_run, max_batch, max_wait, max_inflight):
+        self.fx_run = fx_run
+        self.rank = fx_run.rank
+        self.world_size = fx_run.world_size
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_inflight = max_inflight
+
+        self.pending = deque()  # isends in flight: (works, tensors kept alive)
+
+        if self.rank == 0:
+            self.requests = queue.Queue()
+            self.batches = queue.Queue()  # Futures of the micro-batches in the pipeline, in order
+            self.inflight = threading.Semaphore(max_inflight)
+            self.collector = threading.Thread(target=self.collect, daemon=True)
+            self.num_batches = 0
+
+
+    def isend_activation(self, obj, to_rank):
+        header = torch.zeros(MAX_DIM + 1, dtype=torch.long)
+        tensors = [header]
+        if obj is not None:
+            obj = obj.contiguous()
+            header[0] = obj.dim()
+            header[1:1 + obj.dim()] = torch.tensor(obj.size(), dtype=torch.long)
+            tensors.append(obj)
+
+        works = [dist.isend(t, to_rank) for t in tensors]
+        self.pending.append((works, tensors))
+
+        while len(self.pending) > self.max_inflight:
+            works, _ = self.pending.popleft()
+            for work in works:
+                work.wait()
+
+
+    def recv_activation(self, from_rank):
+        header = torch.zeros(MAX_DIM + 1, dtype=torch.long)
+        dist.recv(header, from_rank)
+        if header[0] == 0:
+            return None
+
+        obj = torch.zeros(size=tuple(header[1:1 + header[0]].tolist()))
+        dist.recv(obj, from_rank)
+        return obj
+
+
+    def drain(self):
+        while len(self.pending) > 0:
+            works, _ = self.pending.popleft()
+            for work in works:
+                work.wait()
+
+
+    # rank 0: Future of the output of a request x (1 x in_features)
+    def submit(self, x):
+        fut = Future()
+        fut.arrival = time.time()
+        self.requests.put((x, fut))
+        return fut
+
+
+    # rank 0: no more requests
+    def close(self):
+        self.requests.put(None)
+
+
+    # rank 0: up to max_batch requests, or those arriving within max_wait after the first; None at the end
+    def next_batch(self):
+        item = self.requests.get()
+        if item is None:
+            return None
+
+        batch = [item]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                item = self.requests.get(timeout=max(0., deadline - time.time()))
+            except queue.Empty:
+                break
+            if item is None:
+                self.requests.put(None) # end after this micro-batch
+                break
+            batch.append(item)
+        return batch
+
+
+    # rank 0: outputs of the last stage, in micro-batch order
+    def collect(self):
+        while True:
+            out = self.recv_activation(self.world_size - 1)
+            if out is None:
+                break
+
+            futs = self.batches.get()
+            done = time.time()
+            for fut, y in zip(futs, out.split(1)):
+                fut.done = done
+                fut.set_result(y)
+            self.inflight.release()
+
+
+    def serve(self):
+        if self.rank == 0:
+            self.collector.start()
+
+            while True:
+                batch = self.next_batch()
+                if batch is None:
+                    break
+
+                self.inflight.acquire()
+                x = torch.cat([x for x, _ in batch])
+                y = self.fx_run.run_stage(x)
+                self.batches.put([fut for _, fut in batch])
+                self.isend_activation(y, 1)
+                self.num_batches = self.num_batches + 1
+
+            self.isend_activation(None, 1)
+            self.collector.join()
+
+        else:
+            to_rank = (self.rank + 1) % self.world_size
+            while True:
+                x = self.recv_activation(self.rank - 1)
+                if x is None:
+                    self.isend_activation(None, to_rank)
+                    break
+                self.isend_activation(self.fx_run.run_stage(x), to_rank)
+
+        self.drain()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
 sim_split = Simple_split_test2()
 sim_split.metadata_transfer2()
 
+fx_run3 = FXRun3(sim_split, sim_split.device)
+
+if args.serve == True:
+    fx_run3.verbose = False
+    server = PipelineServer(fx_run3, args.max_batch, args.max_wait, args.max_inflight)
 
-if sim_split.rank == 0:
-    sample_input = torch.rand(batch_size, in_features)
-else:
-    sample_input = None
+    if sim_split.rank == 0:
+        futs = []
 
-fx_run3 = FXRun3(sim_split, sim_split.device)
+        # requests arriving at args.rate per sec (all at once with 0)
+        def client():
+            for i in range(args.requests):
+                if args.rate > 0:
+                    time.sleep(random.expovariate(args.rate))
+                futs.append(server.submit(torch.rand(1, in_features)))
+            server.close()
 
-fx_run3.print_range()
+        tick = time.time()
+        client_thread = threading.Thread(target=client)
+        client_thread.start()
 
-output1 = fx_run3.fx_forward3(sample_input)
+        with torch.no_grad():
+            server.serve()
+        client_thread.join()
+        tock = time.time()
 
-if sim_split.rank == sim_split.world_size - 1:
-    print(output1)
-print(f"[rank:{sim_split.rank}], run completed ...")
+        outputs = [fut.result() for fut in futs] # in request order
+        latency = [(fut.done - fut.arrival) * 1000 for fut in futs]
 
-rpc.shutdown()
+        print(f"[rank:0] requests:{len(outputs)}, micro-batches:{server.num_batches} ({len(outputs) / server.num_batches:.1f} requests each), max_inflight:{args.max_inflight}")
+        print(f"[rank:0] throughput: {len(outputs) / (tock - tick):.1f} requests/sec, latency p50: {percentile(latency, 50):.1f} ms, p99: {percentile(latency, 99):.1f} ms")
+    else:
+        with torch.no_grad():
+            server.serve()
 
+    print(f"[rank:{sim_split.rank}], serving completed ...")
+
+else:
+    if sim_split.rank == 0:
+        sample_input = torch.rand(batch_size, in_features)
+    else:
+        sample_input = None
+
+    fx_run3.print_range()
+
+    output1 = fx_run3.fx_forward3(sample_input)
+
+    if sim_split.rank == sim_split.world_size - 1:
+        print(output1)
+    print(f"[rank:{sim_split.rank}], run completed ...")
+
+rpc.shutdown()
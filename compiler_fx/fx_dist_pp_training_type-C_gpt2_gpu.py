@@ -19,6 +19,9 @@
 #            torchrun --nproc_per_node=1 --nnodes=2 --node_rank=1
 #                  --master_addr="X.X.X.X" --master_port=29500 fx_dist_pp_training_type-C_gpt2_gpu.py
 #
+#      add --fusion to run the FX fusion pass (fx_fuse) on every stage; compare the
+#      "Step time" printed by rank 0 with and without it
+#
 
 import sys
 import math
@@ -41,6 +44,7 @@ from torch.fx.node import Node
 import copy
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 import time
+import argparse
 
 import torch.distributed as dist
 import datetime
@@ -56,6 +60,8 @@ sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
 from torch.fx.graph_module import GraphModule
 from torch.fx.passes.split_module import split_module
 
+from fx_fusion import fx_fuse
+
 
 from datasets import load_dataset
 from torch.utils.data import DataLoader
@@ -70,6 +76,14 @@ torch.manual_seed(42)
 
 use_gpu = True
 
+parser = argparse.ArgumentParser()
+parser.add_argument("--fusion", action="store_true",
+                    help="run the FX fusion pass (fx_fuse) on the stage before its first forward")
+args = parser.parse_args()
+
+# True: run the FX fusion pass (fx_fuse) on the stage before its first forward, False: run it as traced
+use_fusion = args.fusion
+
 
 #
 # Total process count
@@ -478,6 +492,8 @@ class FXRun3:
 
         self.getitem_dic : Dict[str, Any] = {}
 
+        self.fused = False
+
         self.ds_type2id = {
             Tensor: 100,
             tuple: 101,
@@ -1068,6 +1084,13 @@ class FXRun3:
         args = fx.graph.map_arg(self.node.args, extract_tensor_args)
         kwargs = fx.graph.map_arg(self.node.kwargs, extract_tensor_args)
 
+        if use_fusion == True and self.fused == False:
+            if len(kwargs) == 0:
+                fx_fuse(self.submod, args, self.rank)
+            else:
+                print(f" ### Rank:{self.rank}, fusion skipped: stage called with kwargs {list(kwargs.keys())}")
+            self.fused = True
+
         result = self.submod(*args, **kwargs)
 
         self.fwd_cache2[mb_idx][self.name] = \
@@ -1322,6 +1345,8 @@ def train():
                 labels = torch.cat(outputs)
 
 
+        step_tick = time.time()
+
         optimizer1.zero_grad()
 
         fx_run3.fx_forward4(data, labels)
@@ -1337,6 +1362,10 @@ def train():
         
         torch.nn.utils.clip_grad_norm_(fx_run3.submod.parameters(), 0.5)
         optimizer1.step()
+
+        if sim_split.device.type == "cuda":
+            torch.cuda.synchronize(sim_split.device)
+        step_times.append(time.time() - step_tick)
         
         if sim_split.rank == sim_split.world_size - 1:
             loss =  sum(loss1) / fx_run3.mbsize
@@ -1356,6 +1385,9 @@ def train():
                 start_time = time.time()
 
 
+# step times of this rank, the first step (fusion pass, warm-up) excluded from the report
+step_times = []
+
 if sim_split.rank == 0:
     tick = time.time()
 
@@ -1369,6 +1401,8 @@ if sim_split.rank == 0:
     elapsed_time = tock - tick
 
     print('Time elapsed: %.3f sec ' % (elapsed_time))
+    if len(step_times) > 1:
+        print('Step time (fusion:%s): %.2f ms/step over %d steps' % (use_fusion, sum(step_times[1:]) * 1000 / len(step_times[1:]), len(step_times) - 1))
 
 if sim_split.rank == sim_split.world_size - 1:
     print(f"RANK:{sim_split.rank} ###################### output #############")
@@ -0,0 +1,365 @@
+#
+# Copyright (c) 2024-present, ETRI, All rights reserved.
+#
+#
+#  FX fusion pass shared by the type-C pipeline-parallel PoCs (fx_fuse)
+#
+#      from fx_fusion import fx_fuse
+#      fx_fuse(submod, args, rank)   # before the first forward of the stage, args: its first micro-batch
+#
+
+import math
+import operator
+import logging
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import fx
+from torch.fx.node import Node
+from torch.fx.graph_module import GraphModule
+from torch.fx.passes.shape_prop import ShapeProp, TensorMetadata
+
+
+#
+# FX fusion pass over a stage (submod_i), before its first forward
+#
+#   - gelu: the tanh approximation traced as elementwise ops (gelu_new of GPT-2) becomes one F.gelu
+#   - Linear+bias+ReLU: nn.Linear (or addmm with bias) followed by ReLU becomes one call with
+#       the bias and the ReLU in the GEMM epilogue (torch._addmm_activation); CUDA only,
+#       elsewhere _addmm_activation does not fuse and the Python autograd Function is slower
+#   - elementwise chains: connected elementwise ops whose intermediate results have no other
+#       user become one fused callable (TorchScript: one kernel with the GPU fuser)
+#   - in-place: add/sub/mul/div write into their first operand when it is dead afterwards
+#       (single user), produced by an op that does not keep its output for the backward,
+#       and of the shape/dtype of the result
+#
+#   Shapes and dtypes come from ShapeProp on the first micro-batch (without autograd),
+#   requires_grad from the inputs and parameters each node depends on (mark_requires_grad).
+#
+
+ELEMENTWISE_FUNCTIONS = {
+    operator.add, operator.sub, operator.mul, operator.truediv, operator.neg, operator.pow,
+    torch.add, torch.sub, torch.mul, torch.div, torch.neg, torch.pow,
+    torch.tanh, torch.sigmoid, torch.relu, torch.exp, torch.sqrt, torch.rsqrt,
+    F.relu, F.gelu, F.silu, }
+
+ELEMENTWISE_METHODS = {"add", "sub", "mul", "div", "neg", "pow", "tanh", "sigmoid", "relu", "exp", "sqrt", "rsqrt"}
+
+INPLACE_OPS = {
+    operator.add: "add_", torch.add: "add_",
+    operator.sub: "sub_", torch.sub: "sub_",
+    operator.mul: "mul_", torch.mul: "mul_",
+    operator.truediv: "div_", torch.div: "div_", }
+
+# producers that do not keep their output for the backward: the output can be overwritten
+INPLACE_SAFE_FUNCTIONS = set(INPLACE_OPS.keys()) | {torch.addmm, torch.matmul, torch.mm, torch.bmm, F.linear, F.embedding, F.layer_norm}
+INPLACE_SAFE_METHODS = set(INPLACE_OPS.values())
+INPLACE_SAFE_MODULES = (nn.Linear, nn.Embedding, nn.LayerNorm)
+
+
+class LinearReLUFunction(torch.autograd.Function):
+
+    # x: (N, in), weight: (in, out)
+    @staticmethod
+    def forward(ctx, x, weight, bias):
+        out = torch._addmm_activation(bias, x, weight)
+        ctx.save_for_backward(x, weight, out)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad):
+        x, weight, out = ctx.saved_tensors
+        grad = grad * (out > 0)
+        grad_x = grad @ weight.t() if ctx.needs_input_grad[0] else None
+        grad_weight = x.t() @ grad if ctx.needs_input_grad[1] else None
+        grad_bias = grad.sum(0) if ctx.needs_input_grad[2] else None
+        return grad_x, grad_weight, grad_bias
+
+
+# relu(x @ weight + bias), weight: (in, out); x of any rank is flattened to 2-D for
+#   LinearReLUFunction and its leading dimensions are restored on the output
+def linear_relu(x, weight, bias):
+    out = LinearReLUFunction.apply(x.reshape(-1, x.size(-1)), weight, bias)
+    return out.view(*x.shape[:-1], out.size(-1))
+
+
+class LinearReLU(nn.Module):
+
+    def __init__(self, linear):
+        super().__init__()
+        self.linear = linear
+
+    def forward(self, x):
+        return linear_relu(x, self.linear.weight.t(), self.linear.bias)
+
+
+def is_tensor(n):
+    return isinstance(n, Node) and isinstance(n.meta.get("tensor_meta"), TensorMetadata)
+
+
+def is_relu(gm, n):
+    if n.op == 'call_function':
+        return n.target in (torch.relu, F.relu) and len(n.args) == 1
+    if n.op == 'call_method':
+        return n.target == "relu" and len(n.args) == 1
+    if n.op == 'call_module':
+        return isinstance(gm.get_submodule(n.target), nn.ReLU)
+    return False
+
+
+# (c, other) if n is a binary op of fns with a number c and a node other
+def const_operand(n, fns):
+    if not isinstance(n, Node) or n.op != 'call_function' or n.target not in fns or len(n.args) != 2 or len(n.kwargs) > 0:
+        return None, None
+    a, b = n.args
+    if isinstance(a, (int, float)) and isinstance(b, Node):
+        return a, b
+    if isinstance(b, (int, float)) and isinstance(a, Node):
+        return b, a
+    return None, None
+
+
+# x, [intermediate nodes] if n is 0.5 * x * (1.0 + tanh(sqrt(2 / pi) * (x + 0.044715 * x ** 3.0)))
+def match_gelu_tanh(n):
+    muls, adds = (operator.mul, torch.mul), (operator.add, torch.add)
+    if n.op != 'call_function' or n.target not in muls or len(n.args) != 2:
+        return None, None
+
+    for half, rest in (n.args, reversed(n.args)):
+        c0, x = const_operand(half, muls)
+        c1, t = const_operand(rest, adds)
+        if c0 != 0.5 or c1 != 1.0 or not isinstance(t, Node):
+            continue
+        if not ((t.op == 'call_function' and t.target == torch.tanh) or (t.op == 'call_method' and t.target == "tanh")):
+            continue
+        c2, s = const_operand(t.args[0], muls)
+        if c2 is None or abs(c2 - math.sqrt(2.0 / math.pi)) > 1e-6:
+            continue
+        if not isinstance(s, Node) or s.op != 'call_function' or s.target not in adds or x not in s.args:
+            continue
+        m = s.args[1] if s.args[0] is x else s.args[0]
+        c3, p = const_operand(m, muls)
+        if c3 != 0.044715 or not isinstance(p, Node) or p.op != 'call_function' or p.target not in (operator.pow, torch.pow) \
+                or p.args[0] is not x or p.args[1] != 3.0:
+            continue
+
+        inner = [half, rest, t, t.args[0], s, m, p]
+        if all(len(i.users) == 1 for i in inner):
+            return x, inner
+    return None, None
+
+
+def erase_unused(gm, nodes):
+    for n in reversed(list(gm.graph.nodes)):
+        if n in nodes and len(n.users) == 0:
+            gm.graph.erase_node(n)
+
+
+def fuse_gelu(gm):
+    count = 0
+    for n in list(gm.graph.nodes):
+        x, inner = match_gelu_tanh(n)
+        if x is None:
+            continue
+        with gm.graph.inserting_before(n):
+            g = gm.graph.call_function(F.gelu, (x,), {"approximate": "tanh"})
+        g.meta = dict(n.meta)
+        n.replace_all_uses_with(g)
+        erase_unused(gm, set(inner + [n]))
+        count = count + 1
+    return count
+
+
+def fuse_linear_relu(gm):
+    count = 0
+    for r in list(gm.graph.nodes):
+        if not is_relu(gm, r) or not isinstance(r.args[0], Node) or len(r.args[0].users) != 1:
+            continue
+        n = r.args[0]
+
+        # nn.Linear --> ReLU
+        if n.op == 'call_module' and isinstance(gm.get_submodule(n.target), nn.Linear) and len(n.args) == 1 \
+                and is_tensor(n.args[0]) and len(n.args[0].meta["tensor_meta"].shape) >= 2:
+            linear = gm.get_submodule(n.target)
+            if linear.bias is None:
+                continue
+            name = n.target.replace(".", "_") + "_relu"
+            gm.add_submodule(name, LinearReLU(linear))
+            n.target = name
+            n.meta = dict(r.meta)
+            r.replace_all_uses_with(n)
+            gm.graph.erase_node(r)
+            count = count + 1
+            continue
+
+        # addmm(bias, x, weight) [--> view] --> ReLU
+        view = None
+        if n.op == 'call_method' and n.target == "view" and isinstance(n.args[0], Node) and len(n.args[0].users) == 1:
+            view, n = n, n.args[0]
+        if n.op == 'call_function' and n.target == torch.addmm and len(n.args) == 3 and len(n.kwargs) == 0:
+            bias, x, weight = n.args
+            with gm.graph.inserting_before(n):
+                f = gm.graph.call_function(linear_relu, (x, weight, bias))
+            f.meta = dict(n.meta)
+            n.replace_all_uses_with(f)
+            r.replace_all_uses_with(view if view is not None else f)
+            gm.graph.erase_node(r)
+            gm.graph.erase_node(n)
+            count = count + 1
+    return count
+
+
+def is_elementwise(n):
+    if n.op == 'call_function':
+        ok = n.target in ELEMENTWISE_FUNCTIONS
+    elif n.op == 'call_method':
+        ok = n.target in ELEMENTWISE_METHODS
+    else:
+        return False
+    # tensor arguments only (TorchScript), constant kwargs
+    return ok and is_tensor(n) and all(is_tensor(a) for a in n.all_input_nodes) and \
+            all(not isinstance(v, Node) for v in n.kwargs.values())
+
+
+# [ [nodes], ] connected elementwise ops, the last one the only result used outside
+def find_elementwise_chains(gm):
+    chain_of = {}
+    for n in gm.graph.nodes:
+        if not is_elementwise(n):
+            continue
+        members = []
+        for a in n.all_input_nodes:
+            if a in chain_of and len(a.users) == 1:
+                members = members + chain_of[a]
+        members.append(n)
+        for m in members:
+            chain_of[m] = members
+
+    chains = []
+    for members in chain_of.values():
+        if len(members) > 1 and not any(members is c for c in chains):
+            chains.append(members)
+    return chains
+
+
+# the nodes of members in a (scripted) GraphModule, called in their place
+def outline_chain(gm, members, name):
+    inside = set(members)
+    inputs = []
+    for m in members:
+        for a in m.all_input_nodes:
+            if a not in inside and a not in inputs:
+                inputs.append(a)
+
+    sub = fx.Graph()
+    env = {}
+    for a in inputs:
+        env[a] = sub.placeholder(a.name)
+    for m in members:
+        env[m] = sub.node_copy(m, lambda a: env[a])
+    sub.output(env[members[-1]])
+
+    fused = GraphModule(nn.Module(), sub)
+    try:
+        fused = torch.jit.script(fused)
+    except Exception as e:
+        logging.warning(f" {name}: not scripted ({e})")
+    gm.add_submodule(name, fused)
+
+    out = members[-1]
+    with gm.graph.inserting_before(out):
+        call = gm.graph.call_module(name, tuple(inputs))
+    call.meta = dict(out.meta)
+    out.replace_all_uses_with(call)
+    for m in reversed(members):
+        gm.graph.erase_node(m)
+
+
+def overwritable(gm, a):
+    if not is_tensor(a) or len(a.users) != 1:
+        return False
+    if a.op == 'call_function':
+        return a.target in INPLACE_SAFE_FUNCTIONS
+    if a.op == 'call_method':
+        return a.target in INPLACE_SAFE_METHODS
+    if a.op == 'call_module':
+        return isinstance(gm.get_submodule(a.target), INPLACE_SAFE_MODULES)
+    return False
+
+
+def to_inplace(gm):
+    count = 0
+    for n in gm.graph.nodes:
+        if n.op != 'call_function' or n.target not in INPLACE_OPS or len(n.args) != 2 or len(n.kwargs) > 0 or not is_tensor(n):
+            continue
+
+        x, y = n.args
+        candidates = [(x, y)]
+        if n.target in (operator.add, torch.add, operator.mul, torch.mul):
+            candidates.append((y, x))
+
+        for a, b in candidates:
+            if a is b or not overwritable(gm, a):
+                continue
+            meta, a_meta = n.meta["tensor_meta"], a.meta["tensor_meta"]
+            if meta.shape != a_meta.shape or meta.dtype != a_meta.dtype:
+                continue
+            # mul_/div_: the backward of the other operand would need the overwritten value
+            if INPLACE_OPS[n.target] in ("mul_", "div_") and isinstance(b, Node) and (not is_tensor(b) or b.meta.get("requires_grad", True)):
+                continue
+            n.op, n.target, n.args = 'call_method', INPLACE_OPS[n.target], (a, b)
+            count = count + 1
+            break
+    return count
+
+
+# n.meta["requires_grad"]: True if the node depends on an input or a parameter requiring grad
+#   (conservative: also True for outputs without gradient, ex. argmax)
+def mark_requires_grad(gm, args):
+    args_iter = iter(args)
+    for n in gm.graph.nodes:
+        rg = any(a.meta.get("requires_grad", False) for a in n.all_input_nodes)
+        if n.op == 'placeholder':
+            a = next(args_iter, None)
+            rg = isinstance(a, torch.Tensor) and a.requires_grad
+        elif n.op == 'get_attr':
+            attr = gm
+            for atom in n.target.split("."):
+                attr = getattr(attr, atom)
+            rg = isinstance(attr, torch.Tensor) and attr.requires_grad
+        elif n.op == 'call_module':
+            rg = rg or any(p.requires_grad for p in gm.get_submodule(n.target).parameters())
+        n.meta["requires_grad"] = rg
+
+
+def count_ops(gm):
+    return sum(1 for n in gm.graph.nodes if n.op in ('call_function', 'call_method', 'call_module'))
+
+
+def fx_fuse(gm, args, rank):
+    nodes, ops = len(gm.graph.nodes), count_ops(gm)
+
+    # no change to the random state of dropout
+    devices = list({a.device for a in args if isinstance(a, torch.Tensor) and a.device.type == "cuda"})
+    with torch.no_grad(), torch.random.fork_rng(devices=devices):
+        ShapeProp(gm).propagate(*args)
+    mark_requires_grad(gm, args)
+
+    gelu = fuse_gelu(gm)
+    on_cuda = any(p.is_cuda for p in gm.parameters()) or len(devices) > 0
+    linear_relus = fuse_linear_relu(gm) if on_cuda else 0
+
+    chains = find_elementwise_chains(gm)
+    for i, members in enumerate(chains):
+        outline_chain(gm, members, f"fused_{i}")
+
+    inplace = to_inplace(gm)
+
+    gm.graph.lint()
+    gm.delete_all_unused_submodules() # the Linears now owned by LinearReLU
+    gm.recompile()
+
+    print(f" ### Rank:{rank}, fusion: {nodes} -> {len(gm.graph.nodes)} nodes, {ops} -> {count_ops(gm)} ops "
+          f"(gelu:{gelu}, linear+relu:{linear_relus}, elementwise chains:{len(chains)} "
+          f"[{sum(len(c) for c in chains)} ops], in-place:{inplace})")
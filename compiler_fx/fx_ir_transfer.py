@@ -4,6 +4,11 @@
 #
 #  This is a PoC that transfers a partition of the FX IR generated by FX compile to another machine
 #
+#  Only rank 0 builds and traces the model. With use_weight_file, the weights of all partitions are
+#    written once to a weight file shared by the HOSTs (weight_file, e.g. on NFS), and each partition
+#    is shipped as FX code (its GraphModule with the submodules on the meta device) plus a weight
+#    manifest. Each rank materializes only its own partition from the memory-mapped weight file.
+#
 #
 #  Sample Usage:
 #      <machine #0>
@@ -13,6 +18,8 @@
 #            torchrun --nproc_per_node=2 --nnodes=2 --node_rank=1
 #                  --master_addr="X.X.X.X" --master_port=29500 fx_ir_ransfer.py
 #
+#      (use_weight_file) FX_IR_WEIGHT_FILE=/shared/path/fx_ir_weights.bin on every machine
+#
 
 
 import torch
@@ -24,6 +31,9 @@ from torch.optim import Adam
 from torch import fx
 from torch.fx.node import Node
 import time
+import math
+from itertools import chain
+from typing import Any, Dict, List
 
 import torch.distributed as dist
 import datetime
@@ -49,6 +59,15 @@ hidden = 5120
 # N: the number of HOSTs
 N = 4
 
+# True: ship FX code + weight manifest, weights from a memory-mapped file; False: pickle each partition with its weights
+use_weight_file = True
+
+# weight file written by rank 0, visible from every HOST
+weight_file = os.getenv("FX_IR_WEIGHT_FILE", "fx_ir_weights.bin")
+
+# alignment of the weights in the weight file (every dtype view stays aligned)
+ALIGN = 64
+
 
 class TestModel(nn.Module):
     def __init__(self):
@@ -212,6 +231,46 @@ class Communication(object):
         print(f"## setup_ctrl_group completed.")
 
 
+    # write the parameters/buffers of the partitions to weight_file
+    #   returns [ { name : (offset, dtype, shape, is_param, requires_grad) }, ] per partition, file size
+    def write_weights(self, partitions):
+        manifests = []
+        size = 0
+        for submod in partitions:
+            manifest = {}
+            for name, t in chain(submod.named_parameters(), submod.named_buffers()):
+                manifest[name] = (size, t.dtype, tuple(t.shape), isinstance(t, nn.Parameter), t.requires_grad)
+                size = size + (t.numel() * t.element_size() + ALIGN - 1) // ALIGN * ALIGN
+            manifests.append(manifest)
+
+        with open(weight_file, "wb") as f:
+            f.truncate(size)
+        weights = torch.from_file(weight_file, shared=True, size=size, dtype=torch.uint8)
+        for submod, manifest in zip(partitions, manifests):
+            for name, t in chain(submod.named_parameters(), submod.named_buffers()):
+                offset, dtype, shape, _, _ = manifest[name]
+                weights[offset:offset + t.numel() * t.element_size()].view(dtype).view(shape).copy_(t.detach())
+        del weights
+
+        print(f" >> weight file:{weight_file}, {size / (1024 ** 2):.1f} MB written")
+        return manifests, size
+
+
+    # replace the meta tensors of submod by views of the memory-mapped weight_file
+    #   (private mapping: only the pages of this partition are read, updates do not go to the file)
+    def load_weights(self, submod, manifest, size):
+        weights = torch.from_file(weight_file, shared=False, size=size, dtype=torch.uint8)
+        for name, (offset, dtype, shape, is_param, requires_grad) in manifest.items():
+            nbytes = math.prod(shape) * torch.empty((), dtype=dtype).element_size()
+            t = weights[offset:offset + nbytes].view(dtype).view(shape)
+            prefix, _, leaf = name.rpartition(".")
+            module = submod.get_submodule(prefix)
+            if is_param:
+                t = nn.Parameter(t, requires_grad=requires_grad)
+            setattr(module, leaf, t)
+        return submod
+
+
     def transfer_test(self):
 
         self.metadata_range = []
@@ -227,27 +286,39 @@ class Communication(object):
             #
             submods = self.simple_split(gm, t1, self.metadata_range)
 
+            partitions = []
             skip = False
-            to_rank = 0
             for submod in submods.modules():
                 if skip == False and isinstance(submod, fx.GraphModule):
                     skip = True
                     continue
                 if skip == True and isinstance(submod, fx.GraphModule):
-                    print(f"submod:{submod._get_name()}")
+                    partitions.append(submod)
 
-                    if to_rank == 0:
-                        print(f"### rank = 0")
-                        for node in submod.graph.nodes:
-                            print(f"-- node.op:{node.op}, node.name:{node.name}, node.target:{node.target}, node.all_input_nodes:{node.all_input_nodes}")
+            if use_weight_file == True:
+                manifests, size = self.write_weights(partitions)
 
+            for to_rank, submod in enumerate(partitions):
+                print(f"submod:{submod._get_name()}")
+
+                if to_rank == 0:
+                    print(f"### rank = 0")
+                    for node in submod.graph.nodes:
+                        print(f"-- node.op:{node.op}, node.name:{node.name}, node.target:{node.target}, node.all_input_nodes:{node.all_input_nodes}")
+
+                else:
+                    print(f"### rank = TO: {to_rank}")
+                    if use_weight_file == True:
+                        # weights dropped on rank 0: FX code and module attributes only
+                        submod.to("meta")
+                        object_list = [(submod, manifests[to_rank], size)]
                     else:
-                        print(f"### rank = TO: {to_rank}")
                         object_list = [submod]
-                        dist.broadcast_object_list(object_list, src=0, group=self.ctrl_group[to_rank], device=device)
-                    to_rank = to_rank + 1
+                    dist.broadcast_object_list(object_list, src=0, group=self.ctrl_group[to_rank], device=device)
+
+                print(f" >> FROM:{self.rank} ==> TO:{to_rank} FX IR partition transferred")
 
-                    print(f" >> FROM:{self.rank} ==> TO:{to_rank} FX IR partition transferred")
+            self.submod = partitions[0]
 
         else:
             device = torch.device("cpu")
@@ -255,11 +326,16 @@ class Communication(object):
             self.setup_pair_info()
             self.setup_ctrl_group()
 
+            tick = time.time()
+
             object_list = [None]
             dist.broadcast_object_list(object_list, src=0, group=self.ctrl_group[self.rank], device=device)
 
             #self.graph = object_list[0]
             submod = object_list[0]
+            if use_weight_file == True and submod is not None:
+                submod, manifest, size = submod
+                submod = self.load_weights(submod, manifest, size)
 
             #if self.graph is None:
             if submod is None:
@@ -270,6 +346,11 @@ class Communication(object):
                 for node in submod.graph.nodes:
                     print(f"-- node.op:{node.op}, node.name:{node.name}, node.target:{node.target}, node.all_input_nodes:{node.all_input_nodes}")
 
+                params = sum(p.numel() for p in submod.parameters())
+                print(f" ### rank:{self.rank}, partition materialized: {params:,} parameters, {time.time() - tick:.3f} sec")
+
+            self.submod = submod
+
 
         rpc.shutdown()
 
@@ -0,0 +1,30 @@
+#
+# Copyright (c) 2024-present, ETRI, All rights reserved.
+#
+#
+#  Liveness analysis of the forward+backward FX IR, shared by the FX IR runners
+#
+#      from fx_liveness import liveness_analyze
+#      free_after = liveness_analyze(gm.graph)
+#
+
+from typing import Dict, List
+
+from torch import fx
+
+
+# liveness_analyze: { node.name : [names of the nodes whose last user is this node] }
+#   A node is dead once its last user has run: in the forward+backward IR, the outputs and
+#   inputs of a call_module are used until its stage_backward, the gradients until the
+#   stage_backward of the module producing them. Nodes without users die at once.
+def liveness_analyze(graph: fx.Graph):
+    last_user: Dict[str, str] = {}
+    for node in graph.nodes:
+        for n in node.all_input_nodes:
+            last_user[n.name] = node.name
+        last_user[node.name] = node.name
+
+    free_after: Dict[str, List[str]] = {}
+    for name, user in last_user.items():
+        free_after.setdefault(user, []).append(name)
+    return free_after
@@ -15,22 +15,32 @@ from torch.optim import Adam
 from torch import fx
 from torch.fx.node import Node
 import copy
+import operator
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 import time
 
 
-
 import os
 import sys
 sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
 
-torch.manual_seed(42)
+from fx_liveness import liveness_analyze
+
 
 batch_size = 64
 in_features = 5120
 out_features = 5120
 hidden = 5120
 
+# True: run the IR as generated Python code (FXCodegen), False: interpret it node by node (FXRun)
+use_codegen = False
+
+# True: print the generated source of FXCodegen
+show_codegen = False
+
+# True: drop every intermediate result after its last user (liveness_analyze), False: keep them until the next step
+use_liveness = True
+
 #torch.autograd.set_detect_anomaly(True)
 
 class TestModel(nn.Module):
@@ -82,15 +92,6 @@ class TestModel2(nn.Module):
         x = self.relu(self.linear1(x))
         return x
 
-t1 = TestModel()
-#t1 = TestModel2()
-
-t2 = copy.deepcopy(t1)
-
-#
-print(t1)
-print("-----------------------")
-print(t2)
 
 # LossWrapper: cited form PiPPy
 class LossWrapper(torch.nn.Module):
@@ -108,18 +109,6 @@ class SimpleLossWrapper(LossWrapper):
         out1 = self.module(x)
         return self.loss_fn(out1, targets)
 
-loss_fn = torch.nn.MSELoss()
-wrapper = SimpleLossWrapper(t1, loss_fn)
-
-#gm1 = fx.symbolic_trace(t1)
-gm1 = fx.symbolic_trace(wrapper)
-
-for node in gm1.graph.nodes:
-    print(f"node.op:{node.op}, node.target:{node.target}, node.name:{node.name}")
-
-print("-----------------------")
-print(gm1.code)
-print("-----------------------")
 
 # stage_backward function: cited from PiPPy
 def stage_backward(
@@ -191,12 +180,6 @@ def sync_barrier(loss, barrier_tokens, last_grads):
     return loss, last_grads
     
 
-loss_node, output_node = _get_loss_output(gm1.graph)
-
-print(loss_node)
-print(output_node)
-
-
 # make_ir_for_backwards: adapted from PiPPy
 def make_ir_for_backwards(graph: fx.Graph, loss_node: fx.Node, output_node: fx.Node):
 
@@ -282,15 +265,6 @@ def make_ir_for_backwards(graph: fx.Graph, loss_node: fx.Node, output_node: fx.N
         output_node.args = (barrier_call,)
 
 
-print(f" =======> make_backwards\n\n")
-make_ir_for_backwards(gm1.graph, loss_node, output_node)
-
-# DEBUG
-for node in gm1.graph.nodes:
-    #print(f"node.op:{node.op}, node.target:{node.target}, node.name:{node.name}, node.all_input_nodes: {node.all_input_nodes}")
-    print(f"node.op:{node.op}, node.target:{node.target}, node.name:{node.name}, node.args:{node.args}, node.all_input_nodes: {node.all_input_nodes}")
-print("-----------------------")
-
 class FXRun:
 
     def __init__(self, mod):
@@ -300,6 +274,9 @@ class FXRun:
         self.loss = None
         self.fwd_cache: Dict[int, Tuple[Any, List[torch.Tensor]]] = {}
 
+        # env entries dropped as soon as they are dead
+        self.free_after = liveness_analyze(self.graph) if use_liveness == True else {}
+
         # TODO
         self.stage_num = 0
 
@@ -465,56 +442,230 @@ class FXRun:
             #self.env[node] = result
             self.env[node.name] = result
 
+            for name in self.free_after.get(node.name, ()):
+                del self.env[name]
+
         #return fx.graph.map_arg(self.env[node.name], lambda n: self.env[n.name])
         #return fx.graph.map_arg(self.env[node], lambda n: self.env[n])
         return self.output
 
 
+def _detach(a):
+    if isinstance(a, torch.Tensor):
+        return a.detach().requires_grad_(a.requires_grad)
+    return a
 
 
-t1.train()
-t2.train()
-optimizer1 = Adam(t1.parameters(), lr=3e-5)
-optimizer2 = Adam(t2.parameters(), lr=3e-5)
-
+# FXCodegen: compiled alternative to FXRun
 #
-print(f" begin  fx_run ... ")
+#   The forward+backward IR is lowered once into the source of a Python function: every node
+#   becomes a local variable, submodules/attributes/functions are bound once as globals of the
+#   function, and each stage_backward call takes the outputs and detached inputs of its
+#   call_module directly from locals (no env dict, map_arg or fwd_cache at run time).
+#   With use_liveness, dead locals are deleted (del) after their last user.
+#   Same results as FXRun.run.
+class FXCodegen:
+
+    def __init__(self, mod):
+        self.mod = mod
+        self.graph = mod.graph
+        self.loss = None
+        self.output = None
+
+        self.globals: Dict[str, Any] = {"stage_backward": stage_backward, "_detach": _detach}
+        self.src = self.codegen()
+        exec(compile(self.src, f"<fx_codegen_{id(self)}>", "exec"), self.globals)
+        self.fn = self.globals["fx_step"]
+
+    def add_global(self, prefix, obj):
+        name = f"{prefix}{len(self.globals)}"
+        self.globals[name] = obj
+        return name
+
+    def attr(self, target):
+        attr_itr = self.mod
+        for atom in target.split('.'):
+            attr_itr = getattr(attr_itr, atom)
+        return attr_itr
+
+    # source of an argument: nodes -> locals, containers recursively, other constants -> globals
+    #   detach: "inline", or (name, [expr, ]) to collect the detached nodes into the list name
+    def emit(self, a, detach=None):
+        if isinstance(a, Node):
+            if detach == "inline":
+                return f"_detach(v_{a.name})"
+            if detach is not None:
+                name, exprs = detach
+                exprs.append(f"_detach(v_{a.name})")
+                return f"{name}[{len(exprs) - 1}]"
+            return f"v_{a.name}"
+        if isinstance(a, tuple):
+            return "(" + "".join(self.emit(x, detach) + ", " for x in a) + ")"
+        if isinstance(a, list):
+            return "[" + ", ".join(self.emit(x, detach) for x in a) + "]"
+        if isinstance(a, dict):
+            return "{" + ", ".join(f"{k!r}: {self.emit(v, detach)}" for k, v in a.items()) + "}"
+        if a is None or isinstance(a, (bool, int, str)):
+            return repr(a)
+        return self.add_global("c_", a)
+
+    def codegen(self):
+        placeholders = []
+        body = ["output = None", "loss = None"]  # as in FXRun, when loss_fn takes no output
+        stage_num = 0
+        fwd_cache = {}  # { stage_num : (stage_output, input_values) } as local names
+        free_after = liveness_analyze(self.graph) if use_liveness == True else {}
 
-fx_run = FXRun(gm1)
+        for node in self.graph.nodes:
+            v = f"v_{node.name}"
+            if node.op == 'placeholder':
+                placeholders.append(v)
+
+            elif node.op == 'get_attr':
+                body.append(f"{v} = {self.add_global('a_', self.attr(node.target))}")
+
+            elif node.op == 'call_function' and node.target == stage_backward:
+                stage_num -= 1
+                stage_output, input_values = fwd_cache.pop(stage_num)
+                output_grads = self.emit(node.kwargs["output_grads"], detach="inline")
+                idxs = self.emit(node.kwargs["outputs_with_grads_idxs"])
+                body.append(f"{v} = stage_backward(stage_output={stage_output}, output_grads={output_grads}, input_values={input_values}, outputs_with_grads_idxs={idxs})")
+                if use_liveness == True:
+                    body.append(f"del {stage_output}, {input_values}")
+
+            elif node.op == 'call_function' and node.target == operator.getitem:
+                body.append(f"{v} = {self.emit(node.args[0])}[{self.emit(node.args[1])}]")
+
+            elif node.op == 'call_function':
+                fn = self.add_global("f_", node.target)
+                args = "".join(self.emit(a) + ", " for a in node.args)
+                kwargs = "".join(f"{k}={self.emit(a)}, " for k, a in node.kwargs.items())
+                body.append(f"{v} = {fn}({args}{kwargs})")
+
+            elif node.op == 'call_method':
+                args = "".join(self.emit(a) + ", " for a in node.args[1:])
+                kwargs = "".join(f"{k}={self.emit(a)}, " for k, a in node.kwargs.items())
+                body.append(f"{v} = {self.emit(node.args[0])}.{node.target}({args}{kwargs})")
+
+            elif node.op == 'call_module':
+                # inputs detached as in FXRun: the graph of each module ends at its inputs
+                inputs = f"in_{stage_num}"
+                flat_args = []
+                args = "".join(self.emit(a, (inputs, flat_args)) + ", " for a in node.args)
+                kwargs = "".join(f"{k}={self.emit(a, (inputs, flat_args))}, " for k, a in node.kwargs.items())
+                body.append(f"{inputs} = [{', '.join(flat_args)}]")
+                body.append(f"{v} = {self.add_global('m_', self.attr(node.target))}({args}{kwargs})")
+
+                if node.target == 'loss_fn':
+                    if not str(node.all_input_nodes[0]).startswith("target"):
+                        body.append(f"output = v_{node.all_input_nodes[0].name}")
+                    body.append(f"loss = {v}")
+
+                body.append(f"out_{stage_num} = {v} if isinstance({v}, tuple) else ({v},)")
+                fwd_cache[stage_num] = (f"out_{stage_num}", inputs)
+                stage_num += 1
+
+            dead = [f"v_{name}" for name in free_after.get(node.name, ()) if node.op != 'output']
+            if len(dead) > 0:
+                body.append(f"del {', '.join(dead)}")
+
+        body.append("return output, loss")
+        return f"def fx_step({', '.join(placeholders)}):\n" + "".join(f"    {line}\n" for line in body)
+
+    def run(self, *args):
+        self.output, self.loss = self.fn(*args)
+        return self.output
+
+
+# the PoC: train TestModel on the forward+backward IR and check it against the eager model
+#   (the definitions above are imported by memory_usage4.py)
+if __name__ == "__main__":
+    torch.manual_seed(42)
+
+    t1 = TestModel()
+    #t1 = TestModel2()
+
+    t2 = copy.deepcopy(t1)
+
+    #
+    print(t1)
+    print("-----------------------")
+    print(t2)
+
+    loss_fn = torch.nn.MSELoss()
+    wrapper = SimpleLossWrapper(t1, loss_fn)
+
+    #gm1 = fx.symbolic_trace(t1)
+    gm1 = fx.symbolic_trace(wrapper)
+
+    for node in gm1.graph.nodes:
+        print(f"node.op:{node.op}, node.target:{node.target}, node.name:{node.name}")
+
+    print("-----------------------")
+    print(gm1.code)
+    print("-----------------------")
+
+    loss_node, output_node = _get_loss_output(gm1.graph)
+
+    print(loss_node)
+    print(output_node)
+
+    print(f" =======> make_backwards\n\n")
+    make_ir_for_backwards(gm1.graph, loss_node, output_node)
+
+    # DEBUG
+    for node in gm1.graph.nodes:
+        #print(f"node.op:{node.op}, node.target:{node.target}, node.name:{node.name}, node.all_input_nodes: {node.all_input_nodes}")
+        print(f"node.op:{node.op}, node.target:{node.target}, node.name:{node.name}, node.args:{node.args}, node.all_input_nodes: {node.all_input_nodes}")
+    print("-----------------------")
+
+    t1.train()
+    t2.train()
+    optimizer1 = Adam(t1.parameters(), lr=3e-5)
+    optimizer2 = Adam(t2.parameters(), lr=3e-5)
+
+    #
+    print(f" begin  fx_run ... ")
 
-tick =  time.time()
+    if use_codegen == True:
+        fx_run = FXCodegen(gm1)
+        if show_codegen == True:
+            print(fx_run.src)
+    else:
+        fx_run = FXRun(gm1)
 
-#sample_input = torch.rand(batch_size, in_features)
-sample_output = torch.rand(batch_size, out_features)
+    tick =  time.time()
 
-N = 20
+    #sample_input = torch.rand(batch_size, in_features)
+    sample_output = torch.rand(batch_size, out_features)
 
-for i in range(N):
-    sample_input = torch.rand(batch_size, in_features)
+    N = 20
 
-    optimizer1.zero_grad()
-    optimizer2.zero_grad()
+    for i in range(N):
+        sample_input = torch.rand(batch_size, in_features)
 
-    #loss1 = wrapper(sample_input, sample_output) # actual
-    output1 = fx_run.run(sample_input, sample_output) # actual
-    loss1 = fx_run.loss
+        optimizer1.zero_grad()
+        optimizer2.zero_grad()
 
-    optimizer1.step()
+        #loss1 = wrapper(sample_input, sample_output) # actual
+        output1 = fx_run.run(sample_input, sample_output) # actual
+        loss1 = fx_run.loss
 
-    output2 = t2(sample_input) # expected
-    loss2 = torch.nn.MSELoss()(output2, sample_output)
-    loss2.backward()
-    optimizer2.step()
+        optimizer1.step()
 
-    print(f'Step {i}, Loss1: {loss1}, Loss2: {loss2}')
+        output2 = t2(sample_input) # expected
+        loss2 = torch.nn.MSELoss()(output2, sample_output)
+        loss2.backward()
+        optimizer2.step()
 
-    torch.testing.assert_close(output1, output2)
-    #torch.allclose(output1, output2)
+        print(f'Step {i}, Loss1: {loss1}, Loss2: {loss2}')
 
-tock = time.time()
-elapsed_time = tock - tick
-print('Time elapsed: %.3f sec ' % (elapsed_time))
-print(output1)
-print("#######")
-print(output2)
+        torch.testing.assert_close(output1, output2)
+        #torch.allclose(output1, output2)
 
+    tock = time.time()
+    elapsed_time = tock - tick
+    print('Time elapsed: %.3f sec ' % (elapsed_time))
+    print(output1)
+    print("#######")
+    print(output2)
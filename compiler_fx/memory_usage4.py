@@ -0,0 +1,170 @@
+#
+# Copyright (c) 2023-present, ETRI, All rights reserved.
+#
+#
+# This program is to measure a memory usage of a synthetic model training on the forward+backward FX IR,
+#   with and without liveness-based freeing of the intermediate results (CPU version)
+#
+#   python memory_usage4.py                 # intermediate results dropped after their last user
+#   python memory_usage4.py --no-liveness   # kept until the next step
+#
+
+
+import torch
+import torch.nn as nn
+from torch.optim import Adam
+from torch import fx
+import time
+import argparse
+import resource
+
+import psutil
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+import fx_train_with_backward_IR as fx_ir
+from fx_train_with_backward_IR import SimpleLossWrapper, _get_loss_output, make_ir_for_backwards, FXRun
+
+torch.manual_seed(42)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--no-liveness", dest="liveness", action="store_false",
+                    help="keep the intermediate results of the IR until the next step")
+args = parser.parse_args()
+
+# True: drop every intermediate result after its last user (liveness_analyze), False: keep them until the next step
+#   read by FXRun of fx_train_with_backward_IR
+use_liveness = args.liveness
+fx_ir.use_liveness = use_liveness
+
+batch_size = 64
+in_features = 5120
+out_features = 5120
+#hidden = 5120
+#hidden = 5120 * 8
+#hidden = 5120 * 9
+hidden = 5120 * 10
+#hidden = 5120 * 15
+
+pid = os.getpid()
+print(f">> Process ID: {pid}")
+
+print_flag = True
+
+def print_memory_usage(str, print_flag):
+    if print_flag == True:
+        print(" =========", str, "=========")
+        my_process = psutil.Process(pid)
+        usage =  my_process.memory_info().rss / (1024 ** 3)   # GB unit
+        print(f" Memory Usage: {usage:.3f} GB")
+
+def print_peak_memory_usage(print_flag):
+    if print_flag == True:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2)   # KB -> GB unit
+        print(f" Peak Memory Usage: {peak:.3f} GB")
+
+def get_total_params(module: torch.nn.Module):
+    total_params = 0
+    for param in module.parameters():
+        total_params += param.numel()
+    return total_params
+
+
+class TestModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+
+        self.linear1 = nn.Linear(in_features, hidden)
+        self.linear2 = nn.ModuleList()
+        for i in range(2):
+            self.linear2.append(nn.Linear(hidden, hidden))
+
+        self.linear3 = nn.ModuleList()
+        for i in range(2):
+            self.linear3.append(nn.Linear(hidden, hidden))
+
+        self.linear4 = nn.ModuleList()
+        for i in range(2):
+            self.linear4.append(nn.Linear(hidden, hidden))
+
+        self.linear5 = nn.ModuleList()
+        for i in range(2):
+            self.linear5.append(nn.Linear(hidden, hidden))
+        self.linear6 = nn.Linear(hidden, out_features)
+        self.relu = nn.ReLU(inplace = False)
+
+    def forward(self, x):
+        x = self.relu(self.linear1(x))
+        for m in self.linear2:
+            x = self.relu(m(x))
+        for m in self.linear3:
+            x = self.relu(m(x))
+        for m in self.linear4:
+            x = self.relu(m(x))
+        for m in self.linear5:
+            x = self.relu(m(x))
+        x = self.linear6(x)
+        x = self.relu(x)
+        return x
+
+print_memory_usage("Before creating model instance", print_flag)
+
+t1 = TestModel()
+
+print_memory_usage("After creating model instance: model = TestModel()", print_flag)
+
+
+loss_fn = torch.nn.MSELoss()
+wrapper = SimpleLossWrapper(t1, loss_fn)
+
+gm1 = fx.symbolic_trace(wrapper)
+
+print_memory_usage("After symbolic tracing: gm = fx.symbolic_trace(model)", print_flag)
+
+loss_node, output_node = _get_loss_output(gm1.graph)
+make_ir_for_backwards(gm1.graph, loss_node, output_node)
+
+print_memory_usage("After make_ir_for_backwards()", print_flag)
+
+
+gm1.train()
+optimizer1 = Adam(gm1.parameters(), lr=3e-5)
+
+fx_run = FXRun(gm1)
+
+print(f" liveness: {use_liveness}")
+print('Total parameters in model: {:,}'.format(get_total_params(fx_run.mod)))
+
+print_memory_usage("After counting total parameters: get_total_params(model)", print_flag)
+
+tick =  time.time()
+
+sample_output = torch.rand(batch_size, out_features)
+
+for i in range(2):
+    sample_input = torch.rand(batch_size, in_features)
+
+    optimizer1.zero_grad()
+
+    output1 = fx_run.run(sample_input, sample_output) # actual
+    loss1 = fx_run.loss
+
+    print_memory_usage("After forward+backward: fx_run.run()", print_flag)
+
+    optimizer1.step()
+
+    print_memory_usage("After optimizer step: step()", print_flag)
+    print_peak_memory_usage(print_flag)
+
+    print(f"==========================")
+    print(f'Step {i}, Loss1: {loss1}')
+    print(f"==========================")
+
+
+tock = time.time()
+elapsed_time = tock - tick
+print('Time elapsed: %.3f sec ' % (elapsed_time))
+print(output1)
+print("#######")
@@ -0,0 +1,192 @@
+#
+# Copyright (c) 2024-present, ETRI, All rights reserved.
+#
+#  Benchmark of the split-graph analysis of IR (node partitioning for split_module and
+#  cross_reference_analyze) on synthetic models of increasing depth. The previous
+#  node-walking implementations are kept here as a reference: results are checked to be
+#  identical and both are timed.
+#
+#  Usage (no torchrun needed):
+#    python bench_ir_analyze.py --depths 64 256 1024 4096 --num_stage 8
+#
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+import types
+
+import torch
+import torch.nn as nn
+from torch import fx
+
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+from opt_prime.IR import IR
+
+os.environ.setdefault("RANK", "0")
+
+
+# depth x (linear + relu) with residuals; like the attention mask of a transformer, a
+#   tensor computed at the start is used by every layer, across all stage boundaries
+class DeepSkipModel(nn.Module):
+    def __init__(self, depth, hidden=8):
+        super().__init__()
+        self.layers = nn.ModuleList([nn.Linear(hidden, hidden) for _ in range(depth)])
+        self.relu = nn.ReLU()
+
+    def forward(self, x):
+        mask = torch.sigmoid(x)
+        for layer in self.layers:
+            x = self.relu(layer(x)) * mask + x
+        return x
+
+
+# previous part_fn of IR.split_by_metadata_range
+def legacy_partition(ir):
+    last_idx, last_name = ir.metadata_range[-1]
+    last_flag = False
+    partition = {}
+    for node in ir.gm.graph.nodes:
+        if last_flag == True:
+            partition[node.name] = last_idx
+            continue
+        idx = 0
+        cur = node
+        found = False
+        while cur.name != last_name:
+            for i, m_name in ir.metadata_range:
+                if cur.name == m_name:
+                    idx = i
+                    found = True
+                    break
+            if found:
+                break
+            cur = cur._next
+        if not found and cur.name == last_name:
+            idx = last_idx
+            last_flag = True
+        partition[node.name] = idx
+    return partition
+
+
+# previous IR.cross_reference_analyze
+def legacy_cross_reference_analyze(ir, stage, g, special_nodes):
+    if stage == 0:
+        return
+    from_, to_ = ir.get_range(stage, g)
+    cur = to_
+    while (cur != from_) or (stage > 0 and cur == from_):
+        for i, target_ in enumerate(cur.all_input_nodes):
+            if cur.name == "loss_fn" and i > 0:
+                break
+            referenced_in = False
+            referenced_out = False
+            inner = cur._prev
+            if inner != from_._prev:
+                while (inner != from_) or (stage > 0 and inner == from_):
+                    if inner.name == target_.name:
+                        referenced_in = True
+                        break
+                    if inner == from_:
+                        break
+                    inner = inner._prev
+            if referenced_in == True:
+                continue
+            stage_ = 0
+            split_node_name = ir.metadata_range[stage_][1]
+            outer = next(iter(g.nodes))
+            while outer != from_:
+                if outer.name == target_.name:
+                    if target_.name not in special_nodes:
+                        special_nodes[target_.name] = (stage_, stage)
+                    referenced_out = True
+                    break
+                if outer.name == split_node_name:
+                    stage_ = stage_ + 1
+                    split_node_name = ir.metadata_range[stage_][1]
+                outer = outer._next
+            assert referenced_out == True, target_.name
+        if cur == from_:
+            break
+        cur = cur._prev
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def bench(depth, num_stage, legacy):
+    model = DeepSkipModel(depth)
+    optimus = types.SimpleNamespace(tpl=types.SimpleNamespace(rank=0), model2type={"hf": 50, "sy": 51})
+    ir = IR(model, optimus)
+    ir.gm = fx.symbolic_trace(model)
+
+    # keep the metadata_range of self.gm, before split_by_metadata_range replaces it
+    pre_range = []
+    split_by_metadata_range = ir.split_by_metadata_range
+    def record_range(module, num_stage):
+        pre_range.extend(ir.metadata_range)
+        return split_by_metadata_range(module, num_stage)
+    ir.split_by_metadata_range = record_range
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        submods = ir.simple_split(model, num_stage)
+    g = submods.graph
+
+    ir_pre = IR(model, optimus)
+    ir_pre.gm = ir.gm
+    ir_pre.metadata_range = pre_range
+
+    partition, t_part = timed(ir_pre.get_node_partition)
+
+    # cross_reference_analyze runs on the split graph; the traced graph, with the same
+    #   boundaries, shows how it scales with the number of nodes
+    def analyze(ir, g):
+        ir.special_nodes = {}
+        ir.node_maps = None
+        with contextlib.redirect_stdout(io.StringIO()):
+            for stage in reversed(range(1, num_stage)):
+                ir.cross_reference_analyze(stage, g)
+        return ir.special_nodes
+
+    analyze(ir, g)
+    split_special_nodes = dict(ir.special_nodes)
+
+    special_nodes, t_xref = timed(analyze, ir_pre, ir.gm.graph)
+
+    row = {"depth": depth, "fx_nodes": len(ir.gm.graph.nodes), "part": t_part, "xref": t_xref}
+
+    if legacy:
+        old_partition, row["legacy_part"] = timed(legacy_partition, ir_pre)
+        assert old_partition == partition, "partition mismatch"
+
+        def legacy_analyze(ir, g):
+            old = {}
+            for stage in reversed(range(1, num_stage)):
+                legacy_cross_reference_analyze(ir, stage, g, old)
+            return old
+
+        old_special_nodes, row["legacy_xref"] = timed(legacy_analyze, ir_pre, ir.gm.graph)
+        assert list(old_special_nodes.items()) == list(special_nodes.items()), "special_nodes mismatch"
+        assert list(legacy_analyze(ir, g).items()) == list(split_special_nodes.items()), "special_nodes mismatch"
+
+    return row
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--depths", type=int, nargs="+", default=[64, 256, 1024, 4096])
+    parser.add_argument("--num_stage", type=int, default=8)
+    parser.add_argument("--legacy_max_depth", type=int, default=4096, help="skip the reference implementation above this depth")
+    args = parser.parse_args()
+
+    print(f"{'depth':>7} {'fx nodes':>9} {'part_fn (s)':>12} {'legacy (s)':>11} {'xref (s)':>10} {'legacy (s)':>11}")
+    for depth in args.depths:
+        row = bench(depth, args.num_stage, depth <= args.legacy_max_depth)
+        lp = f"{row['legacy_part']:11.4f}" if "legacy_part" in row else f"{'-':>11}"
+        lx = f"{row['legacy_xref']:11.4f}" if "legacy_xref" in row else f"{'-':>11}"
+        print(f"{row['depth']:7d} {row['fx_nodes']:9d} {row['part']:12.4f} {lp} {row['xref']:10.4f} {lx}")
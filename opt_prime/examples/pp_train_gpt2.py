@@ -17,10 +17,10 @@ import time
 
 from transformers import GPT2Tokenizer, GPT2LMHeadModel, GPT2Config
 from datasets import load_dataset
-from torch.utils.data import DataLoader
 
 sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
 from opt_prime.opti_pri import Optimus_p
+from opt_prime.data_loader import MicroBatchLoader, TokenizeCollate, PackCollate
 
 logging.basicConfig(level=logging.ERROR)
 
@@ -63,7 +63,9 @@ scheduler = torch.optim.lr_scheduler.StepLR(optimizer, 1.0, gamma=0.95)
 
 datasets = load_dataset("squad").data["train"]["context"]
 datasets = [str(record) for record in datasets if len(str(record)) < 500]
-dataloader = DataLoader(datasets, batch_size=batch_size, num_workers=4)
+# tokenized by 4 workers on the first stage; labels shipped to the last stage during the step
+dataloader = MicroBatchLoader(optimus_p, datasets, batch_size=batch_size, collate_fn=TokenizeCollate(tokenizer, max_length=1024), num_workers=4)
+#dataloader = MicroBatchLoader(optimus_p, datasets, batch_size=batch_size, collate_fn=PackCollate(tokenizer, optimus_p.mbsize, max_length=1024), num_workers=4)
 data_size=len(dataloader.dataset)
 print(f"data_size={data_size}")
 nbatches = len(dataloader)
@@ -79,16 +81,7 @@ def train():
     total_loss = 0
     start_time = time.time()
 
-    for i, batch in enumerate(dataloader):
-
-        data, labels = None, None
-
-        # prepare input and label
-        if optimus_p.is_first_stage():
-            tokens =  tokenizer(batch, padding=True, truncation=True, max_length=1024,return_tensors="pt")
-            data, labels = tokens.input_ids, tokens.input_ids
-
-        labels = optimus_p.move_labels2last_stage(labels)
+    for i, (data, labels) in enumerate(dataloader):
 
         optimizer.zero_grad()
 
@@ -101,8 +94,8 @@ def train():
         else:
             loss = None
 
-        torch.nn.utils.clip_grad_norm_(optimus_p.parameters(), 0.5)
-        optimizer.step()
+        # clip by the gradient norm of the whole model, then a foreach optimizer step
+        optimus_p.optimizer_step(optimizer, max_norm=0.5)
 
         if optimus_p.is_last_stage():
             loss = sum(loss) / optimus_p.mbsize
@@ -31,8 +31,10 @@ from torch import fx
 from torch.fx.node import Node
 from torch.fx.graph_module import GraphModule
 from torch.fx.passes.split_module import split_module
+from torch.fx.passes.shape_prop import ShapeProp
 import copy
 import time
+import itertools
 
 import torch.distributed as dist
 import datetime
@@ -80,6 +82,8 @@ class IR(object):
 
         self.special_nodes: Dict[str, Tuple[int, int]] = {}  # { node_name : {stage#, needed-by-stage#),}
 
+        self.optimizer_states = 2 # optimizer states per parameter for cost_split's mem_budget (Adam)
+
 
     def retrieve_IR(self, model: nn.Module):
 
@@ -108,12 +112,17 @@ class IR(object):
             sys.exit(1)
 
 
-    def split_IR(self, model: nn.Module, method, num_stage):
+    def split_IR(self, model: nn.Module, method, num_stage, sample_input=None, profile=False, mem_budget=None, in_flight=None):
 
-        if method not in [ "simple", ]:
+        if method not in [ "simple", "cost", ]:
             print(f"Not supported split method!")
             sys.exit(1)
 
+        if mem_budget is not None and method == "simple":
+            if int(os.environ["RANK"]) == 0:
+                print(f">> mem_budget given, split method: simple --> cost")
+            method = "cost"
+
         # TODO: TO DELETE
         #if int(os.environ["RANK"]) == 0:
         #    print(f">> ------------------ FX graph (pre) --------------------------------")
@@ -124,6 +133,9 @@ class IR(object):
         if method == "simple":
             submods = self.simple_split(model, num_stage)
 
+        elif method == "cost":
+            submods = self.cost_split(model, num_stage, sample_input, profile, mem_budget, in_flight)
+
         # TODO: add new split method
         #elif method == ...
         #
@@ -155,36 +167,6 @@ class IR(object):
         ## simple assert
         assert length >= num_stage, f"Model length:{length} is smaller than # of workers:{num_stage}"
         
-        self.last_flag = False
-
-        def part_fn(node):
-            last_idx, last_name = self.metadata_range[-1]
-            
-            if self.last_flag == True:
-                idx = last_idx
-                #print(f" part_fn:  node.name:{node.name}, --> {idx}")
-                return idx
-            
-            idx = 0
-            
-            cur = node
-            while cur.name != last_name:
-                for i, m_name in self.metadata_range:
-                    if cur.name == m_name:
-                        idx = i
-                        #print(f" part_fn:  node.name:{node.name}, m_name:{m_name}, --> {idx}")
-                        return idx
-            
-                cur = cur._next
-            
-            if cur.name == last_name:
-                idx = last_idx
-                self.last_flag = True
-            
-            #print(f" part_fn:  node.name:{node.name}, --> {idx}")
-            return idx
-            
-
         k, cnt = 0, 0
         for n in self.gm.graph.nodes:
             if n.op == 'call_module':
@@ -206,6 +188,318 @@ class IR(object):
             print(f"  rank:{self.optimus.tpl.rank},  first metadata_range: {self.metadata_range}")
             print(f" ------------------------------------------------------------")
 
+        return self.split_by_metadata_range(module, num_stage)
+
+
+    # Split into num_stage contiguous stages of balanced estimated cost.
+    #   Cut points are call_module nodes (as in simple_split). The cost of a node is its FLOP
+    #   estimate (from the shapes of sample_input if given, else from its parameters) or, with
+    #   profile=True, its measured forward time on sample_input.
+    #   With mem_budget (bytes per device), every stage must also fit its parameters, gradients,
+    #   optimizer states and the activations of in_flight(stage) micro-batches (sample_input is
+    #   taken as one micro-batch).
+    def cost_split(self, module, num_stage, sample_input=None, profile=False, mem_budget=None, in_flight=None):
+        length = self.gm.graph.nodes.__len__()
+        assert length >= num_stage, f"Model length:{length} is smaller than # of workers:{num_stage}"
+
+        node_cost = self.estimate_node_cost(sample_input, profile)
+        node_param_bytes = self.get_node_param_bytes()
+        node_act_bytes = self.get_node_act_bytes()
+
+        if mem_budget is not None and len(node_act_bytes) == 0 and int(os.environ["RANK"]) == 0:
+            print(f"cost_split: mem_budget without sample_input, activation memory not counted")
+
+        # units: runs of nodes ending at a call_module node
+        units = []  # [ (last call_module node name, cost, param bytes, activation bytes, output bytes), ]
+        cost, param_bytes, act_bytes = 0, 0, 0
+        for n in self.gm.graph.nodes:
+            cost = cost + node_cost.get(n.name, 0)
+            param_bytes = param_bytes + node_param_bytes.get(n.name, 0)
+            act_bytes = act_bytes + node_act_bytes.get(n.name, 0)
+            if n.op == 'call_module':
+                units.append((n.name, cost, param_bytes, act_bytes, node_act_bytes.get(n.name, 0)))
+                cost, param_bytes, act_bytes = 0, 0, 0
+        last_node_name = n.name
+
+        assert len(units) >= num_stage, f"# of call_module nodes:{len(units)} is smaller than # of stages:{num_stage}"
+
+        # nodes after the last call_module belong to the last stage
+        name, cost_, param_bytes_, act_bytes_, out_bytes_ = units[-1]
+        units[-1] = (name, cost_ + cost, param_bytes_ + param_bytes, act_bytes_ + act_bytes, out_bytes_)
+
+        if in_flight is None:
+            in_flight = lambda stage: 1
+
+        def stage_mem(stage, begin, end):
+            param_bytes = sum(u[2] for u in units[begin:end])
+            act_bytes = sum(u[3] for u in units[begin:end])
+            # weight + gradient + optimizer states (Adam: 2)
+            mem = param_bytes * (2 + self.optimizer_states)
+            if self.optimus.activation_ckpt == True:
+                # stashed stage inputs + activations of the micro-batch being recomputed
+                in_bytes = units[begin - 1][4] if begin > 0 else 0
+                return mem + in_flight(stage) * in_bytes + act_bytes
+            return mem + in_flight(stage) * act_bytes
+
+        fits = None
+        if mem_budget is not None:
+            fits = lambda stage, begin, end: stage_mem(stage, begin, end) <= mem_budget
+
+        parts = self.balanced_partition([u[1] for u in units], num_stage, fits)
+        if parts is None:
+            if int(os.environ["RANK"]) == 0:
+                print(f"cost_split: no split fits mem_budget:{mem_budget / (1024 ** 2):.2f} MB, memory ignored")
+            parts = self.balanced_partition([u[1] for u in units], num_stage)
+
+        self.metadata_range = []
+        self.stage_cost = []
+        self.stage_param_bytes = []
+        self.stage_mem_bytes = []
+        for k, (begin, end) in enumerate(parts):
+            name = units[end - 1][0] if k < num_stage - 1 else last_node_name
+            self.metadata_range.append((k, name))
+            self.stage_cost.append(sum(u[1] for u in units[begin:end]))
+            self.stage_param_bytes.append(sum(u[2] for u in units[begin:end]))
+            self.stage_mem_bytes.append(stage_mem(k, begin, end))
+
+        if int(os.environ["RANK"]) == 0:
+            total_cost = sum(self.stage_cost)
+            print(f" ------------------------------------------------------------")
+            print(f"  rank:{self.optimus.tpl.rank},  first metadata_range: {self.metadata_range}")
+            print(f"  cost metric: {self.cost_metric}")
+            for k in range(num_stage):
+                print(f"  stage:{k}, predicted load:{self.stage_cost[k]:.4g} ({self.stage_cost[k] * 100 / max(total_cost, 1e-12):.1f}%), param:{self.stage_param_bytes[k] / (1024 ** 2):.2f} MB, peak mem:{self.stage_mem_bytes[k] / (1024 ** 2):.2f} MB (in-flight mb:{in_flight(k)})")
+            print(f"  max/mean load: {max(self.stage_cost) * num_stage / max(total_cost, 1e-12):.3f}")
+            print(f" ------------------------------------------------------------")
+
+        return self.split_by_metadata_range(module, num_stage)
+
+
+    # contiguous partition of costs into num_part non-empty parts minimizing the max part cost
+    #   fits(part#, begin, end): optional constraint on each part; must hold for sub-ranges of a
+    #   fitting range and for a range moved to a later part#
+    #   returns [(begin, end), ...] or None if no partition satisfies fits
+    def balanced_partition(self, costs, num_part, fits=None):
+        n = len(costs)
+        if fits is None:
+            fits = lambda part, begin, end: True
+
+        # greedy: extend each part as far as cap and fits allow
+        #   force_parts: cut early enough to leave one unit for every remaining part
+        def greedy(cap, force_parts=False):
+            parts = []
+            begin, acc = 0, 0
+            for i, c in enumerate(costs):
+                remaining_parts = num_part - len(parts) - 1
+                if i > begin and (acc + c > cap or not fits(len(parts), begin, i + 1) or (force_parts and n - i == remaining_parts)):
+                    parts.append((begin, i))
+                    begin, acc = i, 0
+                if not fits(len(parts), i, i + 1):
+                    return None
+                acc = acc + c
+            parts.append((begin, n))
+            return parts
+
+        parts = greedy(sum(costs))
+        if parts is None or len(parts) > num_part:
+            return None
+
+        # binary search on the max part cost
+        lo, hi = max(costs), sum(costs)
+        for _ in range(100):
+            if hi - lo <= 1e-9 * max(hi, 1):
+                break
+            mid = (lo + hi) / 2
+            parts = greedy(mid)
+            if parts is not None and len(parts) <= num_part:
+                hi = mid
+            else:
+                lo = mid
+
+        parts = greedy(hi, force_parts=True)
+        assert len(parts) == num_part
+        return parts
+
+
+    def get_node_param_bytes(self):
+        node_param_bytes = {}
+        for n in self.gm.graph.nodes:
+            if n.op == 'call_module':
+                mod = self.gm.get_submodule(n.target)
+                node_param_bytes[n.name] = sum(t.numel() * t.element_size() for t in itertools.chain(mod.parameters(), mod.buffers()))
+            elif n.op == 'get_attr':
+                t = self.get_attr_value(n.target)
+                if isinstance(t, torch.Tensor):
+                    node_param_bytes[n.name] = t.numel() * t.element_size()
+        return node_param_bytes
+
+
+    # output bytes of each node (tensor_meta recorded by ShapeProp)
+    def get_node_act_bytes(self):
+        def meta_bytes(meta):
+            if hasattr(meta, 'shape') and hasattr(meta, 'dtype'):
+                return math.prod(meta.shape) * torch.empty((), dtype=meta.dtype).element_size()
+            if isinstance(meta, (tuple, list)):
+                return sum(meta_bytes(m) for m in meta)
+            if isinstance(meta, dict):
+                return sum(meta_bytes(m) for m in meta.values())
+            return 0
+
+        node_act_bytes = {}
+        for n in self.gm.graph.nodes:
+            if n.op in ('call_module', 'call_function', 'call_method') and 'tensor_meta' in n.meta:
+                node_act_bytes[n.name] = meta_bytes(n.meta['tensor_meta'])
+        return node_act_bytes
+
+
+    def get_attr_value(self, target):
+        attr_itr = self.gm
+        for atom in target.split('.'):
+            attr_itr = getattr(attr_itr, atom)
+        return attr_itr
+
+
+    def estimate_node_cost(self, sample_input=None, profile=False):
+        if sample_input is not None and not isinstance(sample_input, (tuple, list)):
+            sample_input = (sample_input,)
+
+        if sample_input is not None and self.optimus.meta_init == True:
+            # meta parameters: shapes only
+            sample_input = tuple(t.to("meta") if isinstance(t, torch.Tensor) else t for t in sample_input)
+            if profile == True:
+                print(f"cost_split: profile=True not supported with a model on the meta device, FLOP estimate used")
+                profile = False
+
+        if sample_input is not None:
+            try:
+                with torch.no_grad():
+                    ShapeProp(self.gm).propagate(*sample_input)
+            except Exception as e:
+                # e.g. meta parameters mixed with CPU buffers
+                print(f"cost_split: shape propagation failed ({type(e).__name__}), estimate from parameters")
+                for n in self.gm.graph.nodes:
+                    n.meta.pop('tensor_meta', None)
+                sample_input = None
+
+        if profile == True and self.optimus.ir_analyze == IR_Anal.SEQUENTIAL:
+            # ranks trace one after another, measured times would not agree
+            print(f"cost_split: profile=True not supported with IR_Anal.SEQUENTIAL, FLOP estimate used")
+            profile = False
+
+        if profile == True and sample_input is not None:
+            node_time = NodeTimeProfiler(self.gm).profile(*sample_input)
+            if dist.is_initialized() and self.optimus.ir_analyze == IR_Anal.PARALLEL:
+                # all ranks must split identically
+                object_list = [node_time]
+                dist.broadcast_object_list(object_list, src=0)
+                node_time = object_list[0]
+            self.cost_metric = "forward time (sec)"
+            return node_time
+
+        if profile == True:
+            print(f"cost_split: profile=True needs sample_input, FLOP estimate used")
+
+        self.cost_metric = "FLOPs"
+        node_cost = {}
+        for n in self.gm.graph.nodes:
+            node_cost[n.name] = self.estimate_node_flops(n)
+        return node_cost
+
+
+    # FLOP estimate of a node; uses the tensor_meta recorded by ShapeProp if available
+    def estimate_node_flops(self, n):
+        meta = n.meta.get('tensor_meta', None)
+        out_numel = math.prod(meta.shape) if hasattr(meta, 'shape') else None
+
+        def input_shape(i):
+            if i < len(n.args) and isinstance(n.args[i], Node):
+                m = n.args[i].meta.get('tensor_meta', None)
+                if hasattr(m, 'shape'):
+                    return tuple(m.shape)
+            return None
+
+        if n.op == 'call_module':
+            mod = self.gm.get_submodule(n.target)
+            num_params = sum(p.numel() for p in mod.parameters())
+
+            if isinstance(mod, nn.Embedding):
+                return out_numel if out_numel is not None else mod.embedding_dim
+            if isinstance(mod, nn.Linear):
+                return 2 * mod.in_features * (out_numel if out_numel is not None else mod.out_features)
+            if type(mod).__name__ == "Conv1D": # HF GPT-2, weight: (nx, nf)
+                nx = mod.weight.shape[0]
+                return 2 * nx * (out_numel if out_numel is not None else mod.weight.shape[1])
+            if isinstance(mod, nn.modules.conv._ConvNd):
+                k = mod.weight[0].numel() # in_channels/groups * kernel size
+                return 2 * k * (out_numel if out_numel is not None else mod.out_channels)
+            if out_numel is not None:
+                return out_numel * (5 if num_params > 0 else 1) # norm, activation, ...
+            return 2 * num_params
+
+        if n.op in ('call_function', 'call_method'):
+            target = n.target if n.op == 'call_function' else str(n.target)
+            if target in (torch.matmul, torch.bmm, torch.mm, 'matmul', 'bmm', 'mm') and out_numel is not None:
+                a = input_shape(0)
+                return 2 * out_numel * (a[-1] if a else 1)
+            if target in (torch.baddbmm, torch.addmm, 'baddbmm', 'addmm') and out_numel is not None:
+                a = input_shape(1)
+                return 2 * out_numel * (a[-1] if a else 1)
+            if out_numel is not None:
+                return out_numel # elementwise, reshape, ...
+
+            # no shape: per-token cost of the parameters used (e.g. traced-through HF Conv1D)
+            param_numel = 0
+            for arg in n.all_input_nodes:
+                if arg.op == 'get_attr':
+                    t = self.get_attr_value(arg.target)
+                    if isinstance(t, torch.Tensor):
+                        param_numel = param_numel + t.numel()
+            return 2 * param_numel if target in (torch.matmul, torch.mm, torch.addmm, 'matmul', 'mm', 'addmm') else param_numel
+
+        return 0
+
+
+    # node name of self.gm --> stage, in one pass: a node belongs to the first metadata_range
+    #   node at or after it; nodes after the last one belong to the last stage
+    def get_node_partition(self):
+        last_idx, last_name = self.metadata_range[-1]
+        boundary = {}
+        for i, m_name in self.metadata_range:
+            boundary.setdefault(m_name, i)
+
+        partition = {}
+        pending = []
+        done = False
+        for n in self.gm.graph.nodes:
+            if done == True:
+                partition[n.name] = last_idx
+                continue
+            pending.append(n.name)
+            if n.name == last_name:
+                idx = last_idx
+                done = True
+            elif n.name in boundary:
+                idx = boundary[n.name]
+            else:
+                continue
+            for name in pending:
+                partition[name] = idx
+            pending = []
+        for name in pending:
+            partition[name] = last_idx
+
+        return partition
+
+
+    # split self.gm into num_stage submodules at the nodes in self.metadata_range
+    def split_by_metadata_range(self, module, num_stage):
+
+        last_idx = self.metadata_range[-1][0]
+        partition = self.get_node_partition()
+
+        def part_fn(node):
+            return partition.get(node.name, last_idx)
+
         submodules = split_module(self.gm, module, part_fn, keep_original_order=True)
 
 
@@ -315,81 +609,68 @@ class IR(object):
 
 
 
+    # node --> (index, stage) of the split graph g, for cross_reference_analyze
+    #   the nodes after metadata_range[k-1] up to metadata_range[k] belong to stage k
+    def build_node_maps(self, g:fx.Graph):
+        node_idx, node_stage = {}, {}
+        stage_ = 0
+        node_by_name = {}
+        for i, n in enumerate(g.nodes):
+            node_idx[n] = i
+            node_by_name[n.name] = n
+            node_stage[n] = stage_
+            if n.name == self.metadata_range[stage_][1] and stage_ < len(self.metadata_range) - 1:
+                stage_ = stage_ + 1
+
+        self.node_maps = (g, len(node_idx), node_idx, node_stage, node_by_name)
+
+
     # analyze IR graph and find the cross-layer referenced nodes
+    #   special_nodes: { node_name : (producing stage, last stage that needs it) }
+    #   Call for stage = num_stage-1, ..., 1; each call visits the edges of its stage once.
     def cross_reference_analyze(self, stage, g:fx.Graph):
     
         if stage == 0:
             return
-    
-        from_, to_ = self.get_range(stage, g)
+
+        if getattr(self, "node_maps", None) is None or self.node_maps[0] is not g or self.node_maps[1] != len(g.nodes):
+            self.build_node_maps(g)
+        _, _, node_idx, node_stage, node_by_name = self.node_maps
+
+        # same as get_range(stage, g)
+        from_ = node_by_name[self.metadata_range[stage-1][1]]._next
+        to_ = node_by_name[self.metadata_range[stage][1]]
     
         #logging.debug(f" ***** stage:{stage} >>  from_:{from_.name}, to_:{to_.name}")
         print(f" ***** stage:{stage} >>  from_:{from_.name}, to_:{to_.name}")
-    
+
+        from_idx = node_idx[from_]
+
         cur = to_
-        while (cur != from_) or (stage > 0 and cur == from_):
-    
-            # in process check - backward direction
-    
-            #for _, target_ in enumerate(cur.all_input_nodes):
+        while True:
+            cur_idx = node_idx[cur]
+
             for i, target_ in enumerate(cur.all_input_nodes):
                 if cur.name == "loss_fn" and i > 0:
                     break
-                referenced_in = False
-                referenced_out = False
-    
-                inner = cur._prev
-                if inner != from_._prev:
-                    while (inner != from_) or (stage > 0 and inner == from_):
-                        if inner.name == target_.name:
-                            #logging.debug(f" [cross_reference_analyze] ({target_.name}) referenced in current stage:{stage} !")
-                            referenced_in = True
-                            break
-    
-                        if inner == from_:
-                            break
-    
-                        inner = inner._prev
-    
-                if referenced_in == True:
+
+                target_idx = node_idx[target_]
+
+                # referenced in current stage
+                if from_idx <= target_idx < cur_idx:
                     continue
-    
-                if referenced_in == False:
-    
-                    # output process check - forward direction
-    
-                    stage_ = 0
-                    split_node_name = self.metadata_range[stage_][1]
-    
-                    for k in g.nodes:
-                        first_node = k
-                        break
-    
-                    outer = first_node
-                    while outer != from_: 
-                        # DEBUG
-                        if outer.name == target_.name:
-                            logging.info(f" [cross_reference_analyze] ({target_.name}) referenced in outer stage:{stage_} !!")
-    
-                            if target_.name not in self.special_nodes:
-                                self.special_nodes[target_.name] = (stage_, stage)  # { node_name : {stage#, needed-by-stage#),}
-                            referenced_out = True
-                            break
-    
-                        if outer.name == split_node_name:
-                            stage_ = stage_ + 1
-                            split_node_name = self.metadata_range[stage_][1]
-    
-                        outer = outer._next
-    
-    
-                if referenced_out == False:
+
+                if target_idx >= from_idx:
                     logging.critical(f"[Error] cannot handle this case: {target_.name} !!!")
                     sys.exit(1)
-    
+
+                logging.info(f" [cross_reference_analyze] ({target_.name}) referenced in outer stage:{node_stage[target_]} !!")
+                if target_.name not in self.special_nodes:
+                    self.special_nodes[target_.name] = (node_stage[target_], stage)  # { node_name : {stage#, needed-by-stage#),}
+
             if cur == from_:
                 break
-    
+
             cur = cur._prev
 
 
@@ -544,7 +825,7 @@ class IR(object):
         self.reference = []
 
         for stage in reversed(range(self.optimus.tpl.num_stage)):
-            if stage != self.optimus.tpl.get_stage():
+            if stage not in self.optimus.tpl.stages:
                 del_name = f"submod_{stage}"
                 self.delete_intermediate_module(del_name)
 
@@ -557,3 +838,39 @@ class IR(object):
         gc.collect()
         torch.cuda.empty_cache()
 
+
+
+# measured forward time of every node of a GraphModule (min over repeat runs)
+class NodeTimeProfiler(fx.Interpreter):
+
+    def __init__(self, gm: GraphModule, warmup=1, repeat=3):
+        super().__init__(gm)
+        self.warmup = warmup
+        self.repeat = repeat
+        self.node_time = {}
+        self.recording = False
+        self.sync = torch.cuda.is_available()
+
+    def run_node(self, n):
+        if self.recording == False:
+            return super().run_node(n)
+
+        if self.sync == True:
+            torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        result = super().run_node(n)
+        if self.sync == True:
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - t0
+        self.node_time[n.name] = min(self.node_time.get(n.name, elapsed), elapsed)
+        return result
+
+    def profile(self, *args):
+        with torch.no_grad():
+            for _ in range(self.warmup):
+                self.run(*args)
+            self.recording = True
+            for _ in range(self.repeat):
+                self.run(*args)
+            self.recording = False
+        return self.node_time
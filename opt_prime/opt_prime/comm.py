@@ -2,7 +2,10 @@ import torch
 import torch.distributed as dist
 import logging
 import os
+import sys
+import math
 from torch import Tensor, Size
+from typing import Any, Dict, List
 
 from opt_prime.IR import IR_Anal
 
@@ -12,6 +15,17 @@ logging.basicConfig(level=logging.ERROR)
 
 NoneType=type(None)
 
+# int64 slots of the fixed-size header message; larger headers are sent in two parts
+HEADER_CAPACITY = 64
+
+# schema tag sent on a keyed channel once both sides hold the same schema
+SCHEMA_HIT = 1
+SCHEMA_MISS = 0
+ASYNC_SCHEMA_HIT = -1
+
+# max bytes of a flat bucket when streaming stage tensors (IR_Anal.SINGLE)
+STREAM_BUCKET_SIZE = 64 * 1024 * 1024
+
 
 class Comm:
 
@@ -24,7 +38,8 @@ class Comm:
             Size: 103, 
             int: 104, 
             NoneType: 105,
-            type: 106, }
+            type: 106,
+            set: 107, }
 
         self.ds_id2type = {v:k for k, v in self.ds_type2id.items()}
         
@@ -44,6 +59,15 @@ class Comm:
 
         self.tensor_id2type = {v:k for k,v in self.tensor_type2id.items()}
 
+        # schema cache for keyed channels
+        self.send_schema: Dict[Any, List[int]] = {}   # { (to_rank, key) : header }
+        self.recv_schema: Dict[Any, List[int]] = {}   # { (from_rank, key) : header }
+        self.recv_buffers: Dict[Any, Dict[Any, List[Tensor]]] = {}  # { (from_rank, key) : { slot : [tensor, ...] } }
+        self.schema_tag: Dict[Any, Tensor] = {}  # { device : tag tensor }
+        self.last_irecv: Dict[Any, Any] = {}  # { (from_rank, group) : last AsyncRecv posted or queued }
+        self.send_varying = set()  # { (to_rank, key) } whose schema changed on an async send
+        self.recv_varying = set()  # { (from_rank, key) } whose schema changed on an async receive
+
         self.init_comm(use_gpu)
 
         if ir_analyze == IR_Anal.SINGLE:
@@ -85,168 +109,263 @@ class Comm:
 
 
 
-    def receive_data(self, from_rank, device):
-        ds_type = torch.tensor([0], dtype=torch.long, device=device)
-        dist.recv(ds_type, from_rank)
+    # Packed wire format (one message per object tree, plus payloads):
+    #
+    #   [header: HEADER_CAPACITY x int64] [header overflow (optional)] [payload #0] [payload #1] ...
+    #
+    # header[0] is the length of the encoded tree, which follows in pre-order.
+    # Every object starts with its ds_type id, then
+    #   Tensor                : ndim, shape[0], ..., shape[ndim-1], dtype id
+    #   tuple/list/set/Size   : length, then the encoded elements
+    #   int                   : value
+    #   type                  : ds_type id of the object
+    #   None                  : (nothing)
+    # Tensor payloads are sent in the order they appear in the header.
 
-        ds_type = self.ds_id2type[ds_type.item()]
-        
-        #if str(ds_type) == "<class 'Tensor'>":
-        if ds_type is Tensor:
-            return self.receive_tensor(from_rank, device)
-        #elif str(ds_type) == "<class 'tuple'>":
-        elif ds_type is tuple:
-            return self.receive_tuple(from_rank, device)
-        #elif str(ds_type) == "<class 'list'>":
-        elif ds_type is list:
-            return self.receive_list(from_rank, device)
-        elif ds_type is Size:
-            return self.receive_size(from_rank, device)
-        elif ds_type is int:
-            return self.receive_int(from_rank, device)
-        elif ds_type is set:
-            return self.receive_set(from_rank, device)
-        elif ds_type is NoneType:
-            return self.receive_none(from_rank)
-        elif ds_type is type:
-            return self.receive_type(from_rank, device)
+    # With key given, the header is cached per (peer, key) on both sides. Later sends
+    # with the same schema carry only a SCHEMA_HIT tag and the payloads; a changed
+    # schema falls back to SCHEMA_MISS + full header. With slot also given, the
+    # receiver reuses the receive buffers of that (peer, key, slot), so the
+    # previously received value of the slot must be dead by then.
+
+    def receive_data(self, from_rank, device, key=None, slot=None):
+        ck = None if key is None else (from_rank, key)
+
+        if ck is None:
+            header = self.receive_header(from_rank, device)
         else:
-            logging.critical(f"#### receive_data: not supported type!")
-        # TODO
+            header = self.recv_schema.get(ck)
+            if header is None or self.receive_tag(from_rank, device) != SCHEMA_HIT:
+                header = self.receive_header(from_rank, device)
+                self.recv_schema[ck] = header
+                self.recv_buffers[ck] = {}
 
+        obj, tensors = self.build_recv_obj(header, device, ck, slot)
 
-    def send_data(self, obj, to_rank, device):
-        ds_type = self.ds_type2id[type(obj)]
-        ds_type = torch.tensor(ds_type, dtype=torch.long, device=device)
-        dist.send(ds_type, to_rank)
+        for t in tensors:
+            dist.recv(t, from_rank)
 
-        if isinstance(obj, torch.Tensor):
-            self.send_tensor(obj, to_rank, device)
-        elif isinstance(obj, tuple):
-            self.send_tuple(obj, to_rank, device)
-        elif isinstance(obj, list):
-            self.send_list(obj, to_rank, device)
-        elif isinstance(obj, Size):
-            self.send_size(obj, to_rank, device)
-        elif isinstance(obj, int):
-            self.send_int(obj, to_rank, device)
-        elif isinstance(obj, set):
-            self.send_set(obj, to_rank, device)
-        elif obj is None:
-            self.send_none(obj, to_rank)
-        elif isinstance(obj, type):
-            self.send_type(obj, to_rank, device)
+        return obj
+
+
+    def send_data(self, obj, to_rank, device, key=None):
+        header = []
+        tensors = []
+        self.encode_header(obj, header, tensors, device)
+
+        if key is None:
+            self.send_header(header, to_rank, device)
+        else:
+            ck = (to_rank, key)
+            cached = self.send_schema.get(ck)
+            if cached is not None and cached == header:
+                self.send_tag(SCHEMA_HIT, to_rank, device)
+            else:
+                if cached is not None:
+                    self.send_tag(SCHEMA_MISS, to_rank, device)
+                self.send_header(header, to_rank, device)
+                self.send_schema[ck] = header
+
+        for t in tensors:
+            dist.send(t, to_rank)
+
+
+    # Non-blocking variants. The fixed-size header message is always sent, so the
+    # receiver can post it in advance; header[0] == ASYNC_SCHEMA_HIT replaces the
+    # tag. With a cached schema the receiver also posts the payload irecvs in
+    # advance, until the schema of the key changes once: the sender then sends
+    # dummy payloads of the cached schema to match them, then the header overflow
+    # and the new payloads, and both sides mark the key as varying. For a varying
+    # key (ex. sequence length padded per batch) the payloads are received only
+    # after the header, so a schema change costs no dummies.
+    # The irecvs from a peer are posted in turn (see AsyncRecv), so a schema change
+    # does not shift the messages matched by the receives issued after it.
+    # With group given, the messages go through that process group, so they are
+    # not matched against the other messages between the two ranks.
+
+    def isend_data(self, obj, to_rank, device, key=None, group=None):
+        header = []
+        tensors = []
+        self.encode_header(obj, header, tensors, device)
+
+        ck = None if key is None else (to_rank, key)
+        cached = None if ck is None else self.send_schema.get(ck)
+
+        works = []
+        if cached is not None and cached == header:
+            packed = self.pack_header([ASYNC_SCHEMA_HIT], device, with_length=False)
+            works.append(dist.isend(packed, to_rank, group=group))
+            keep = [packed]
         else:
-            logging.critical(f"#### send_data: not supported type!")
+            packed = self.pack_header(header, device)
+            works.append(dist.isend(packed[:HEADER_CAPACITY], to_rank, group=group))
+            keep = [packed]
 
+            if cached is not None and ck not in self.send_varying:
+                self.send_varying.add(ck)
+                dummies = []
+                self.decode_header(cached, 0, dummies, device)
+                for t in dummies:
+                    works.append(dist.isend(t, to_rank, group=group))
+                keep.extend(dummies)
 
-    def receive_set(self, from_rank, device):
-        return set(self.receive_list(from_rank, device))
+            if packed.numel() > HEADER_CAPACITY:
+                works.append(dist.isend(packed[HEADER_CAPACITY:], to_rank, group=group))
 
-    def send_set(self, obj, to_rank, device):
-        self.send_list(list(obj), to_rank, device)
+            if ck is not None:
+                self.send_schema[ck] = header
 
-    def receive_int(self, from_rank, device):
-        int_data = torch.tensor([0], dtype=torch.long, device=device)
-        dist.recv(int_data, from_rank)
-        return int_data.item()
+        for t in tensors:
+            works.append(dist.isend(t, to_rank, group=group))
+        keep.extend(tensors)
 
-    def send_int(self, obj, to_rank, device):
-        int_data = torch.tensor([obj], dtype=torch.long, device=device) # ex. 2
-        dist.send(int_data, to_rank)
+        return AsyncSend(works, keep)
 
 
-    def receive_size(self, from_rank, device):
-        return Size(self.receive_list(from_rank, device))
+    def irecv_data(self, from_rank, device, key=None, slot=None, group=None):
+        return AsyncRecv(self, from_rank, device, key, slot, group)
 
-    def send_size(self, obj, to_rank, device):
-        self.send_list(list(obj), to_rank, device)
 
-    def receive_tuple(self, from_rank, device):
-        return tuple(self.receive_list(from_rank, device))
+    def build_recv_obj(self, header, device, ck=None, slot=None):
+        buffers = None
+        if ck is not None and slot is not None:
+            buffers = self.recv_buffers[ck].get(slot)
 
-    def send_tuple(self, obj, to_rank, device):
-        self.send_list(list(obj), to_rank, device)
+        tensors = []
+        obj, _ = self.decode_header(header, 1, tensors, device, None if buffers is None else iter(buffers))
 
-    def send_none(self, obj, to_rank):
-        logging.debug(f"send_none")
+        if ck is not None and slot is not None and buffers is None:
+            self.recv_buffers[ck][slot] = tensors
 
-    def receive_none(self, from_rank):
-        return None
+        return obj, tensors
 
-    def send_type(self, obj, to_rank, device):
-        type_data = torch.tensor([self.ds_type2id[type(obj)]], dtype=torch.long, device=device) # ex. 2
-        dist.send(type_data, to_rank)
 
-    def receive_type(self, from_rank, device):
-        type_data = torch.tensor([0], dtype=torch.long, device=device)
-        dist.recv(type_data, from_rank)
-        return self.ds_id2type[type_data.item()]
+    def get_schema_tag(self, device):
+        if device not in self.schema_tag:
+            self.schema_tag[device] = torch.zeros(1, dtype=torch.long, device=device)
+        return self.schema_tag[device]
 
-    def receive_tensor(self, from_rank, device):
-        dimension = torch.tensor([0], dtype=torch.long, device=device)
-        dist.recv(dimension, from_rank)
-        #logging.debug(f" >>>>> recv_tensor, dimension:{dimension} from rank:{from_rank}")
+    def send_tag(self, tag, to_rank, device):
+        tag_data = self.get_schema_tag(device)
+        tag_data.fill_(tag)
+        dist.send(tag_data, to_rank)
 
-        shape = torch.tensor([0] * dimension.item(), dtype=torch.long, device=device)
-        dist.recv(shape, from_rank)
-        #logging.debug(f" >>>>> recv_tensor, shaple:{shape} from rank:{from_rank}")
-        shape = tuple(shape.tolist())
+    def receive_tag(self, from_rank, device):
+        tag_data = self.get_schema_tag(device)
+        dist.recv(tag_data, from_rank)
+        return tag_data.item()
 
-        ttype = torch.tensor([0], dtype=torch.long, device=device)
-        dist.recv(ttype, from_rank)
-        #logging.debug(f" >>>>> recv_tensor, ttype:{ttype} from rank:{from_rank}")
+    def clear_schema(self):
+        self.send_schema = {}
+        self.recv_schema = {}
+        self.recv_buffers = {}
+        self.send_varying = set()
+        self.recv_varying = set()
 
-        ttype = self.tensor_id2type[ttype.item()]
 
-        obj = torch.zeros(size=shape, dtype=ttype, device=device)
-        dist.recv(obj, from_rank)
-        #logging.debug(f" >>>>> recv_tensor, obj:{obj} from rank:{from_rank}")
+    def pack_header(self, header, device, with_length=True):
+        if with_length:
+            header = [len(header)] + header
+        padding = max(HEADER_CAPACITY - len(header), 0)
+        return torch.tensor(header + [0] * padding, dtype=torch.long, device=device)
 
-        return obj
+    def send_header(self, header, to_rank, device):
+        packed = self.pack_header(header, device)
 
-    def send_tensor(self, obj, to_rank, device):
-        if isinstance(obj, torch.Tensor):
-            obj_size = obj.size()
-            dimension = torch.tensor(len(obj_size), dtype=torch.long, device=device) # ex. 2
-            logging.debug(f" >>>>> send_tensor, obj.size():{obj_size}, len:{len(obj_size)}, dimension:{dimension}")
-        dist.send(dimension, to_rank)
+        dist.send(packed[:HEADER_CAPACITY], to_rank)
+        if packed.numel() > HEADER_CAPACITY:
+            dist.send(packed[HEADER_CAPACITY:], to_rank)
+            logging.debug(f" >>>>> send_header, header overflow:{packed.numel() - HEADER_CAPACITY}")
+
+
+    def receive_header(self, from_rank, device):
+        packed = torch.empty(HEADER_CAPACITY, dtype=torch.long, device=device)
+        dist.recv(packed, from_rank)
+
+        return self.complete_header(packed.tolist(), from_rank, device)
+
+    def complete_header(self, header, from_rank, device, group=None):
+        length = header[0]
+        if length + 1 > HEADER_CAPACITY:
+            overflow = torch.empty(length + 1 - HEADER_CAPACITY, dtype=torch.long, device=device)
+            dist.recv(overflow, from_rank, group=group)
+            header = header + overflow.tolist()
+
+        return header[:length + 1]
+
+
+    def get_ds_type_id(self, obj):
+        if type(obj) in self.ds_type2id:
+            return self.ds_type2id[type(obj)]
+        if isinstance(obj, torch.Tensor): # ex. nn.Parameter
+            return self.ds_type2id[Tensor]
+        return None
+
+
+    def encode_header(self, obj, header, tensors, device):
+        ds_type = self.get_ds_type_id(obj)
+        if ds_type is None:
+            raise TypeError(f"send_data: not supported type [{type(obj)}]")
+
+        header.append(ds_type)
 
         if isinstance(obj, torch.Tensor):
-            shape = torch.tensor(list(obj_size), dtype=torch.long, device=device) # ex. [54, 5120]
-        dist.send(shape, to_rank)
+            header.append(obj.dim())
+            header.extend(obj.size())
+            header.append(self.tensor_type2id[obj.dtype])
+
+            if not obj.is_contiguous():
+                obj = obj.contiguous()
+            tensors.append(obj.to(device))
+        elif isinstance(obj, (tuple, list, set)): # including Size
+            header.append(len(obj))
+            for n in obj:
+                self.encode_header(n, header, tensors, device)
+        elif isinstance(obj, type):
+            header.append(self.ds_type2id.get(obj, self.ds_type2id[type]))
+        elif isinstance(obj, int):
+            header.append(obj)
 
-        ttype = self.tensor_type2id[obj.dtype]
-        ttype = torch.tensor(ttype, dtype=torch.long, device=device)
-        dist.send(ttype, to_rank)
-        #logging.debug(f" >>>>> send_tensor, ttype:{ttype}")
 
-        if not obj.is_contiguous():
-            obj = obj.contiguous()
-            #logging.debug(f" >>> obj made to be contiguous")
+    def decode_header(self, header, pos, tensors, device, buffers=None):
+        ds_type = self.ds_id2type[header[pos]]
+        pos = pos + 1
 
-        obj = obj.to(device)
-        dist.send(obj, to_rank)
-        #logging.debug(f" >>>>> send_tensor, obj:{obj}")
+        if ds_type is Tensor:
+            dimension = header[pos]
+            shape = tuple(header[pos + 1 : pos + 1 + dimension])
+            ttype = self.tensor_id2type[header[pos + 1 + dimension]]
+            pos = pos + dimension + 2
 
-    def receive_list(self, from_rank, device):
-        length = torch.tensor([0], dtype=torch.long, device=device)
-        dist.recv(length, from_rank)
+            if buffers is None:
+                obj = torch.empty(size=shape, dtype=ttype, device=device)
+            else:
+                obj = next(buffers).detach() # fresh leaf on the reused storage
+            tensors.append(obj)
+            return obj, pos
 
-        obj = []
-        for _ in range(length.item()):
-            n = self.receive_data(from_rank, device)
-            obj.append(n)
+        elif ds_type in (tuple, list, set, Size):
+            length = header[pos]
+            pos = pos + 1
 
-        return obj
+            obj = []
+            for _ in range(length):
+                n, pos = self.decode_header(header, pos, tensors, device, buffers)
+                obj.append(n)
 
-    def send_list(self, obj, to_rank, device):
-        length = torch.tensor(len(obj), dtype=torch.long, device=device)
-        dist.send(length, to_rank)
+            return ds_type(obj), pos
 
-        for n in obj:
-            self.send_data(n, to_rank, device)
+        elif ds_type is int:
+            return header[pos], pos + 1
 
+        elif ds_type is type:
+            return self.ds_id2type[header[pos]], pos + 1
+
+        elif ds_type is NoneType:
+            return None, pos
+
+        else:
+            raise TypeError(f"receive_data: not supported type [{ds_type}]")
 
     def setup_ctrl_group(self):
         print(f"[rank:{self.rank}] ir_analyze=IR_Anal.SINGLE")
@@ -266,3 +385,172 @@ class Comm:
             self.ctrl_group[rank] = dist.new_group(pair_ranks)
 
         print(f"[rank:{self.rank}], setup_ctrl_group completed")
+
+
+    # Streamed tensor shipping: tensors are packed per dtype into flat buckets of at most
+    # bucket_size bytes (a larger tensor gets its own bucket). Both sides derive the buckets
+    # from the same specs [(shape, dtype), ...]. Every bucket is sent to all to_ranks at once,
+    # while the next bucket is packed.
+
+    def get_buckets(self, specs, bucket_size=STREAM_BUCKET_SIZE):
+        buckets = []  # [ (dtype, [idx, ...], numel), ]
+        open_bucket = {}  # { dtype : index in buckets }
+        for i, (shape, dtype) in enumerate(specs):
+            numel = math.prod(shape)
+            element_size = torch.empty((), dtype=dtype).element_size()
+
+            b = open_bucket.get(dtype)
+            if b is None or (buckets[b][2] + numel) * element_size > bucket_size:
+                buckets.append((dtype, [], 0))
+                b = open_bucket[dtype] = len(buckets) - 1
+            buckets[b][1].append(i)
+            buckets[b] = (dtype, buckets[b][1], buckets[b][2] + numel)
+        return buckets
+
+
+    def send_tensors(self, tensors, to_ranks, device, bucket_size=STREAM_BUCKET_SIZE):
+        specs = [(tuple(t.shape), t.dtype) for t in tensors]
+        works = []
+        for dtype, idx, numel in self.get_buckets(specs, bucket_size):
+            flat = torch.cat([tensors[i].detach().reshape(-1) for i in idx]) if len(idx) > 1 else tensors[idx[0]].detach().reshape(-1)
+            if dtype == torch.bool:
+                flat = flat.to(torch.uint8)
+            flat = flat.to(device)
+
+            new_works = [dist.isend(flat, to_rank) for to_rank in to_ranks]
+            for work in works:
+                work.wait()
+            works = new_works
+        for work in works:
+            work.wait()
+
+
+    def receive_tensors(self, specs, from_rank, device, bucket_size=STREAM_BUCKET_SIZE):
+        buckets = self.get_buckets(specs, bucket_size)
+
+        # all receives are posted up front, so the sender never waits for this rank
+        flats, works = [], []
+        for dtype, idx, numel in buckets:
+            flat = torch.empty(numel, dtype=torch.uint8 if dtype == torch.bool else dtype, device=device)
+            works.append(dist.irecv(flat, from_rank))
+            flats.append(flat)
+
+        tensors = [None for _ in specs]
+        for (dtype, idx, numel), flat, work in zip(buckets, flats, works):
+            work.wait()
+            if dtype == torch.bool:
+                flat = flat.to(torch.bool)
+            offset = 0
+            for i in idx:
+                shape = specs[i][0]
+                n = math.prod(shape)
+                tensors[i] = flat.narrow(0, offset, n).view(shape)
+                offset = offset + n
+        return tensors
+
+
+
+class AsyncSend:
+
+    def __init__(self, works, tensors):
+        self.works = works
+        self.tensors = tensors # keep alive until completed
+
+    def is_completed(self):
+        return all(w.is_completed() for w in self.works)
+
+    def wait(self):
+        for w in self.works:
+            w.wait()
+        self.works = []
+        self.tensors = None
+
+
+class AsyncRecv:
+
+    # A schema miss receives the new payloads synchronously in wait(), so the receives posted
+    # after it from the same peer would be matched against them: a receive is posted only once
+    # the previous one from its peer (and group) is waited for, or at once if there is none.
+
+    def __init__(self, comm, from_rank, device, key=None, slot=None, group=None):
+        self.comm = comm
+        self.from_rank = from_rank
+        self.device = device
+        self.slot = slot
+        self.group = group
+        self.ck = None if key is None else (from_rank, key)
+
+        self.done = False
+        self.result = None
+        self.prev = None
+        self.next = None
+        self.header_work = None
+        self.works = []
+
+        prev = comm.last_irecv.get((from_rank, group))
+        comm.last_irecv[(from_rank, group)] = self
+        if prev is not None and prev.done == False:
+            self.prev = prev
+            prev.next = self
+        else:
+            self.post()
+
+    def post(self):
+        self.prev = None
+        self.packed = torch.empty(HEADER_CAPACITY, dtype=torch.long, device=self.device)
+        self.header_work = dist.irecv(self.packed, self.from_rank, group=self.group)
+
+        # read when posted: the previous receive on the key is complete by now
+        self.cached = None if self.ck is None else self.comm.recv_schema.get(self.ck)
+        if self.cached is not None and self.ck not in self.comm.recv_varying:
+            self.obj, tensors = self.comm.build_recv_obj(self.cached, self.device, self.ck, self.slot)
+            self.works = [dist.irecv(t, self.from_rank, group=self.group) for t in tensors]
+
+    # True once wait() would not block on the sender (a schema miss still receives synchronously)
+    def is_completed(self):
+        if self.done == True:
+            return True
+        return self.header_work is not None and self.header_work.is_completed() and all(w.is_completed() for w in self.works)
+
+    def wait(self):
+        if self.done == True:
+            return self.result
+        if self.header_work is None:
+            self.prev.wait() # posts this receive
+
+        self.result = self.receive()
+        self.done = True
+
+        if self.comm.last_irecv.get((self.from_rank, self.group)) is self:
+            del self.comm.last_irecv[(self.from_rank, self.group)]
+        if self.next is not None:
+            self.next.post()
+            self.next = None
+
+        return self.result
+
+    def receive(self):
+        self.header_work.wait()
+        header = self.packed.tolist()
+
+        for w in self.works: # payloads, or dummies if the schema changed
+            w.wait()
+
+        if self.cached is not None and header[0] == ASYNC_SCHEMA_HIT:
+            if len(self.works) > 0:
+                return self.obj
+            header = self.cached # varying key: payloads not posted in advance
+        else:
+            header = self.comm.complete_header(header, self.from_rank, self.device, self.group)
+            if self.ck is not None:
+                if self.cached is not None:
+                    self.comm.recv_varying.add(self.ck)
+                self.comm.recv_schema[self.ck] = header
+                self.comm.recv_buffers[self.ck] = {}
+
+        obj, tensors = self.comm.build_recv_obj(header, self.device, self.ck, self.slot)
+
+        for t in tensors:
+            dist.recv(t, self.from_rank, group=self.group)
+
+        return obj
@@ -0,0 +1,170 @@
+#
+# Copyright (c) 2024-present, ETRI, All rights reserved.
+#
+
+import torch
+from torch.utils.data import DataLoader
+
+
+#
+# Input pipeline of Optimus_p (for data, labels in MicroBatchLoader(optimus_p, ...))
+#
+#   On the ranks of the first stage, DataLoader workers tokenize and collate the batches
+#   (collate_fn, e.g. TokenizeCollate) ahead of the training loop, into pinned memory on GPU.
+#   The next batch is copied to the device on a side CUDA stream while the current step runs;
+#   the compute stream waits for that copy only when the batch is handed out.
+#
+#   The labels of every step are shipped to the last stage without blocking
+#   (Optimus_p.ship_labels): the last stage does not wait for them before the loss of its first
+#   micro-batch, so the first stage no longer holds the pipeline between the steps.
+#
+#   The other ranks do not read the dataset; they yield (None, None) len(loader) times.
+#
+#   PackCollate packs variable-length samples instead of padding the whole batch to its longest
+#   sample: the samples are sorted by length and cut into mbsize micro-batches of about the same
+#   number of tokens, each right-padded to its own longest sample only (labels: ignore_index).
+#   The micro-batches are given to Optimus_p as lists, and may differ in rows and length.
+#
+
+class TokenizeCollate:
+
+    def __init__(self, tokenizer, max_length=1024, padding=True, truncation=True):
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.padding = padding
+        self.truncation = truncation
+
+    # (input_ids, labels) of a batch of texts, for causal LM
+    def __call__(self, batch):
+        tokens = self.tokenizer(batch, padding=self.padding, truncation=self.truncation, max_length=self.max_length, return_tensors="pt")
+        return tokens.input_ids, tokens.input_ids
+
+
+# [ [sample index, ], ] mbsize runs of the samples sorted by length, of about the same padded
+#   size (rows x longest sample): the smallest cap on the padded size that greedy runs fit
+#   in mbsize micro-batches (bisection); every micro-batch gets at least one sample
+def bin_by_tokens(lengths, mbsize):
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    assert len(order) >= mbsize, f"{len(order)} samples for {mbsize} micro-batches"
+
+    def greedy(cap):
+        bins = [[order[0]]]
+        for i in order[1:]:
+            # longest first: the padded size of a run is its rows x its first sample
+            if (len(bins[-1]) + 1) * lengths[bins[-1][0]] <= cap:
+                bins[-1].append(i)
+            else:
+                bins.append([i])
+        return bins
+
+    lo, hi = lengths[order[0]], lengths[order[0]] * len(order)
+    while lo < hi:
+        cap = (lo + hi) // 2
+        if len(greedy(cap)) <= mbsize:
+            hi = cap
+        else:
+            lo = cap + 1
+
+    bins = greedy(lo)
+    while len(bins) < mbsize: # split the run of most rows
+        k = max(range(len(bins)), key=lambda b: len(bins[b]))
+        half = len(bins[k]) // 2
+        bins[k:k + 1] = [bins[k][:half], bins[k][half:]]
+    return bins
+
+
+class PackCollate:
+
+    def __init__(self, tokenizer, mbsize, max_length=1024, ignore_index=-100):
+        self.tokenizer = tokenizer
+        self.mbsize = mbsize
+        self.max_length = max_length
+        self.ignore_index = ignore_index
+
+    # ([input_ids, ] * mbsize, [labels, ] * mbsize) of a batch of texts, for causal LM
+    def __call__(self, batch):
+        ids = self.tokenizer(batch, truncation=True, max_length=self.max_length)["input_ids"]
+
+        data, labels = [], []
+        for samples in bin_by_tokens([len(x) for x in ids], self.mbsize):
+            length = max(len(ids[i]) for i in samples)
+            input_ids = torch.full((len(samples), length), self.tokenizer.pad_token_id, dtype=torch.long)
+            target = torch.full((len(samples), length), self.ignore_index, dtype=torch.long)
+            for row, i in enumerate(samples):
+                input_ids[row, :len(ids[i])] = torch.tensor(ids[i], dtype=torch.long)
+                target[row, :len(ids[i])] = input_ids[row, :len(ids[i])]
+            data.append(input_ids)
+            labels.append(target)
+        return data, labels
+
+
+def map_tensors(obj, fn):
+    if isinstance(obj, torch.Tensor):
+        return fn(obj)
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(map_tensors(x, fn) for x in obj)
+    return obj
+
+
+class MicroBatchLoader:
+
+    def __init__(self, optimus, dataset, batch_size, collate_fn=None, num_workers=4, shuffle=False, drop_last=False, prefetch_factor=2):
+        self.optimus = optimus
+        self.is_reader = optimus.tpl.has_first_stage()
+
+        use_workers = self.is_reader and num_workers > 0
+        self.loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last,
+                                 collate_fn=collate_fn,
+                                 num_workers=num_workers if use_workers else 0,
+                                 prefetch_factor=prefetch_factor if use_workers else None,
+                                 persistent_workers=use_workers,
+                                 pin_memory=self.is_reader and optimus.use_gpu)
+
+        self.stream = None
+        if self.is_reader and optimus.use_gpu:
+            self.stream = torch.cuda.Stream(device=optimus.device)
+
+
+    def __len__(self):
+        return len(self.loader)
+
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+
+    # start copying the next (data, labels) to the device; None at the end
+    def preload(self, batches):
+        batch = next(batches, None)
+        if batch is None or self.stream is None:
+            return batch
+
+        with torch.cuda.stream(self.stream):
+            batch = map_tensors(batch, lambda t: t.to(self.optimus.device, non_blocking=True))
+        return batch
+
+
+    # the compute stream uses the batch after its copy; its memory belongs to the compute stream
+    def ready(self, batch):
+        if self.stream is not None:
+            torch.cuda.current_stream(self.optimus.device).wait_stream(self.stream)
+            map_tensors(batch, lambda t: t.record_stream(torch.cuda.current_stream(self.optimus.device)))
+        return batch
+
+
+    def __iter__(self):
+        if self.is_reader == False:
+            for _ in range(len(self.loader)):
+                self.optimus.ship_labels(None)
+                yield None, None
+            return
+
+        batches = iter(self.loader)
+        batch = self.preload(batches)
+        while batch is not None:
+            data, labels = self.ready(batch)
+            batch = self.preload(batches) # copied during this step
+
+            self.optimus.ship_labels(labels)
+            yield data, labels
@@ -0,0 +1,204 @@
+#
+# Copyright (c) 2024-present, ETRI, All rights reserved.
+#
+
+from contextlib import contextmanager
+
+import torch
+import torch.distributed as dist
+
+
+#
+# Bucketed data-parallel gradient reduction of a pipeline stage
+#
+#   Replaces DistributedDataParallel on the local stages (Optimus_p(..., dp_reducer="bucket")).
+#   The gradients of the micro-batches are accumulated locally; during the backward of the
+#   last micro-batch, a bucket of parameters is all-reduced (async) over the DP group as soon
+#   as all its gradients are accumulated, while the backward of the stage goes on and its
+#   gradient is sent upstream. finish() waits for the reductions before the optimizer step.
+#
+#   - parameters are bucketed in reverse order of registration (about the order of backward)
+#     and buckets are launched in order, so all replicas issue the same collectives
+#   - no search for unused parameters: the buckets not complete at the end of the backward
+#     are launched then, with a zero gradient for the parameters that have none
+#   - p.grad is a view of the flat buffer of its bucket: no copy while it stays bound
+#   - reduce_scatter=True: each rank only gets its 1/dp_size shard of every bucket (ZeRO),
+#     the rest of the buffer is not reduced
+#
+
+# views of flat with the shapes of params, in order
+def split_flat(flat, params):
+    views = []
+    offset = 0
+    for p in params:
+        views.append(flat[offset:offset + p.numel()].view(p.shape))
+        offset = offset + p.numel()
+    return views
+
+
+class GradBucket:
+
+    def __init__(self, params, device, dtype, dp_size):
+        self.params = params
+        self.device = device
+        self.dtype = dtype
+        numel = sum(p.numel() for p in params)
+        self.shard_size = (numel + dp_size - 1) // dp_size
+        self.dp_size = dp_size
+        self.allocate()
+
+        self.ready = [False for _ in params]
+        self.num_ready = 0
+        self.work = None
+
+
+    def allocate(self):
+        self.buffer = torch.zeros(self.shard_size * self.dp_size, dtype=self.dtype, device=self.device)
+        self.views = split_flat(self.buffer, self.params)
+
+
+    # ZeRO-2: no gradient memory until the next backward
+    def release(self):
+        for p in self.params:
+            p.grad = None
+        self.buffer = None
+        self.views = None
+
+
+    def shard(self, dp_rank):
+        return self.buffer[dp_rank * self.shard_size:(dp_rank + 1) * self.shard_size]
+
+
+class DPReducer:
+
+    def __init__(self, module, process_group, bucket_cap_mb=25, reduce_scatter=False):
+        self.process_group = process_group
+        self.dp_size = dist.get_world_size(process_group)
+        self.dp_rank = dist.get_rank(process_group)
+        self.reduce_scatter = reduce_scatter
+
+        # same initial state on every replica (as DDP)
+        src = dist.get_global_rank(process_group, 0)
+        with torch.no_grad():
+            for t in list(module.parameters()) + list(module.buffers()):
+                dist.broadcast(t, src, group=process_group)
+
+        params = [p for p in module.parameters() if p.requires_grad]
+        cap = bucket_cap_mb * 1024 * 1024
+
+        self.buckets = []
+        self.bucket_of = {}  # { param : (bucket index, index in bucket) }
+        pending = {}  # { (device, dtype) : ([params], bytes) }
+        for p in reversed(params):
+            key = (p.device, p.dtype)
+            group, size = pending.get(key, ([], 0))
+            group.append(p)
+            size = size + p.numel() * p.element_size()
+            if size >= cap:
+                self.add_bucket(group, *key)
+                group, size = [], 0
+            pending[key] = (group, size)
+        for key, (group, _) in pending.items():
+            if len(group) > 0:
+                self.add_bucket(group, *key)
+
+        for p in params:
+            p.register_post_accumulate_grad_hook(self.grad_ready)
+
+        self.require_sync = False
+        self.next_bucket = 0
+
+
+    def add_bucket(self, params, device, dtype):
+        for i, p in enumerate(params):
+            self.bucket_of[p] = (len(self.buckets), i)
+        self.buckets.append(GradBucket(params, device, dtype, self.dp_size))
+
+
+    # backward of the micro-batches under sync(True) reduces the gradients
+    @contextmanager
+    def sync(self, enabled=True):
+        self.require_sync = enabled
+        try:
+            yield
+        finally:
+            self.require_sync = False
+            if enabled:
+                self.launch_remaining()
+
+
+    def bind_grad(self, p, view):
+        if p.grad is view or p.grad.data_ptr() == view.data_ptr():
+            return
+        with torch.no_grad():
+            view.copy_(p.grad)
+        if p.device == view.device: # not bound while the model is swapped out
+            p.grad = view
+
+
+    # post-accumulate-grad hook of every parameter
+    def grad_ready(self, p):
+        b, i = self.bucket_of[p]
+        bucket = self.buckets[b]
+        if bucket.buffer is None:
+            bucket.allocate()
+        self.bind_grad(p, bucket.views[i])
+
+        if self.require_sync == False:
+            return
+
+        assert bucket.work is None, f"gradient accumulated after its bucket was reduced: {tuple(p.shape)}"
+        if bucket.ready[i] == False:
+            bucket.ready[i] = True
+            bucket.num_ready = bucket.num_ready + 1
+
+        while self.next_bucket < len(self.buckets) and self.buckets[self.next_bucket].num_ready == len(self.buckets[self.next_bucket].params):
+            self.launch(self.buckets[self.next_bucket])
+            self.next_bucket = self.next_bucket + 1
+
+
+    def launch(self, bucket):
+        bucket.buffer.div_(self.dp_size)
+        if self.reduce_scatter:
+            bucket.work = dist.reduce_scatter_tensor(bucket.shard(self.dp_rank), bucket.buffer, group=self.process_group, async_op=True)
+        else:
+            bucket.work = dist.all_reduce(bucket.buffer, group=self.process_group, async_op=True)
+
+
+    # end of the last backward: parameters without gradient count as zero
+    def launch_remaining(self):
+        for bucket in self.buckets[self.next_bucket:]:
+            if bucket.buffer is None:
+                bucket.allocate()
+            for i, p in enumerate(bucket.params):
+                if p.grad is None:
+                    bucket.views[i].zero_()
+                    if p.device == bucket.views[i].device:
+                        p.grad = bucket.views[i]
+                else:
+                    self.bind_grad(p, bucket.views[i])
+            self.launch(bucket)
+        self.next_bucket = len(self.buckets)
+
+
+    # wait for the reductions; gradients not bound to their bucket get the reduced values
+    def finish(self):
+        for bucket in self.buckets:
+            if bucket.work is None:
+                continue
+            bucket.work.wait()
+            bucket.work = None
+
+            for i, p in enumerate(bucket.params):
+                if p.grad is not None and p.grad.data_ptr() != bucket.views[i].data_ptr():
+                    with torch.no_grad():
+                        p.grad.copy_(bucket.views[i])
+
+            bucket.ready = [False for _ in bucket.params]
+            bucket.num_ready = 0
+        self.next_bucket = 0
+
+
+    # ZeRO: [ (bucket, reduced gradient shard of this rank), ] after finish()
+    def grad_shards(self):
+        return [(bucket, bucket.shard(self.dp_rank)) for bucket in self.buckets]
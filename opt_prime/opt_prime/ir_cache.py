@@ -0,0 +1,200 @@
+#
+# Copyright (c) 2024-present, ETRI, All rights reserved.
+#
+
+import os
+import sys
+import copy
+import json
+import shutil
+import hashlib
+
+import torch
+import torch.nn as nn
+
+from torch.fx.graph_module import GraphModule
+
+
+IR_CACHE_VERSION = 1
+
+
+#
+# On-disk cache of the split plan of Optimus_p
+#
+#   <cache_dir>/<key>/plan.pt       : metadata_range, special_nodes, getitem_dic, model_type, top-level graph
+#   <cache_dir>/<key>/stage_<k>.pt  : submod_<k> without parameters/buffers of the model,
+#                                     and where each of them comes from in the model
+#
+#   key: hash of the model config and parameter shapes, world size, pp/dp size, num_chunks, mbsize
+#        and split options. Parameters are taken from the live model at load time, so a cached
+#        plan stays valid when the weights change.
+#
+class IRCache:
+
+    def __init__(self, cache_dir, module: nn.Module, **split_config):
+        self.cache_dir = cache_dir
+        self.key = self.get_key(module, split_config)
+        self.path = os.path.join(cache_dir, self.key)
+
+
+    def get_key(self, module, split_config):
+        if hasattr(module, "config") and hasattr(module.config, "to_json_string"):
+            model_config = module.config.to_json_string()
+        else:
+            model_config = str(module)
+
+        param_shapes = [(name, tuple(t.shape), str(t.dtype)) for name, t in module.state_dict(keep_vars=True).items()]
+
+        key_src = json.dumps({
+            "version": IR_CACHE_VERSION,
+            "torch": torch.__version__,
+            "model": type(module).__name__,
+            "config": model_config,
+            "params": param_shapes,
+            "split": {k: str(v) for k, v in sorted(split_config.items())},
+        }, sort_keys=True)
+
+        return hashlib.sha256(key_src.encode()).hexdigest()[:32]
+
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.path, "plan.pt"))
+
+
+    # save the split plan of ir (call before IR.clean_module_memory)
+    def save(self, ir, module, model_type, getitem_dic):
+        top = ir.model_ir[0]
+
+        # tensor --> name in the model
+        model_tensors = {}
+        for name, t in module.named_parameters(remove_duplicate=False):
+            model_tensors.setdefault(id(t), name)
+        for name, t in module.named_buffers(remove_duplicate=False):
+            model_tensors.setdefault(id(t), name)
+
+        tmp_path = f"{self.path}.tmp{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+
+        for stage in range(ir.optimus.tpl.num_stage):
+            name = f"submod_{stage}"
+            submod = top.get_submodule(name)
+
+            # model tensors become meta tensors in the saved copy; others (e.g. traced constants) are kept
+            root, graph, tensors = strip_submod(submod, lambda t: id(t) in model_tensors)
+
+            tensor_map = []  # [ (name in submod, name in model, is_param), ]
+            for snames, is_param, t in tensors:
+                for sname in snames:
+                    tensor_map.append((sname, model_tensors[id(t)], is_param))
+
+            obj = {"name": name, "root": root, "graph": graph, "tensor_map": tensor_map}
+            torch.save(obj, os.path.join(tmp_path, f"stage_{stage}.pt"))
+
+        plan = {
+            "metadata_range": ir.metadata_range,
+            "special_nodes": ir.special_nodes,
+            "getitem_dic": getitem_dic,
+            "model_type": model_type,
+            "graph": copy.deepcopy(top.graph), # only node names/args are used at run time
+        }
+        torch.save(plan, os.path.join(tmp_path, "plan.pt"))
+
+        # publish the whole directory at once; a concurrent writer of the same plan may have won
+        try:
+            os.rename(tmp_path, self.path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+        print(f" ### IR cache saved: {self.path}")
+
+
+    def load_plan(self):
+        plan = torch.load(os.path.join(self.path, "plan.pt"), map_location="cpu", weights_only=False)
+        print(f" ### IR cache loaded: {self.path}")
+        return plan
+
+
+    # submod_<stage> with the parameters/buffers of module --> (name, submod, node)
+    def load_stage(self, stage, module, plan):
+        obj = torch.load(os.path.join(self.path, f"stage_{stage}.pt"), map_location="cpu", weights_only=False)
+
+        params = dict(module.named_parameters(remove_duplicate=False))
+        buffers = dict(module.named_buffers(remove_duplicate=False))
+
+        tensors = [([sname], is_param, params[mname] if is_param else buffers[mname]) for sname, mname, is_param in obj["tensor_map"]]
+        name, submod = obj["name"], rebuild_submod(obj["root"], obj["graph"], tensors)
+
+        node = None
+        for n in plan["graph"].nodes:
+            if n.name == name:
+                node = n
+                break
+
+        if node is None:
+            print(f"ERROR: Not found node({name}) in IR cache")
+            sys.exit(1)
+
+        return name, submod, node
+
+
+    def get_output_node(self, plan):
+        for n in reversed(plan["graph"].nodes):
+            if n.op == 'output':
+                return n
+
+
+
+# GraphModule --> (root, graph, tensors) with the parameters/buffers passing tensor_filter
+#   replaced by meta tensors in root
+#   tensors: [ ([names in submod], is_param, tensor), ] one entry per distinct tensor
+#   A pickled GraphModule is re-traced from its code when loaded, which fails on HF-traced
+#   code; root (a plain nn.Module) and graph are pickled instead and rebuilt by rebuild_submod.
+def strip_submod(submod: GraphModule, tensor_filter=None):
+    memo = {}
+    tensors = {}  # { id(tensor) : ([names], is_param, tensor) }
+    for mname, mod in submod.named_modules(remove_duplicate=False):
+        prefix = f"{mname}." if mname else ""
+        for is_param, attrs in ((True, mod._parameters), (False, mod._buffers)):
+            for attr, t in attrs.items():
+                if t is None or (tensor_filter is not None and not tensor_filter(t)):
+                    continue
+                if id(t) not in tensors:
+                    tensors[id(t)] = ([], is_param, t)
+                    if is_param:
+                        memo[id(t)] = nn.Parameter(torch.empty_like(t, device="meta"), requires_grad=t.requires_grad)
+                    else:
+                        memo[id(t)] = torch.empty_like(t, device="meta")
+                tensors[id(t)][0].append(f"{prefix}{attr}")
+
+    skeleton = copy.deepcopy(submod, memo)
+
+    root = nn.Module()
+    for n, m in skeleton.named_children():
+        root.add_module(n, m)
+    for n, p in skeleton._parameters.items():
+        root.register_parameter(n, p)
+    for n, b in skeleton._buffers.items():
+        root.register_buffer(n, b)
+    for n in skeleton.graph.nodes:
+        if n.op == 'get_attr':
+            atom = n.target.split('.')[0]
+            if not hasattr(root, atom):
+                setattr(root, atom, getattr(skeleton, atom))
+
+    return root, copy.deepcopy(skeleton.graph), list(tensors.values())
+
+
+# (root, graph) of strip_submod + tensors --> GraphModule
+def rebuild_submod(root, graph, tensors):
+    submod = GraphModule(root, graph)
+
+    for snames, is_param, t in tensors:
+        for sname in snames:
+            prefix, _, leaf = sname.rpartition(".")
+            owner = submod.get_submodule(prefix) if prefix else submod
+            if is_param:
+                owner._parameters[leaf] = t
+            else:
+                owner._buffers[leaf] = t
+
+    return submod
@@ -0,0 +1,186 @@
+#
+# Copyright (c) 2024-present, ETRI, All rights reserved.
+#
+
+import os
+import sys
+import json
+import contextlib
+from collections import defaultdict
+
+import torch
+import torch.nn as nn
+
+
+#
+# Lazy materialization of a model built on the meta device
+#
+#   The model is traced and split with meta parameters; each rank then allocates (and loads
+#   from a checkpoint, or initializes) only the tensors of its own stages.
+#
+
+
+# create parameters on the meta device and keep buffers on CPU
+#   buffers are small and often not saved in checkpoints (e.g. causal masks)
+@contextlib.contextmanager
+def init_empty_weights():
+    register_parameter = nn.Module.register_parameter
+
+    def register_meta_parameter(module, name, param):
+        register_parameter(module, name, param)
+        if param is not None and param.device.type != "meta":
+            kwargs = param.__dict__
+            module._parameters[name] = type(param)(param.to("meta"), requires_grad=param.requires_grad, **kwargs)
+
+    nn.Module.register_parameter = register_meta_parameter
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = register_parameter
+
+
+def has_meta_tensors(module: nn.Module):
+    for t in module.parameters():
+        if t.is_meta:
+            return True
+    for t in module.buffers():
+        if t.is_meta:
+            return True
+    return False
+
+
+# reads tensors by name from a checkpoint without loading all of it
+#   path: a state_dict file (.pt, .bin, .safetensors), or a directory with such files
+#         (with or without a HF *.index.json)
+class CheckpointReader:
+
+    def __init__(self, path, prefix=""):
+        self.path = path
+        self.prefix = prefix # e.g. HF base_model_prefix + ".", for checkpoints of the base model
+        self.files = {}  # { file : opened checkpoint }
+        self.weight_map = {}  # { tensor name : file }
+
+        if os.path.isdir(path):
+            index = [f for f in sorted(os.listdir(path)) if f.endswith(".index.json")]
+            if len(index) > 0:
+                with open(os.path.join(path, index[0])) as f:
+                    for name, file in json.load(f)["weight_map"].items():
+                        self.weight_map[name] = os.path.join(path, file)
+            else:
+                for file in sorted(os.listdir(path)):
+                    if file.endswith((".safetensors", ".bin", ".pt", ".pth")):
+                        for name in self.open(os.path.join(path, file)).keys():
+                            self.weight_map[name] = os.path.join(path, file)
+        else:
+            for name in self.open(path).keys():
+                self.weight_map[name] = path
+
+
+    def open(self, file):
+        if file not in self.files:
+            if file.endswith(".safetensors"):
+                try:
+                    from safetensors import safe_open
+                except ImportError:
+                    print(f"safetensors is needed to read {file}")
+                    sys.exit(1)
+                self.files[file] = safe_open(file, framework="pt", device="cpu")
+            else:
+                # mmap: only the tensors read are brought into memory
+                self.files[file] = torch.load(file, map_location="cpu", mmap=True, weights_only=True)
+        return self.files[file]
+
+
+    def find(self, name):
+        if name in self.weight_map:
+            return name
+        if self.prefix and name.startswith(self.prefix) and name[len(self.prefix):] in self.weight_map:
+            return name[len(self.prefix):]
+        return None
+
+
+    def get(self, name):
+        key = self.find(name)
+        if key is None:
+            return None
+        ckpt = self.open(self.weight_map[key])
+        if isinstance(ckpt, dict):
+            return ckpt[key]
+        return ckpt.get_tensor(key)
+
+
+
+# allocate the meta tensors of submod on device, shared (tied) tensors once
+#   names: { id(tensor) : name in model }, to look up reader
+#   init_fn(module): initializes the tensors of module not found in the checkpoint
+#   root: the model, to find the module a moved tensor belongs to for init_fn
+def materialize_module(submod: nn.Module, device, names, reader=None, init_fn=None, root=None):
+    owners = defaultdict(list)  # { id(tensor) : [ (module, attr, is_param), ] }
+    tensors = {}
+    for mod in submod.modules():
+        for attr, t in mod._parameters.items():
+            if t is not None and t.is_meta:
+                owners[id(t)].append((mod, attr, True))
+                tensors[id(t)] = t
+        for attr, t in mod._buffers.items():
+            if t is not None and t.is_meta:
+                owners[id(t)].append((mod, attr, False))
+                tensors[id(t)] = t
+
+    loaded = []
+    uninitialized = []
+    for key, t in tensors.items():
+        new = torch.zeros_like(t, device=device) # left as zeros if init_fn skips it
+
+        value = reader.get(names[key]) if reader is not None and key in names else None
+        if value is not None:
+            assert value.shape == t.shape, f"{names[key]}: checkpoint shape {tuple(value.shape)} != {tuple(t.shape)}"
+            with torch.no_grad():
+                new.copy_(value)
+            loaded.append(key)
+        else:
+            uninitialized.append(key)
+
+        # tied tensors stay tied
+        if owners[key][0][2] == True:
+            new = nn.Parameter(new, requires_grad=t.requires_grad)
+        for mod, attr, is_param in owners[key]:
+            if is_param:
+                mod._parameters[attr] = new
+            else:
+                mod._buffers[attr] = new
+
+    for key in uninitialized:
+        if owners[key][0][2] == False:
+            # buffers (e.g. causal masks) are computed at construction, not by init_fn
+            print(f"ERROR: meta buffer {names.get(key, '?')} not in the checkpoint; build the model with init_empty_weights() to keep buffers")
+            sys.exit(1)
+
+    if len(uninitialized) > 0:
+        if init_fn is None:
+            print(f"ERROR: {len(uninitialized)} meta tensors not in the checkpoint, e.g. {names.get(uninitialized[0], '?')}")
+            sys.exit(1)
+
+        # initialize through the module owning the tensor in the model (submod may hold
+        #   it under another name, e.g. moved_* of IR.split_by_metadata_range)
+        init_modules = []
+        for key in uninitialized:
+            mod, attr, is_param = owners[key][0]
+            if root is not None and key in names:
+                prefix, _, attr = names[key].rpartition(".")
+                mod = root.get_submodule(prefix) if prefix else root
+                mod._parameters[attr] = owners[key][0][0]._parameters[owners[key][0][1]]
+            if mod not in init_modules:
+                init_modules.append(mod)
+
+        with torch.no_grad():
+            for mod in init_modules:
+                init_fn(mod)
+
+            # init_fn may have overwritten tensors of these modules that were loaded
+            for key in loaded:
+                mod, attr, is_param = owners[key][0]
+                t = mod._parameters[attr] if is_param else mod._buffers[attr]
+                t.copy_(reader.get(names[key]))
+
+    return len(loaded), len(uninitialized)
@@ -0,0 +1,152 @@
+#
+# Copyright (c) 2024-present, ETRI, All rights reserved.
+#
+
+import torch
+
+
+#
+# Asynchronous offload of the optimizer states and of the model (swap_opt_in_fwdbwd,
+#   swap_model_in_optstep)
+#
+#   Tensors are copied on a dedicated CUDA stream, to/from pinned host buffers that are
+#   allocated once per tensor and reused by every swap. A device tensor swapped out is freed
+#   once its copy is done (record_stream); a tensor swapped in is used by the compute stream
+#   after its copy (wait_event), so the host never blocks, except before the optimizer step
+#   on CPU of swap_model_in_optstep (synchronize()).
+#
+#   Scalar states (e.g. the step of Adam) stay where the optimizer keeps them.
+#
+#   prefetch_optimizer() starts loading the optimizer states back, e.g. during the backward of
+#   the last micro-batch; load_optimizer() then only orders the compute stream after it.
+#
+
+class OffloadEngine:
+
+    def __init__(self, device):
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+        self.host_buffers = {}  # { key : pinned host tensor }
+
+        self.optimizer_event = None  # optimizer states loading
+        self.model_event = None  # model loading
+
+
+    def host_buffer(self, key, t):
+        buf = self.host_buffers.get(key)
+        if buf is None or buf.shape != t.shape or buf.dtype != t.dtype:
+            buf = torch.empty(t.shape, dtype=t.dtype, pin_memory=True)
+            self.host_buffers[key] = buf
+        return buf
+
+
+    # copies on self.stream start after the work queued so far on the compute stream
+    def begin(self):
+        self.stream.wait_stream(torch.cuda.current_stream(self.device))
+
+
+    def to_host(self, key, t):
+        buf = self.host_buffer(key, t)
+        with torch.cuda.stream(self.stream):
+            buf.copy_(t, non_blocking=True)
+        t.record_stream(self.stream) # freed when the copy is done
+        return buf
+
+
+    def to_device(self, t):
+        dev = torch.empty(t.shape, dtype=t.dtype, device=self.device)
+        with torch.cuda.stream(self.stream):
+            dev.copy_(t, non_blocking=True)
+        dev.record_stream(self.stream)
+        return dev
+
+
+    def record(self):
+        event = torch.cuda.Event()
+        event.record(self.stream)
+        return event
+
+
+    def offload_optimizer(self, optimizer):
+        self.begin()
+        for param, state in optimizer.state.items():
+            for k, v in state.items():
+                if isinstance(v, torch.Tensor) and v.device.type == "cuda" and v.dim() > 0:
+                    state[k] = self.to_host(("optimizer", id(param), k), v)
+
+
+    def prefetch_optimizer(self, optimizer):
+        if self.optimizer_event is not None:
+            return
+        self.begin()
+        for state in optimizer.state.values():
+            for k, v in state.items():
+                if isinstance(v, torch.Tensor) and v.device.type == "cpu" and v.dim() > 0:
+                    state[k] = self.to_device(v)
+        self.optimizer_event = self.record()
+
+
+    # the states stay offloaded (e.g. the optimizer step runs on CPU): back to the host buffers,
+    #   which still hold them
+    def cancel_prefetch(self, optimizer):
+        if self.optimizer_event is None:
+            return
+        for param, state in optimizer.state.items():
+            for k, v in state.items():
+                key = ("optimizer", id(param), k)
+                if isinstance(v, torch.Tensor) and v.device.type == "cuda" and v.dim() > 0:
+                    state[k] = self.host_buffers[key] if key in self.host_buffers else self.to_host(key, v)
+        self.optimizer_event = None
+
+
+    def load_optimizer(self, optimizer):
+        self.prefetch_optimizer(optimizer)
+        torch.cuda.current_stream(self.device).wait_event(self.optimizer_event)
+        self.optimizer_event = None
+
+
+    # parameters, their gradients and buffers of the submodules
+    def module_tensors(self, submods):
+        for c, submod in enumerate(submods):
+            for mod_name, mod in submod.named_modules():
+                for name, p in mod._parameters.items():
+                    if p is not None:
+                        yield (c, mod_name, name), mod, p
+                for name, b in mod._buffers.items():
+                    if b is not None:
+                        yield (c, mod_name, name), mod, b
+
+
+    def offload_model(self, submods):
+        self.begin()
+        for key, mod, t in self.module_tensors(submods):
+            if t.device.type != "cuda":
+                continue
+            if isinstance(t, torch.nn.Parameter):
+                grad = t.grad
+                t.data = self.to_host(("model",) + key, t.data)
+                if grad is not None:
+                    t.grad = self.to_host(("grad",) + key, grad)
+            else:
+                mod._buffers[key[2]] = self.to_host(("model",) + key, t)
+
+
+    def load_model(self, submods):
+        self.begin()
+        for key, mod, t in self.module_tensors(submods):
+            if t.device.type != "cpu":
+                continue
+            if isinstance(t, torch.nn.Parameter):
+                grad = t.grad
+                t.data = self.to_device(t.data)
+                if grad is not None:
+                    t.grad = self.to_device(grad)
+            else:
+                mod._buffers[key[2]] = self.to_device(t)
+        self.model_event = self.record()
+        torch.cuda.current_stream(self.device).wait_event(self.model_event)
+
+
+    # host tensors written by the copies are ready for use on CPU
+    def synchronize(self):
+        self.stream.synchronize()
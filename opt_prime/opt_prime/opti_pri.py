@@ -8,10 +8,21 @@ import torch.nn as nn
 
 from torch.nn.parallel import DistributedDataParallel
 
-from opt_prime.comm import Comm
+from opt_prime.comm import Comm, AsyncRecv
 from opt_prime.IR import IR, IR_Anal
+from opt_prime.ir_cache import IRCache, strip_submod, rebuild_submod
+from opt_prime.lazy_init import CheckpointReader, has_meta_tensors, materialize_module
+from opt_prime.trace import StepTracer
+from opt_prime.dp_reducer import DPReducer
+from opt_prime.zero import ZeroOptimizer
+from opt_prime.offload import OffloadEngine
+from opt_prime.recompute import Recompute, RECOMPUTE_POLICY
 from opt_prime.schedule import ScheduleGPipe 
 from opt_prime.schedule import Schedule1F1B 
+from opt_prime.schedule import ScheduleGPipeAsync
+from opt_prime.schedule import Schedule1F1BAsync
+from opt_prime.schedule import ScheduleInterleaved1F1B
+from opt_prime.schedule import ScheduleZeroBubble
 
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
@@ -19,6 +30,9 @@ from torch.fx.graph_module import GraphModule
 
 import psutil
 import os
+import copy
+import itertools
+import math
 
 
 #logging.basicConfig(level=logging.DEBUG)
@@ -28,18 +42,23 @@ logging.basicConfig(level=logging.ERROR)
 SCHEDULE = {
     "gpipe": ScheduleGPipe,
     "1f1b": Schedule1F1B, 
+    "gpipe_async": ScheduleGPipeAsync,
+    "1f1b_async": Schedule1F1BAsync,
+    "interleaved_1f1b": ScheduleInterleaved1F1B,
+    "zb_h1": ScheduleZeroBubble,
     }
 
 
 
 class Topology:
 
-    def __init__(self, rank, local_rank, world_size, pp_size, dp_size):
+    def __init__(self, rank, local_rank, world_size, pp_size, dp_size, num_chunks=1):
         self.rank = rank
         self.local_rank = local_rank
         self.world_size = world_size
         self.pp_size = pp_size
         self.dp_size = dp_size
+        self.num_chunks = num_chunks # virtual stages per rank
 
         #
         self.stage2rank = {}
@@ -51,8 +70,11 @@ class Topology:
 
 
     def set_stage2rank(self):
-        for i in range(self.pp_size):
-            self.stage2rank[i] = [i*self.dp_size + j for j in range(self.dp_size)]
+        # with num_chunks > 1, stage i is placed on pipeline rank (i % pp_size), 
+        #   e.g. pp_size:4, num_chunks:2 --> pipeline rank 0 holds stage 0 and 4
+        for i in range(self.pp_size * self.num_chunks):
+            p = i % self.pp_size
+            self.stage2rank[i] = [p*self.dp_size + j for j in range(self.dp_size)]
 
     def get_rank2stage(self, rank):
         for stage, ranks in self.stage2rank.items():
@@ -60,6 +82,9 @@ class Topology:
                 return stage
         return None
 
+    def get_rank2stages(self, rank):
+        return [stage for stage, ranks in self.stage2rank.items() if rank in ranks]
+
     def set_stage(self):
         ## PP only
         ##if self.dp_size == 1: 
@@ -71,6 +96,23 @@ class Topology:
         # PP + DP: using data structure
         self.stage = self.get_rank2stage(self.rank)
 
+        # local stages (one per chunk); self.stage follows the current chunk
+        self.stages = self.get_rank2stages(self.rank)
+        self.chunk = 0
+
+    def set_chunk(self, chunk):
+        if chunk == self.chunk:
+            return
+        self.chunk = chunk
+        self.stage = self.stages[chunk]
+        self.setup_rank_topology()
+
+    def has_first_stage(self):
+        return self.get_first_stage() in self.stages
+
+    def has_last_stage(self):
+        return self.get_last_stage() in self.stages
+
     def get_stage(self):
         return self.stage
 
@@ -134,7 +176,7 @@ class Topology:
 
 
     def setup_rank_topology(self):
-        stage = self.get_rank2stage(self.rank)
+        stage = self.stage
         tlist = self.stage2rank[stage]
         index = tlist.index(self.rank)
 
@@ -200,6 +242,14 @@ class Run_Info:
         self.node = None
         self.submod = None
 
+        self.chunks: List[Tuple[str, Any, Any]] = []  # [ (name, submod, node), ] per local stage
+        self.chunk_env: Dict[int, Tuple[Any, ...]] = {} # { chunk : (env, flat_args, env_recv_mark, env_send_mark) }
+        self.chunk = 0
+        self.mbsize = mbsize
+
+        self.reducers: List[Any] = []  # DPReducer per local stage (dp_reducer="bucket")
+        self.reducer = None
+
         self.output_node = None
         self.env: List[Dict[str, Any]] = [{} for _ in range(mbsize)]
         self.env_recv_mark: List[Dict[str, Any]] = [{} for _ in range(mbsize)]
@@ -219,6 +269,8 @@ class Run_Info:
 
         self.state_dict_cpu = {}
 
+        self.device_buffers: Dict[Tuple[str, int], torch.Tensor] = {}  # { (key, mb_idx) : flat device buffer } for to_device
+
         self.num_classes = num_classes
 
 
@@ -288,10 +340,51 @@ class Run_Info:
         print(f" ===============================")
 
 
+    def set_chunk(self, chunk):
+        self.name, self.submod, self.node = self.chunks[chunk]
+        if len(self.reducers) > 0:
+            self.reducer = self.reducers[chunk]
+
+        # each local stage keeps its own env, flat_args and forward send/recv marks, 
+        # since a node relayed through the pipeline may pass several local stages of this rank
+        if len(self.chunks) > 1:
+            self.chunk_env[self.chunk] = (self.env, self.flat_args, self.env_recv_mark, self.env_send_mark)
+            if chunk not in self.chunk_env:
+                self.chunk_env[chunk] = tuple([{} for _ in range(self.mbsize)] for _ in range(4))
+            self.env, self.flat_args, self.env_recv_mark, self.env_send_mark = self.chunk_env[chunk]
+
+        self.chunk = chunk
+
+    def get_submods(self):
+        return [submod for _, submod, _ in self.chunks]
+
+
+    # drop the per-step state in place (force_free_mem); the containers are reused by the next step
     def clean_run_info(self, mbsize):
-        self.env = [{} for _ in range(mbsize)]
-        self.flat_args = [{} for _ in range(mbsize)]
-        self.grads = [{} for _ in range(mbsize)]
+        envs = [(self.env, self.flat_args)] + [(env, flat_args) for env, flat_args, _, _ in self.chunk_env.values()]
+        for env, flat_args in envs:
+            for mb_idx in range(mbsize):
+                env[mb_idx].clear()
+                flat_args[mb_idx].clear()
+        for mb_idx in range(mbsize):
+            self.grads[mb_idx].clear()
+
+
+    # copy t into the reusable device buffer of (key, mb_idx) and return it
+    #   A buffer grows to the largest tensor seen, so variable shapes (e.g. sequence lengths)
+    #   do not reallocate after the first steps. The previous value of the slot must be dead.
+    def to_device(self, t: torch.Tensor, key, mb_idx):
+        if t.device == self.device:
+            return t
+
+        buf = self.device_buffers.get((key, mb_idx))
+        if buf is None or buf.dtype != t.dtype or buf.numel() < t.numel():
+            buf = torch.empty(t.numel(), dtype=t.dtype, device=self.device)
+            self.device_buffers[(key, mb_idx)] = buf
+
+        out = buf[:t.numel()].view(t.shape)
+        out.copy_(t, non_blocking=True)
+        return out
 
 
 pid = os.getpid()
@@ -304,7 +397,7 @@ def print_cpu_memory_usage(str, print_flag = False):
 
 class Optimus_p:
 
-    def __init__(self, module:nn.Module, mbsize, use_gpu=False, dp_size=1, preserve_output=False, activation_ckpt=False, force_free_mem=False, display_mem=False, swap_opt_in_fwdbwd=False, swap_model_in_optstep=False, ir_analyze: IR_Anal = IR_Anal.PARALLEL, use_padding=True):
+    def __init__(self, module:nn.Module, mbsize, use_gpu=False, dp_size=1, preserve_output=False, activation_ckpt=False, force_free_mem=False, display_mem=False, swap_opt_in_fwdbwd=False, swap_model_in_optstep=False, ir_analyze: IR_Anal = IR_Anal.PARALLEL, use_padding=True, num_chunks=1, split_method="simple", sample_input=None, profile_split=False, mem_budget=None, mem_schedule="1f1b", ir_cache_dir=None, checkpoint=None, trace=False, dp_reducer="ddp", bucket_cap_mb=25, zero_stage=0, async_offload=True, recompute=None, recompute_budget=None):
 
         #self.model_ir = []
         self.mbsize = mbsize
@@ -317,6 +410,12 @@ class Optimus_p:
 
         self.activation_ckpt = activation_ckpt
 
+        # checkpointed regions inside the stages (see recompute.py)
+        if recompute is not None and recompute not in RECOMPUTE_POLICY:
+            print(f"Not supported recompute option: {recompute}, use one of {list(RECOMPUTE_POLICY.keys())}")
+            sys.exit(1)
+        self.recompute = Recompute(recompute, recompute_budget) if recompute is not None else None
+
         rank = self.comm.rank
         world_size = self.comm.world_size
         local_rank = self.comm.local_rank
@@ -332,15 +431,24 @@ class Optimus_p:
 
         pp_size = world_size // dp_size
 
+        if num_chunks < 1 or (num_chunks > 1 and (pp_size == 1 or ir_analyze == IR_Anal.SINGLE)):
+            print(f"Virtual stages(num_chunks option) need pp_size > 1 and are not supported with IR_Anal.SINGLE")
+            sys.exit(1)
+
+        self.num_chunks = num_chunks
+        self.ir_analyze = ir_analyze
+
         if rank == 0:
             print(f"> Pipeline Parallel Size: {pp_size}")  
             if dp_size > 1:
                 print(f"> Data Parallel Size: {dp_size}")
+            if num_chunks > 1:
+                print(f"> Virtual stages per rank: {num_chunks}")
 
             print(f">> ir_analyze: {ir_analyze}")
 
 
-        self.tpl = Topology(rank, local_rank, world_size, pp_size, dp_size)
+        self.tpl = Topology(rank, local_rank, world_size, pp_size, dp_size, num_chunks)
 
         if use_gpu == True:
             self.device = torch.device(f"cuda:{local_rank}")
@@ -349,6 +457,9 @@ class Optimus_p:
             self.device = torch.device("cpu")
             print(f">>> Using CPU ...")
 
+        # per-rank, per-micro-batch spans of every schedule phase (see export_trace)
+        self.tracer = StepTracer(rank, self.device) if trace == True else None
+
 
         # num_classes auto config
         self.ignore_index = -100
@@ -359,7 +470,61 @@ class Optimus_p:
 
         self.clean_module_memory = True
 
-        if ir_analyze == IR_Anal.SEQUENTIAL:
+        # model built on the meta device: trace/split on meta tensors, then materialize local stages only
+        self.meta_init = has_meta_tensors(module)
+        if self.meta_init == True:
+            if ir_analyze == IR_Anal.SINGLE:
+                print(f"A model on the meta device needs IR_Anal.PARALLEL or IR_Anal.SEQUENTIAL")
+                sys.exit(1)
+
+            self.meta_names = {}  # { id(tensor) : name in model }
+            for name, t in itertools.chain(module.named_parameters(remove_duplicate=False), module.named_buffers(remove_duplicate=False)):
+                self.meta_names.setdefault(id(t), name)
+
+            self.ckpt_reader = None
+            if checkpoint is not None:
+                prefix = getattr(module, "base_model_prefix", "")
+                self.ckpt_reader = CheckpointReader(checkpoint, prefix=f"{prefix}." if prefix else "")
+
+            self.meta_root = module
+            self.meta_init_fn = module._init_weights if hasattr(module, "_init_weights") else self.reset_module # HF: _init_weights
+
+            if rank == 0:
+                print(f"> Meta-device model, weights from: {checkpoint if checkpoint is not None else 'initialization'}")
+
+        elif checkpoint is not None and rank == 0:
+            print(f"> checkpoint option is used only for a model on the meta device, ignored")
+
+        if mem_schedule not in SCHEDULE:
+            print(f"Not supported schedule for mem_schedule option: {mem_schedule}")
+            sys.exit(1)
+
+        # memory-aware split: in-flight micro-batches per stage under the schedule to be run
+        in_flight = lambda stage: SCHEDULE[mem_schedule].num_in_flight(stage, self.tpl, self.mbsize)
+        self.stage_mem_budget = mem_budget / num_chunks if mem_budget is not None else None # split evenly over a rank's chunks
+
+        # cached split plan: every rank loads its own stages, no tracing/splitting
+        self.ir_cache = None
+        ir_cached = False
+        if ir_cache_dir is not None:
+            self.ir_cache = IRCache(ir_cache_dir, module, world_size=world_size, pp_size=pp_size, dp_size=dp_size, num_chunks=num_chunks, mbsize=self.mbsize, \
+                    split_method=split_method, sample_input=getattr(sample_input, "shape", sample_input), profile_split=profile_split, \
+                    mem_budget=mem_budget, mem_schedule=mem_schedule, activation_ckpt=activation_ckpt)
+            object_list = [self.ir_cache.exists()]
+            dist.broadcast_object_list(object_list, src=0, device=self.device) # same decision on all ranks
+            ir_cached = object_list[0]
+
+        if ir_cached == True:
+            plan = self.ir_cache.load_plan()
+            self.load_local_stages(rank, module, plan)
+            self.model_type = plan["model_type"]
+            self.run_info.output_node = self.ir_cache.get_output_node(plan)
+            self.run_info.special_nodes = plan["special_nodes"]
+            self.run_info.metadata_range = plan["metadata_range"]
+            self.run_info.getitem_dic = plan["getitem_dic"]
+            print(f"[rank:{rank}, local_rank:{local_rank}] IR CACHE LOADED ...")
+
+        elif ir_analyze == IR_Anal.SEQUENTIAL:
             print(f"SEQUENTIAL mode >> [rank:{rank}, local_world_size:{self.comm.local_world_size}]")
 
             for i in range(self.comm.local_world_size):
@@ -367,14 +532,11 @@ class Optimus_p:
                     self.ir = IR(module, self)
 
                     self.model_type = self.ir.retrieve_IR(module)
-                    self.ir.split_IR(module, "simple", num_stage=self.tpl.get_num_stage())
+                    self.ir.split_IR(module, split_method, num_stage=self.tpl.get_num_stage(), sample_input=sample_input, profile=profile_split, mem_budget=self.stage_mem_budget, in_flight=in_flight)
 
-                    self.ir.setup_submod(self.tpl.stage, rank) # setup name, submod, node
+                    self.setup_local_stages(rank) # setup name, submod, node
                     self.ir.build_getitem_dic()
 
-                    self.run_info.submod.to(self.run_info.device)
-                    print(f" ### Rank:{rank}, name:{self.run_info.node.name}, move {self.run_info.name} to {self.run_info.device}")
-
                     self.run_info.output_node = self.ir.get_output_node()
 
                     if rank == 0:
@@ -390,6 +552,9 @@ class Optimus_p:
                     self.run_info.metadata_range = self.ir.metadata_range
                     self.run_info.getitem_dic = self.run_info.getitem_dic
 
+                    if self.ir_cache is not None and rank == 0:
+                        self.ir_cache.save(self.ir, module, self.model_type, self.run_info.getitem_dic)
+
                     if self.clean_module_memory == True:
                         print_cpu_memory_usage(f"[Rank:{rank}] Before: clean_module_memory")
                         self.ir.clean_module_memory()
@@ -400,52 +565,25 @@ class Optimus_p:
                 dist.barrier()
 
 
-        if (ir_analyze == IR_Anal.SINGLE and rank == 0) or ir_analyze == IR_Anal.PARALLEL:
+        if ir_cached == False and ((ir_analyze == IR_Anal.SINGLE and rank == 0) or ir_analyze == IR_Anal.PARALLEL):
             # IR effective at #0 process when IR_Anal.SINGLE
 
             self.ir = IR(module, self)
             #self.model_ir.append(IR(module))
 
             self.model_type = self.ir.retrieve_IR(module)
-            self.ir.split_IR(module, "simple", num_stage=self.tpl.get_num_stage())
+            self.ir.split_IR(module, split_method, num_stage=self.tpl.get_num_stage(), sample_input=sample_input, profile=profile_split, mem_budget=self.stage_mem_budget, in_flight=in_flight)
 
-            self.ir.setup_submod(self.tpl.stage, rank) # setup name, submod, node
+            if ir_analyze == IR_Anal.PARALLEL:
+                self.setup_local_stages(rank) # setup name, submod, node
+            else:
+                self.ir.setup_submod(self.tpl.stage, rank) # setup name, submod, node
             self.ir.build_getitem_dic()
 
             if ir_analyze == IR_Anal.SINGLE and rank == 0:
-
-                to_name, to_submod, to_node = None, None, None
-
-                for stage in range(self.tpl.num_stage):
-                    #for n, m in self.ir.model_ir[0].named_children():
-                    #    if n == f"submod_{stage}" and isinstance(m, GraphModule):
-                    #        to_name = n
-                    #        to_submod = m
-                    #        break
-                    to_name = f"submod_{stage}"
-                    to_submod = self.ir.model_ir[0].get_submodule(to_name)
-
-                    for nd in self.ir.model_ir[0].graph.nodes:
-                        if nd.name == to_name:
-                            to_node = nd
-                            break
-
-                    object_list = [to_name, to_submod, to_node]
-
-                    for to_rank in self.tpl.stage2rank[stage]:
-
-                        if to_rank == 0:
-                            continue
-                        else:
-                            print(f"[Rank:0] >> Send IR partition to rank:{to_rank} ...")
-                            dist.broadcast_object_list(object_list, src=0, group=self.comm.ctrl_group[to_rank], device=self.run_info.device)
-                    to_name, to_submod, to_node = None, None, None
-                    object_list = []
+                self.ship_stages()
 
             elif ir_analyze == IR_Anal.PARALLEL:
-                self.run_info.submod.to(self.run_info.device)
-                print(f" ### Rank:{rank}, name:{self.run_info.node.name}, move {self.run_info.name} to {self.run_info.device}")
-
                 self.run_info.output_node = self.ir.get_output_node()
 
                 if rank == 0:
@@ -458,6 +596,9 @@ class Optimus_p:
                 self.run_info.metadata_range = self.ir.metadata_range
                 self.run_info.getitem_dic = self.run_info.getitem_dic
 
+                if self.ir_cache is not None and rank == 0:
+                    self.ir_cache.save(self.ir, module, self.model_type, self.run_info.getitem_dic)
+
                 if self.clean_module_memory == True:
                     print_cpu_memory_usage(f"[Rank:{rank}] Before: clean_module_memory")
                     self.ir.clean_module_memory()
@@ -466,43 +607,25 @@ class Optimus_p:
                 print(f"[rank:{rank}, local_rank:{local_rank}] PARALLEL MODE PROCESSING ...")
 
 
-        elif ir_analyze == IR_Anal.SINGLE and rank != 0:
-            object_list = [None, None, None]
-            dist.broadcast_object_list(object_list, src=0, group=self.comm.ctrl_group[rank], device=self.run_info.device)
-            self.run_info.name = object_list[0]
-            print(f"<< [Rank:{rank}, Stage:{self.tpl.stage}] <== Received {self.run_info.name} ...")
-            self.run_info.submod = object_list[1]
-            self.run_info.node = object_list[2]
+        elif ir_cached == False and ir_analyze == IR_Anal.SINGLE and rank != 0:
+            self.receive_stage(rank)
 
-        if ir_analyze == IR_Anal.SINGLE:
+        if ir_cached == False and ir_analyze == IR_Anal.SINGLE:
             self.run_info.submod.to(self.run_info.device)
             print(f" ### Rank:{rank}, name:{self.run_info.node.name}, move {self.run_info.name} to {self.run_info.device}")
 
             if rank == 0:
-                #self.run_info.output_node = self.ir.get_output_node()
-                object_list2 = [self.ir.get_output_node()]
-                for to_rank in self.tpl.stage2rank[self.tpl.get_last_stage()]:
-                    if to_rank == 0:
-                        continue
-                    dist.broadcast_object_list(object_list2, src=0, group=self.comm.ctrl_group[to_rank], device=self.run_info.device)
-                    print(f" [Rank:0] >>>> Send output node[:{self.run_info.output_node}] to rank:{to_rank} ...")
-                self.run_info.output_node = object_list2[0]
-                #print(f" >>>> Send output node to rank:{to_rank} ...")
-            elif rank in self.tpl.stage2rank[self.tpl.get_last_stage()]:
-                if rank != 0:
-                    object_list2 = [None]
-                    dist.broadcast_object_list(object_list2, src=0, group=self.comm.ctrl_group[rank], device=self.run_info.device)
-                    self.run_info.output_node = object_list2[0]
-                    print(f"[Rank:{rank}, Stage:{self.tpl.stage}] <<<< Received output node[{self.run_info.output_node}] ...")
-
-        if ir_analyze == IR_Anal.SINGLE:
-            if rank == 0:
+                self.run_info.output_node = self.ir.get_output_node()
+
                 self.ir.print_graph(rank)
                 self.run_info.print_getitem_dic()
 
                 for stage in reversed(range(1, self.tpl.get_num_stage())):
                     self.ir.cross_reference_analyze(stage, self.ir.model_ir[0].graph)
 
+                if self.ir_cache is not None:
+                    self.ir_cache.save(self.ir, module, self.model_type, self.run_info.getitem_dic)
+
                 if self.clean_module_memory == True:
                     print_cpu_memory_usage(f"[Rank:{rank}] Before: clean_module_memory")
                     self.ir.clean_module_memory()
@@ -520,6 +643,38 @@ class Optimus_p:
 
         self.display_mem = display_mem
 
+        if len(self.run_info.chunks) == 0: # IR_Anal.SINGLE
+            self.run_info.chunks.append((self.run_info.name, self.run_info.submod, self.run_info.node))
+
+        if dp_reducer not in ("ddp", "bucket"):
+            print(f"Not supported dp_reducer option: {dp_reducer}")
+            sys.exit(1)
+        if zero_stage not in (0, 1, 2):
+            print(f"Not supported zero_stage option: {zero_stage}")
+            sys.exit(1)
+        if zero_stage > 0 and dp_size == 1:
+            print(f"> zero_stage option needs dp_size > 1, ignored")
+            zero_stage = 0
+        if zero_stage > 0 and dp_reducer != "bucket":
+            if rank == 0:
+                print(f"> zero_stage:{zero_stage} uses dp_reducer=\"bucket\"")
+            dp_reducer = "bucket"
+        self.dp_reducer = dp_reducer
+        self.bucket_cap_mb = bucket_cap_mb
+        self.zero_stage = zero_stage
+        self.zero_optimizer = None
+
+        # process group of the first and last ranks of each pipeline, for ship_labels()
+        self.label_group = None
+        self.label_sends = []
+        self.pending_labels = None
+        if pp_size > 1:
+            for i in range(dp_size):
+                label_ranks = [self.tpl.stage2rank[0][i], self.tpl.stage2rank[self.tpl.get_last_stage()][i]]
+                group = dist.new_group(label_ranks)
+                if rank in label_ranks:
+                    self.label_group = group
+
         if dp_size > 1:
             self.prepare_dp_group()
 
@@ -527,7 +682,7 @@ class Optimus_p:
         #    self.ir.print_graph(rank)
         #    self.run_info.print_getitem_dic()
 
-        if ir_analyze == IR_Anal.SINGLE:
+        if ir_cached == False and ir_analyze == IR_Anal.SINGLE:
             if rank == 0:
                 #for stage in reversed(range(1, self.tpl.get_num_stage())):
                 #    self.ir.cross_reference_analyze(stage, self.ir.model_ir[0].graph)
@@ -564,22 +719,137 @@ class Optimus_p:
         self.optimizer = None  # TODO
         self.swap_opt_in_fwdbwd = swap_opt_in_fwdbwd 
         self.swap_model_in_optstep = swap_model_in_optstep 
+
+        # swaps through pinned host buffers on a copy stream, not blocking the schedule
+        self.offload_engine = None
+        if async_offload == True and use_gpu == True and (swap_opt_in_fwdbwd == True or swap_model_in_optstep == True):
+            self.offload_engine = OffloadEngine(self.device)
         self.use_padding = use_padding  # padding option
 
+    def setup_local_stages(self, rank):
+        for stage in self.tpl.stages:
+            self.run_info.name, self.run_info.submod, self.run_info.node = None, None, None
+            self.ir.setup_submod(stage, rank)
+
+            if self.meta_init == True:
+                self.materialize_submod(rank)
+            self.run_info.submod.to(self.run_info.device)
+            print(f" ### Rank:{rank}, name:{self.run_info.node.name}, move {self.run_info.name} to {self.run_info.device}")
+
+            self.run_info.chunks.append((self.run_info.name, self.run_info.submod, self.run_info.node))
+
+        self.set_chunk(0)
+
+
+    def load_local_stages(self, rank, module, plan):
+        for stage in self.tpl.stages:
+            self.run_info.name, self.run_info.submod, self.run_info.node = self.ir_cache.load_stage(stage, module, plan)
+
+            if self.meta_init == True:
+                self.materialize_submod(rank)
+            self.run_info.submod.to(self.run_info.device)
+            print(f" ### Rank:{rank}, name:{self.run_info.node.name}, move {self.run_info.name} (IR cache) to {self.run_info.device}")
+
+            self.run_info.chunks.append((self.run_info.name, self.run_info.submod, self.run_info.node))
+
+        self.set_chunk(0)
+
+
+    # allocate the meta tensors of run_info.submod on device; load them from the checkpoint or initialize
+    def materialize_submod(self, rank):
+        num_loaded, num_init = materialize_module(self.run_info.submod, self.run_info.device, self.meta_names, self.ckpt_reader, self.meta_init_fn, self.meta_root)
+        print(f" ### Rank:{rank}, materialize {self.run_info.name}: {num_loaded} tensors loaded, {num_init} initialized")
+        print_cpu_memory_usage(f"[Rank:{rank}] After: materialize {self.run_info.name}")
+
+
+    @staticmethod
+    def reset_module(mod):
+        if hasattr(mod, "reset_parameters"):
+            mod.reset_parameters()
+        else:
+            for t in itertools.chain(mod.parameters(recurse=False), mod.buffers(recurse=False)):
+                t.zero_()
+
+
+    # IR_Anal.SINGLE: ship every stage to its ranks. The structure of a stage (root module with
+    #   meta tensors, graph, tensor specs) goes as a small object; its tensors are then
+    #   streamed as flat buckets (Comm.send_tensors), to all ranks of the stage at once
+    def ship_stages(self):
+        graph = copy.deepcopy(self.ir.model_ir[0].graph) # node names/args of the top-level graph
+
+        shipments = []
+        for stage in range(self.tpl.num_stage):
+            to_ranks = [r for r in self.tpl.stage2rank[stage] if r != 0]
+            if len(to_ranks) == 0:
+                continue
+
+            to_name = f"submod_{stage}"
+            root, sgraph, tensors = strip_submod(self.ir.model_ir[0].get_submodule(to_name))
+            specs = [(snames, is_param, t.requires_grad, tuple(t.shape), t.dtype) for snames, is_param, t in tensors]
+
+            object_list = [to_name, (root, sgraph, specs), graph]
+            for to_rank in to_ranks:
+                print(f"[Rank:0] >> Send IR partition to rank:{to_rank} ...")
+                dist.broadcast_object_list(object_list, src=0, group=self.comm.ctrl_group[to_rank], device=self.run_info.device)
+            shipments.append((to_ranks, [t for _, _, t in tensors]))
+
+        # every rank has posted its receives by now
+        for to_ranks, tensors in shipments:
+            self.comm.send_tensors(tensors, to_ranks, self.run_info.device)
+            print(f"[Rank:0] >> Sent {sum(t.numel() * t.element_size() for t in tensors) / (1024 ** 2):.1f} MB to ranks:{to_ranks}")
+
+
+    def receive_stage(self, rank):
+        object_list = [None, None, None]
+        dist.broadcast_object_list(object_list, src=0, group=self.comm.ctrl_group[rank], device=self.run_info.device)
+        self.run_info.name = object_list[0]
+        root, sgraph, specs = object_list[1]
+        graph = object_list[2]
+        print(f"<< [Rank:{rank}, Stage:{self.tpl.stage}] <== Received {self.run_info.name} ...")
+
+        values = self.comm.receive_tensors([(shape, dtype) for _, _, _, shape, dtype in specs], 0, self.run_info.device)
+        tensors = []
+        for (snames, is_param, requires_grad, _, _), t in zip(specs, values):
+            tensors.append((snames, is_param, nn.Parameter(t, requires_grad=requires_grad) if is_param else t))
+        self.run_info.submod = rebuild_submod(root, sgraph, tensors)
+
+        for n in graph.nodes:
+            if n.name == self.run_info.name:
+                self.run_info.node = n
+            if n.op == 'output':
+                self.run_info.output_node = n
+
+
+    # switch the current local stage (virtual stage) of this rank
+    def set_chunk(self, chunk):
+        self.tpl.set_chunk(chunk)
+        self.run_info.set_chunk(chunk)
+
+
+    # micro-batches of the labels; labels already split by the caller (e.g. PackCollate) are kept
+    def split_labels(self, labels):
+        if isinstance(labels, (list, tuple)):
+            assert len(labels) == self.mbsize, f"len(labels):[{len(labels)}] is not equal to mbsize:[{self.mbsize}]"
+            return labels[0], tuple(labels)
+
+        # labels padding
+        if self.use_padding and labels.size(0) % self.mbsize != 0:
+            padding_size = self.mbsize - (labels.size(0) % self.mbsize)
+            # Use class value as padding
+            padding_value = self.ignore_index  
+            padding = torch.full((padding_size, *labels.size()[1:]), padding_value, device=labels.device, dtype=labels.dtype)
+            labels = torch.cat([labels, padding], dim=0)
+
+        mbatches = torch.chunk(labels, self.mbsize)
+        assert len(mbatches) == self.mbsize, f"len(mbatches):[{len(mbatches)}] is not equal to mbsize:[{self.mbsize}]"
+        return labels, mbatches
+
+
     def prepare_labels(self, labels):
-        if self.tpl.is_first_stage():
+        if self.tpl.has_first_stage():
             target_node_name = "labels"
 
-            # labels padding
-            if self.use_padding and labels.size(0) % self.mbsize != 0:
-                padding_size = self.mbsize - (labels.size(0) % self.mbsize)
-                # Use class value as padding
-                padding_value = self.ignore_index  
-                padding = torch.full((padding_size, *labels.size()[1:]), padding_value, device=labels.device, dtype=labels.dtype)
-                labels = torch.cat([labels, padding], dim=0)
-
-            mbatches = torch.chunk(labels, self.mbsize)
-            assert len(mbatches) == self.mbsize, f"len(mbatches):[{len(mbatches)}] is not equal to mbsize:[{self.mbsize}]"
+            labels, mbatches = self.split_labels(labels)
             if self.mbsize == 1:
                 self.run_info.env[0][target_node_name] = labels
             else:
@@ -589,24 +859,33 @@ class Optimus_p:
             if self.comm.world_size > 1:
                 for j in range(self.mbsize):
                     obj = self.run_info.env[j][target_node_name]
-                    self.comm.send_data(obj, self.tpl.get_last_rank(), self.device)
+                    self.comm.send_data(obj, self.tpl.get_last_rank(), self.device, key=target_node_name)
             else:
-                self.run_info.env[0][target_node_name] = self.run_info.env[0][target_node_name].to(self.device)
+                self.run_info.env[0][target_node_name] = self.run_info.to_device(self.run_info.env[0][target_node_name], target_node_name, 0)
 
 
     def ready_labels(self):
 
-        if self.tpl.is_last_stage():
+        if self.tpl.has_last_stage():
             target_node_name = "labels"
 
+            # labels belong to the env of the last local stage
+            self.set_chunk(len(self.tpl.stages) - 1)
+
             if self.comm.world_size > 1:
                 for j in range(self.mbsize):
-                    self.run_info.env[j][target_node_name] = self.comm.receive_data(self.tpl.get_first_rank(), self.device)
+                    self.run_info.env[j][target_node_name] = self.comm.receive_data(self.tpl.get_first_rank(), self.device, key=target_node_name, slot=j)
+            # the env holds reused receive/device buffers: hand out copies, not the buffers
             if self.mbsize == 1:
-                labels = self.run_info.env[0][target_node_name]
+                labels = self.run_info.env[0][target_node_name].clone()
             else:
                 outputs = tuple(mb["labels"] for mb in self.run_info.env)
-                labels = torch.cat(outputs)
+                if len(set(mb.shape[1:] for mb in outputs)) == 1:
+                    labels = torch.cat(outputs)
+                else: # packed micro-batches of different lengths
+                    labels = [mb.clone() for mb in outputs]
+
+            self.set_chunk(0)
             return labels
         return None
 
@@ -617,21 +896,144 @@ class Optimus_p:
         return self.ready_labels()
 
 
+    # move_labels2last_stage without blocking (see MicroBatchLoader): the first stage sends the
+    #   micro-batches as one message on the label group, the last stage posts the receive;
+    #   run_loss() waits for it at the loss of the first micro-batch
+    def ship_labels(self, labels):
+        target_node_name = "shipped_labels"
+
+        if self.tpl.has_first_stage():
+            labels, mbatches = self.split_labels(labels)
+            if self.tpl.has_last_stage():
+                self.pending_labels = [self.run_info.to_device(mb, target_node_name, j) for j, mb in enumerate(mbatches)]
+                return
+            self.label_sends = [handle for handle in self.label_sends if not handle.is_completed()]
+            self.label_sends.append(self.comm.isend_data(list(mbatches), self.tpl.get_last_rank(), self.device, key=target_node_name, group=self.label_group))
+
+        elif self.tpl.has_last_stage():
+            self.pending_labels = self.comm.irecv_data(self.tpl.get_first_rank(), self.device, key=target_node_name, slot=0, group=self.label_group)
+
+
+    # labels shipped by ship_labels(), into the env of the current (last) stage
+    def wait_labels(self):
+        mbatches = self.pending_labels
+        self.pending_labels = None
+        if isinstance(mbatches, AsyncRecv):
+            mbatches = mbatches.wait()
+        for j in range(self.mbsize):
+            self.run_info.env[j]["labels"] = mbatches[j]
+
+
     def run(self, data, labels, mode="gpipe"):
         #schedule = SCHEDULE[mode](self.run_info, self.ir, self.comm, self.tpl)
         #
         #schedule.run(data, labels)
         #self.schedule = SCHEDULE[mode](self.run_info, self.ir, self.comm, self.tpl, self.activation_ckpt)
+        if self.num_chunks > 1 and mode != "interleaved_1f1b":
+            print(f"mode:{mode} not supported with num_chunks > 1, use mode=\"interleaved_1f1b\"")
+            sys.exit(1)
+
         self.schedule = SCHEDULE[mode](self)
+        if self.tracer is not None:
+            self.tracer.instrument(self.schedule)
 
         self.schedule.run(data, labels)
+
+        # DP gradients reduced during the last backward, ready for the optimizer step
+        for reducer in self.run_info.reducers:
+            reducer.finish()
+        if self.zero_optimizer is not None:
+            self.zero_optimizer.collect_grads()
+
+
+    # merged Chrome trace of the steps run so far, written at rank 0 (call on every rank)
+    def export_trace(self, path):
+        if self.tracer is None:
+            print(f"tracing is not enabled, use Optimus_p(..., trace=True)")
+            return None
+        return self.tracer.export(path)
         
 
     def parameters(self):
-        return self.run_info.submod.parameters()
+        return itertools.chain(*(submod.parameters() for submod in self.run_info.get_submods()))
+
+
+    # optimizer of the local stages; with zero_stage > 0, its states are sharded over the DP group
+    #   (e.g. optimizer = optimus_p.shard_optimizer(torch.optim.Adam, lr=3e-5))
+    def shard_optimizer(self, optimizer_class, **kwargs):
+        if self.zero_stage == 0:
+            self.optimizer = optimizer_class(self.parameters(), **kwargs)
+        else:
+            self.zero_optimizer = ZeroOptimizer(self.run_info.reducers, optimizer_class, zero_stage=self.zero_stage, **kwargs)
+            self.optimizer = self.zero_optimizer
+        return self.optimizer
+
+
+    # gradients of the local stages, grouped by (device, dtype) for the foreach kernels
+    def get_grad_groups(self):
+        grads = self.zero_optimizer.get_grads() if self.zero_optimizer is not None else [p.grad for p in self.parameters()]
+        groups = {}
+        for g in grads:
+            if g is not None:
+                groups.setdefault((g.device, g.dtype), []).append(g)
+        return groups
+
+
+    # clip_grad_norm_ over the whole pipeline: the norm of every gradient of the model, not
+    #   only of the local stages. Per-stage sums are all-reduced once over all ranks; the
+    #   dp_size replicas of a stage hold the same (reduced) gradients and are counted once;
+    #   with zero_stage > 0, each replica holds its own shard.
+    def clip_grad_norm_(self, max_norm, norm_type=2.0):
+        norm_type = float(norm_type)
+        groups = self.get_grad_groups()
+
+        local = torch.zeros(1, dtype=torch.float32, device=self.device)
+        for (device, _), grads in groups.items():
+            norms = torch.stack(torch._foreach_norm(grads, norm_type)).float()
+            if norm_type == math.inf:
+                local = torch.maximum(local, norms.max().to(self.device))
+            else:
+                local += norms.pow(norm_type).sum().to(self.device)
+
+        if self.comm.world_size > 1:
+            if norm_type == math.inf:
+                dist.all_reduce(local, op=dist.ReduceOp.MAX)
+            else:
+                dist.all_reduce(local, op=dist.ReduceOp.SUM)
+                if self.zero_optimizer is None:
+                    local = local / self.tpl.dp_size
+
+        total_norm = local[0] if norm_type == math.inf else local[0].pow(1.0 / norm_type)
+
+        # no host sync: multiply by min(1, coef)
+        clip_coef = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0)
+        for (device, _), grads in groups.items():
+            torch._foreach_mul_(grads, clip_coef.to(device))
+
+        return total_norm
+
+
+    # optimizer step with the global gradient clipping of clip_grad_norm_ (if max_norm is given);
+    #   Adam/AdamW/SGD/... run their multi-tensor (foreach) implementation unless set otherwise
+    def optimizer_step(self, optimizer=None, max_norm=None, norm_type=2.0):
+        if optimizer is None:
+            optimizer = self.optimizer
+
+        total_norm = None
+        if max_norm is not None:
+            total_norm = self.clip_grad_norm_(max_norm, norm_type)
+
+        for group in optimizer.param_groups:
+            if "foreach" in group and group["foreach"] is None and group.get("fused") is not True:
+                group["foreach"] = True
+
+        optimizer.step()
+        return total_norm
 
     def train(self):
-        return self.run_info.submod.train()
+        for submod in self.run_info.get_submods():
+            submod.train()
+        return self.run_info.submod
 
     def get_loss(self):
         return self.run_info.loss
@@ -642,10 +1044,10 @@ class Optimus_p:
 
 
     def is_first_stage(self):
-        return self.tpl.is_first_stage()
+        return self.tpl.has_first_stage()
 
     def is_last_stage(self):
-        return self.tpl.is_last_stage()
+        return self.tpl.has_last_stage()
 
 
     def prepare_dp_group(self):
@@ -656,8 +1058,15 @@ class Optimus_p:
             dp_group = list(range(start_rank, end_rank))
             if self.tpl.rank in dp_group:
                 ddp_group = dist.new_group(dp_group)
-                #self.run_info.submod = DistributedDataParallel(self.run_info.submod, process_group=ddp_group, find_unused_parameters=False)
-                self.run_info.submod = DistributedDataParallel(self.run_info.submod, process_group=ddp_group, find_unused_parameters=True)
+                if self.dp_reducer == "bucket":
+                    # bucketed async all-reduce in the backward of the last micro-batch (see dp_reducer.py)
+                    self.run_info.reducers = [DPReducer(submod, ddp_group, bucket_cap_mb=self.bucket_cap_mb, reduce_scatter=self.zero_stage > 0) for submod in self.run_info.get_submods()]
+                else:
+                    for c, (name, submod, node) in enumerate(self.run_info.chunks):
+                        #submod = DistributedDataParallel(submod, process_group=ddp_group, find_unused_parameters=False)
+                        submod = DistributedDataParallel(submod, process_group=ddp_group, find_unused_parameters=True)
+                        self.run_info.chunks[c] = (name, submod, node)
+                self.run_info.set_chunk(self.tpl.chunk)
                 print(f"Preparing DP group: {dp_group}")
             else:
                 dist.new_group(dp_group)
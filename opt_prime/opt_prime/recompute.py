@@ -0,0 +1,194 @@
+#
+# Copyright (c) 2024-present, ETRI, All rights reserved.
+#
+
+import operator
+import logging
+
+import torch
+import torch.nn as nn
+from torch import fx
+from torch.fx.graph_module import GraphModule
+from torch.fx.passes.shape_prop import ShapeProp
+from torch.utils.checkpoint import checkpoint
+
+
+#
+# Selective activation recomputation inside the stages (Optimus_p(..., recompute=...))
+#
+#   An FX pass over the GraphModule of a stage groups its nodes into regions from the module
+#   hierarchy recorded at tracing (nn_module_stack) and moves each selected region into a
+#   submodule run under torch.utils.checkpoint: only the inputs of the region are kept for
+#   the backward, its activations are recomputed.
+#
+#   - "block": every repeated block (e.g. transformer.h.3)
+#   - "attn" / "mlp": only the attention / MLP of every block
+#
+#   With a budget (bytes of activations per micro-batch and stage), the activations of the
+#   nodes are measured (ShapeProp) on the first micro-batch, and the largest regions are
+#   recomputed until the stage fits; without budget, all regions of the policy are.
+#
+
+RECOMPUTE_POLICY = {
+    "block": None,
+    "attn": ("attn", "attention"),
+    "mlp": ("mlp", "ffn", "feed_forward", "intermediate"),
+}
+
+
+class CheckpointRegion(nn.Module):
+
+    def __init__(self, region: GraphModule):
+        super().__init__()
+        self.region = region
+
+    def forward(self, *args):
+        return checkpoint(self.region, *args, use_reentrant=False)
+
+
+# module path of the block (or part of the block) that n belongs to, None if none
+def region_key(n, policy):
+    stack = n.meta.get("nn_module_stack")
+    if not stack:
+        return None
+    paths = [v[0] if isinstance(v, tuple) else k for k, v in stack.items()]
+    for i, path in enumerate(paths):
+        if path.split(".")[-1].isdigit(): # a block of a ModuleList
+            if RECOMPUTE_POLICY[policy] is None:
+                return path
+            if i + 1 < len(paths):
+                part = paths[i + 1][len(path) + 1:].split(".")[0]
+                if any(name in part.lower() for name in RECOMPUTE_POLICY[policy]):
+                    return f"{path}.{part}"
+            return None
+    return None
+
+
+# [ [nodes], ] maximal runs of nodes of the same region, in graph order
+def find_regions(gm: GraphModule, policy):
+    regions = []
+    cur_key, cur = None, []
+    for n in gm.graph.nodes:
+        if n.op == "get_attr":
+            continue
+        key = region_key(n, policy) if n.op not in ("placeholder", "output") else None
+        if key != cur_key and len(cur) > 0:
+            regions.append(cur)
+            cur = []
+        if key is not None:
+            cur.append(n)
+        cur_key = key
+    if len(cur) > 0:
+        regions.append(cur)
+    return [r for r in regions if len(r) > 1]
+
+
+def node_bytes(n):
+    meta = n.meta.get("tensor_meta")
+    metas = meta if isinstance(meta, (tuple, list)) else [meta]
+    total = 0
+    for m in metas:
+        if hasattr(m, "shape") and hasattr(m, "dtype"):
+            total = total + m.shape.numel() * torch.empty((), dtype=m.dtype).element_size()
+    return total
+
+
+# move the nodes of region into a CheckpointRegion submodule called in their place
+def outline_region(gm: GraphModule, region, name):
+    in_region = set(region)
+
+    inputs = []
+    for n in region:
+        for a in n.all_input_nodes:
+            if a not in in_region and a.op != "get_attr" and a not in inputs:
+                inputs.append(a)
+    outputs = [n for n in region if any(u not in in_region for u in n.users)]
+
+    sub = fx.Graph()
+    env = {}
+    for a in inputs:
+        env[a] = sub.placeholder(a.name)
+    for n in region:
+        for a in n.all_input_nodes:
+            if a.op == "get_attr" and a not in env:
+                env[a] = sub.get_attr(a.target)
+        env[n] = sub.node_copy(n, lambda a: env[a])
+    sub.output(tuple(env[n] for n in outputs))
+
+    gm.add_submodule(name, CheckpointRegion(GraphModule(gm, sub)))
+
+    with gm.graph.inserting_before(region[0]):
+        call = gm.graph.call_module(name, tuple(inputs))
+        for i, n in enumerate(outputs):
+            out = gm.graph.call_function(operator.getitem, (call, i))
+            n.replace_all_uses_with(out, delete_user_cb=lambda u: u not in in_region)
+
+    for n in reversed(region):
+        gm.graph.erase_node(n)
+
+    # attributes now read inside the region only
+    for a in [a for a in env if a.op == "get_attr" and len(a.users) == 0]:
+        gm.graph.erase_node(a)
+
+
+# positional inputs of the GraphModule (its placeholders in order) from the args/kwargs of the
+#   stage call; None if a placeholder has neither a value nor a default
+def placeholder_inputs(gm, args, kwargs):
+    inputs = list(args)
+    for node in [n for n in gm.graph.nodes if n.op == 'placeholder'][len(args):]:
+        if node.target in kwargs:
+            inputs.append(kwargs[node.target])
+        elif len(node.args) > 0:
+            inputs.append(node.args[0])
+        else:
+            return None
+    return inputs
+
+
+class Recompute:
+
+    def __init__(self, policy, budget=None):
+        self.policy = policy
+        self.budget = budget
+        self.prepared = set()  # local stages (chunks) already rewritten
+
+
+    # rewrite the GraphModule of the local stage before its first forward
+    def prepare(self, chunk, gm, args, kwargs, rank):
+        if chunk in self.prepared:
+            return
+        self.prepared.add(chunk)
+
+        regions = find_regions(gm, self.policy)
+
+        total = None
+        inputs = None if self.budget is None else placeholder_inputs(gm, args, kwargs)
+        if self.budget is not None and inputs is None:
+            logging.warning(f" [Recompute] rank:{rank}, recompute_budget ignored for stage {chunk}: "
+                            f"inputs {sorted(kwargs)} not matched to its placeholders, all regions of the policy are checkpointed")
+        if inputs is not None:
+            # no change to the random state of dropout
+            devices = list({a.device for a in inputs if isinstance(a, torch.Tensor) and a.device.type == "cuda"})
+            with torch.no_grad(), torch.random.fork_rng(devices=devices):
+                ShapeProp(gm).propagate(*inputs)
+            sizes = [sum(node_bytes(n) for n in r) for r in regions]
+            total = sum(node_bytes(n) for n in gm.graph.nodes if n.op not in ("placeholder", "get_attr", "output"))
+
+            selected = []
+            for size, r in sorted(zip(sizes, regions), key=lambda x: -x[0]):
+                if total <= self.budget:
+                    break
+                out_size = sum(node_bytes(n) for n in r if any(u not in r for u in n.users))
+                total = total - size + out_size
+                selected.append(r)
+            regions = [r for r in regions if any(r is s for s in selected)]
+
+        for i, r in enumerate(regions):
+            outline_region(gm, r, f"recompute_{i}")
+        gm.graph.lint()
+        # the submodules moved into the regions: registered once, no duplicate state_dict keys
+        gm.delete_all_unused_submodules()
+        gm.recompile()
+
+        est = f", activations/micro-batch: {total / (1024 ** 2):.2f} MB" if total is not None else ""
+        print(f" ### Rank:{rank}, recompute ({self.policy}): {len(regions)} regions checkpointed{est}")
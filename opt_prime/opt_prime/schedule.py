@@ -13,6 +13,11 @@ import sys
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 from torch.nn.parallel import DistributedDataParallel
 
+try:
+    from torch.autograd.graph import GradientEdge
+except ImportError:
+    GradientEdge = None # ScheduleZeroBubble: W recomputes the input-side gradients
+
 import gc
 
 
@@ -32,6 +37,11 @@ class Schedule:
     def __init__(self, optimus): 
         self.optimus = optimus
 
+        # non-blocking boundary communication (isend/irecv)
+        self.async_comm = False
+        self.pending_recv: Dict[Tuple[int, str, int], Any] = {} # { (from_rank, node_name, mb_idx) : AsyncRecv }
+        self.pending_send: List[Any] = []  # [ AsyncSend, ... ]
+
         if self.optimus.force_free_mem == True:
             self.total_mem = torch.cuda.get_device_properties(self.optimus.tpl.local_rank).total_memory 
             self.allocated_mem = torch.cuda.memory_allocated(self.optimus.tpl.local_rank) 
@@ -42,6 +52,12 @@ class Schedule:
         global model_offloaded
 
 
+    # max # of micro-batches whose activations a stage holds at once (used by the memory-aware split)
+    @staticmethod
+    def num_in_flight(stage, tpl, mbsize):
+        return mbsize
+
+
     def init_env_mark(self, mb_idx):
         self.optimus.run_info.env_recv_mark[mb_idx]["input_ids"] = None # TODO: Seq Cls.
         self.optimus.run_info.env_send_mark[mb_idx]["input_ids"] = None # TODO: Seq Cls.
@@ -63,7 +79,14 @@ class Schedule:
 
         if self.optimus.tpl.is_first_stage():
             input = next(self.args_iter)
-            if isinstance(input, torch.Tensor):
+            if isinstance(input, (list, tuple)):
+                # micro-batches already split by the caller (e.g. PackCollate), possibly of different shapes
+                if len(input) != self.optimus.mbsize:
+                    logging.critical(f"### {len(input)} micro-batches given, mbsize:{self.optimus.mbsize}")
+                    sys.exit(1)
+                for j in range(self.optimus.mbsize):
+                    self.optimus.run_info.env[j]["placeholder"] = self.optimus.run_info.to_device(input[j], "placeholder", j)
+            elif isinstance(input, torch.Tensor):
                 # Check if input size is smaller than mbsize before chunking
                 if self.optimus.use_padding and input.size(0) % self.optimus.mbsize != 0:
                     padding_size = self.optimus.mbsize - (input.size(0) % self.optimus.mbsize)
@@ -75,11 +98,11 @@ class Schedule:
                 mbatches = torch.chunk(input, self.optimus.mbsize)
                 # Now proceed as usual
                 if self.optimus.mbsize == 1:
-                    input = input.to(self.optimus.run_info.device)
+                    input = self.optimus.run_info.to_device(input, "placeholder", 0)
                     self.optimus.run_info.env[0]["placeholder"] = input
                 else:
                     for j in range(self.optimus.mbsize):
-                        mbatch = mbatches[j].to(self.optimus.run_info.device)
+                        mbatch = self.optimus.run_info.to_device(mbatches[j], "placeholder", j)
                         self.optimus.run_info.env[j]["placeholder"] = mbatch
             else:
                 logging.critical(f"### input:{input} not Tensor --> currently not supported!!")
@@ -107,6 +130,10 @@ class Schedule:
             print(f"optimus.optimizer not set when swap_opt_in_fwdbwd == True")
             return
 
+        if self.optimus.offload_engine is not None:
+            self.optimus.offload_engine.offload_optimizer(self.optimus.optimizer)
+            return
+
         state_dict = self.optimus.optimizer.state_dict()
         for state in state_dict['state'].values():
             for k, v in state.items():
@@ -123,18 +150,37 @@ class Schedule:
             print(f"optimus.optimizer not set when swap_opt_in_fwdbwd == True")
             return
 
+        if self.optimus.offload_engine is not None:
+            self.optimus.offload_engine.load_optimizer(self.optimus.optimizer)
+            return
+
         state_dict = self.optimus.optimizer.state_dict()
         for state in state_dict['state'].values():
             for k, v in state.items():
                 if isinstance(v, torch.Tensor):
                     state[k] = v.to(self.optimus.run_info.device)
 
+
+    # start loading the offloaded optimizer states back, to overlap with the last backward
+    def prefetch_optimizer(self):
+        global model_offloaded
+        global optimizer_offloaded
+
+        if self.optimus.offload_engine is None or self.optimus.swap_opt_in_fwdbwd == False or self.optimus.optimizer == None:
+            return
+        if optimizer_offloaded == True and model_offloaded == False:
+            self.optimus.offload_engine.prefetch_optimizer(self.optimus.optimizer)
+
     def offload_model(self):
         if self.optimus.swap_model_in_optstep == False:
             print(f"offload_model() should be used when swap_model_in_optstep == True")
             return
 
-        self.optimus.run_info.submod.to('cpu')
+        if self.optimus.offload_engine is not None:
+            self.optimus.offload_engine.offload_model(self.optimus.run_info.get_submods())
+        else:
+            for submod in self.optimus.run_info.get_submods():
+                submod.to('cpu')
 
         if self.optimus.display_mem == True:
             print(f" >>> >>> [rank:{self.optimus.tpl.rank}], offload model ...")
@@ -146,7 +192,11 @@ class Schedule:
             print(f"load_model() should be used when swap_model_in_optstep == True")
             return
 
-        self.optimus.run_info.submod.to(self.optimus.run_info.device)
+        if self.optimus.offload_engine is not None:
+            self.optimus.offload_engine.load_model(self.optimus.run_info.get_submods())
+        else:
+            for submod in self.optimus.run_info.get_submods():
+                submod.to(self.optimus.run_info.device)
 
         if self.optimus.display_mem == True:
             print(f" >>> >>> [rank:{self.optimus.tpl.rank}], load model ...")
@@ -177,6 +227,12 @@ class Schedule:
                     if self.optimus.display_mem == True:
                         print(f" >>> [rank:{self.optimus.tpl.rank}], offload optimizer ...")
 
+                # the optimizer step runs on CPU
+                if self.optimus.offload_engine is not None:
+                    if self.optimus.swap_opt_in_fwdbwd == True:
+                        self.optimus.offload_engine.cancel_prefetch(self.optimus.optimizer)
+                    self.optimus.offload_engine.synchronize()
+
 
     def run_loss(self, mb_idx):
         assert self.optimus.tpl.is_last_stage() == True
@@ -200,6 +256,8 @@ class Schedule:
         else:
             output1_ = self.optimus.run_info.env[mb_idx][str(key_)]
 
+        if self.optimus.pending_labels is not None: # shipped by ship_labels()
+            self.optimus.wait_labels()
         target1_ = self.optimus.run_info.env[mb_idx]["labels"]
 
         #if self.optimus.ir.model_type == self.optimus.ir.model2type["hf"]:
@@ -268,6 +326,66 @@ class Schedule:
 
 
 
+    def receive_boundary(self, mb_idx, node_name, from_rank):
+        pending = self.pending_recv.pop((from_rank, node_name, mb_idx), None)
+        if pending is not None:
+            return pending.wait()
+
+        if self.async_comm == True:
+            return self.optimus.comm.irecv_data(from_rank, self.optimus.run_info.device, key=node_name, slot=(self.optimus.tpl.chunk, mb_idx)).wait()
+
+        return self.optimus.comm.receive_data(from_rank, self.optimus.run_info.device, key=node_name, slot=(self.optimus.tpl.chunk, mb_idx))
+
+
+    def send_boundary(self, obj, node_name, to_rank):
+        if self.async_comm == True:
+            self.pending_send.append(self.optimus.comm.isend_data(obj, to_rank, self.optimus.run_info.device, key=node_name))
+            self.complete_sends(block=False)
+        else:
+            self.optimus.comm.send_data(obj, to_rank, self.optimus.run_info.device, key=node_name)
+
+
+    def post_recv(self, mb_idx, node_name, from_rank):
+        if (from_rank, node_name, mb_idx) not in self.pending_recv:
+            self.pending_recv[(from_rank, node_name, mb_idx)] = self.optimus.comm.irecv_data(from_rank, self.optimus.run_info.device, key=node_name, slot=(self.optimus.tpl.chunk, mb_idx))
+
+
+    def complete_sends(self, block=True):
+        if block == True:
+            for handle in self.pending_send:
+                handle.wait()
+            self.pending_send = []
+        else:
+            self.pending_send = [handle for handle in self.pending_send if not handle.is_completed()]
+
+
+    # Post the activation irecvs of mb_idx in advance (same order as pre_fx_micro_forward_core).
+    # Callers must keep the per-peer message order identical to the non-prefetched schedule.
+    def prefetch_forward(self, mb_idx):
+        if self.async_comm == False or mb_idx >= self.optimus.mbsize or self.optimus.tpl.is_first_stage():
+            return
+
+        pre_split_rank = self.optimus.tpl.get_prev_rank()
+
+        for node_name, range_ in self.optimus.run_info.special_nodes.items():
+            src_stage, needed_by_stage = range_
+            if self.optimus.tpl.stage > src_stage and self.optimus.tpl.stage <= needed_by_stage:
+                if node_name in self.optimus.run_info.getitem_dic:
+                    node_name = self.optimus.run_info.getitem_dic[node_name][0]
+                if self.optimus.run_info.env_recv_mark[mb_idx].get(node_name) is None:
+                    self.post_recv(mb_idx, node_name, pre_split_rank)
+
+
+    # Post the gradient irecv of mb_idx in advance (same order as pre_fx_micro_backward_core)
+    def prefetch_backward(self, mb_idx):
+        if self.async_comm == False or mb_idx >= self.optimus.mbsize or self.optimus.tpl.is_last_stage():
+            return
+
+        node_name = self.get_next_node_name()
+        if self.optimus.run_info.env_grad_recv_mark[mb_idx][node_name] is None:
+            self.post_recv(mb_idx, node_name, self.optimus.tpl.get_next_rank())
+
+
     def pre_fx_micro_forward_core(self, mb_idx):
         #from_, to_ = self.optimus.ir.get_range(self.optimus.tpl.get_stage(), self.optimus.run_info.graph)
 
@@ -292,7 +410,7 @@ class Schedule:
                     if node_name in self.optimus.run_info.getitem_dic:
                         submod_name = self.optimus.run_info.getitem_dic[node_name][0]
                         if self.optimus.run_info.env_recv_mark[mb_idx][submod_name] is None:
-                            self.optimus.run_info.env[mb_idx][submod_name] = self.optimus.comm.receive_data(pre_split_rank, self.optimus.run_info.device)
+                            self.optimus.run_info.env[mb_idx][submod_name] = self.receive_boundary(mb_idx, submod_name, pre_split_rank)
                             self.optimus.run_info.env_recv_mark[mb_idx][submod_name] = 1
 
                         if isinstance(self.optimus.run_info.env[mb_idx][submod_name], torch.Tensor):
@@ -301,7 +419,7 @@ class Schedule:
                                 logging.info(f" ###### node name:{submod_name} requires_grad(True) #####") 
                     else:
                         if self.optimus.run_info.env_recv_mark[mb_idx][node_name] is None:
-                            self.optimus.run_info.env[mb_idx][node_name] = self.optimus.comm.receive_data(pre_split_rank, self.optimus.run_info.device)
+                            self.optimus.run_info.env[mb_idx][node_name] = self.receive_boundary(mb_idx, node_name, pre_split_rank)
                             self.optimus.run_info.env_recv_mark[mb_idx][node_name] = 1
                         # TODO: Seq Cls.
                         #if isinstance(self.optimus.run_info.env[mb_idx][node_name], torch.Tensor):
@@ -347,6 +465,12 @@ class Schedule:
         args = fx.graph.map_arg(self.optimus.run_info.node.args, extract_tensor_args)
         kwargs = fx.graph.map_arg(self.optimus.run_info.node.kwargs, extract_tensor_args)
 
+        if self.optimus.recompute is not None:
+            submod = self.optimus.run_info.submod
+            if isinstance(submod, DistributedDataParallel):
+                submod = submod.module
+            self.optimus.recompute.prepare(self.optimus.run_info.chunk, submod, args, kwargs, self.optimus.tpl.rank)
+
         if isinstance(self.optimus.run_info.submod, DistributedDataParallel):
             with self.optimus.run_info.submod.no_sync():
                 #logging.info(f" [FWD] DDP no_sync ... rank:{self.optimus.tpl.rank}, mb_idx:{mb_idx}")
@@ -416,7 +540,7 @@ class Schedule:
                         submod_name = self.optimus.run_info.getitem_dic[node_name][0]
                         if self.optimus.run_info.env_send_mark[mb_idx][submod_name] is None:
                             obj = self.optimus.run_info.env[mb_idx][submod_name]
-                            self.optimus.comm.send_data(obj, next_split_rank, self.optimus.run_info.device)
+                            self.send_boundary(obj, submod_name, next_split_rank)
                             self.optimus.run_info.env_send_mark[mb_idx][submod_name] = 1
                             if self.optimus.activation_ckpt == True and needed_by_stage - src_stage == 1: # For Act ckpt
                                 self.optimus.run_info.env[mb_idx][submod_name] = None  
@@ -425,7 +549,7 @@ class Schedule:
                     else:
                         if self.optimus.run_info.env_send_mark[mb_idx][node_name] is None:
                             obj = self.optimus.run_info.env[mb_idx][node_name]
-                            self.optimus.comm.send_data(obj, next_split_rank, self.optimus.run_info.device)
+                            self.send_boundary(obj, node_name, next_split_rank)
                             self.optimus.run_info.env_send_mark[mb_idx][node_name] = 1
                             if self.optimus.activation_ckpt == True and needed_by_stage - src_stage == 1: # For Act ckpt
                                 self.optimus.run_info.env[mb_idx][node_name] = None 
@@ -447,7 +571,8 @@ class Schedule:
         return cnt
 
 
-    def core_backward(self, forward_output, forward_output_gradient, forward_input, valid_index: List[int],):
+    # forward outputs and their gradients --> flat lists of tensors for autograd
+    def get_backward_tensors(self, forward_output, forward_output_gradient, valid_index: List[int],):
 
         forward_output_with_grads = [forward_output[i] for i in valid_index]
         forward_output_gradient_with_grads = [forward_output_gradient[i] for i in valid_index]
@@ -491,6 +616,12 @@ class Schedule:
         if forward_output_list[0] != None and forward_output_gradient_list[0] != None and forward_output_list[0].shape != forward_output_gradient_list[0].shape:
             forward_output_list[0] = forward_output_list[0].view(-1, forward_output_list[0].size(-1))
 
+        return forward_output_list, forward_output_gradient_list
+
+
+    def core_backward(self, forward_output, forward_output_gradient, forward_input, valid_index: List[int],):
+
+        forward_output_list, forward_output_gradient_list = self.get_backward_tensors(forward_output, forward_output_gradient, valid_index)
 
         torch.autograd.backward(forward_output_list, grad_tensors=forward_output_gradient_list)
         #inputs_with_grad = []
@@ -511,12 +642,8 @@ class Schedule:
         return forward_input_gradient, None
 
 
-    def run_core_backward(self, mb_idx, node, grads):
-
-        if self.optimus.force_free_mem == True:
-            self.cond_free_mem_()
+    def get_backward_args(self, mb_idx, node, grads):
 
-        args = ()
         kwargs = dict()
         #if self.optimus.activation_ckpt == True and node.name != "output":
         if self.optimus.activation_ckpt == True and node.name != "output" and not self.optimus.tpl.is_last_stage():
@@ -541,6 +668,20 @@ class Schedule:
         num_nodes = self.get_num_nodes(node.name) 
         kwargs["valid_index"] = [i for i in range(num_nodes)]
 
+        return kwargs
+
+
+    def run_core_backward(self, mb_idx, node, grads):
+
+        if self.optimus.force_free_mem == True:
+            self.cond_free_mem_()
+
+        if mb_idx == self.optimus.mbsize - 1 and self.optimus.force_free_mem == True:
+            self.prefetch_optimizer()
+
+        args = ()
+        kwargs = self.get_backward_args(mb_idx, node, grads)
+
         if isinstance(self.optimus.run_info.submod, DistributedDataParallel):
             if mb_idx == self.optimus.mbsize - 1:
                 #logging.info(f" DDP ... [node.name:{node.name}], [mb_idx:{mb_idx}], prepare_for_backward ...") 
@@ -550,6 +691,10 @@ class Schedule:
             else:
                 with self.optimus.run_info.submod.no_sync():
                     result = self.core_backward(*args, **kwargs)
+        elif self.optimus.run_info.reducer is not None:
+            # last stage: the backward of the loss (output node) comes first and has no parameters
+            with self.optimus.run_info.reducer.sync(mb_idx == self.optimus.mbsize - 1 and node.name == self.optimus.run_info.name):
+                result = self.core_backward(*args, **kwargs)
         else:
             result = self.core_backward(*args, **kwargs)
 
@@ -567,7 +712,7 @@ class Schedule:
 
             node_name = self.get_next_node_name()
             if self.optimus.run_info.env_grad_recv_mark[mb_idx][node_name] is None:
-                self.optimus.run_info.grads[mb_idx][node_name] = self.optimus.comm.receive_data(pre_split_rank, self.optimus.run_info.device)
+                self.optimus.run_info.grads[mb_idx][node_name] = self.receive_boundary(mb_idx, node_name, pre_split_rank)
                 grads = self.optimus.run_info.grads[mb_idx][node_name]
                 self.optimus.run_info.env_grad_recv_mark[mb_idx][node_name] = 1
 
@@ -606,7 +751,7 @@ class Schedule:
             node_name = self.optimus.run_info.name
             if self.optimus.run_info.env_grad_send_mark[mb_idx][node_name] is None:
                 obj = self.optimus.run_info.grads[mb_idx][node_name]
-                self.optimus.comm.send_data(obj, next_split_rank, self.optimus.run_info.device)
+                self.send_boundary(obj, node_name, next_split_rank)
                 self.optimus.run_info.env_grad_send_mark[mb_idx][node_name] = 1
                 if self.optimus.activation_ckpt == True:
                     self.optimus.run_info.grads[mb_idx][node_name] = None
@@ -681,6 +826,7 @@ class ScheduleGPipe(Schedule):
 
         for i in range(self.optimus.mbsize):
             self.pre_fx_micro_forward_core(i)
+            self.prefetch_forward(i + 1)
             self.fx_micro_forward_core(i)
             result = self.post_fx_micro_forward_core(i)
             next(result)
@@ -689,10 +835,13 @@ class ScheduleGPipe(Schedule):
             if self.optimus.tpl.is_last_stage():
                 self.run_loss(i)
             grads = self.pre_fx_micro_backward_core(i)
+            self.prefetch_backward(i + 1)
             self.fx_micro_backward_core(i, grads)
             result = self.post_fx_micro_backward_core(i)
             next(result)
 
+        self.complete_sends()
+
         if self.optimus.force_free_mem == True:
             self.optimus.run_info.clean_run_info(self.optimus.mbsize)
             if self.optimus.swap_model_in_optstep == True:
@@ -713,6 +862,12 @@ class Schedule1F1B(Schedule):
     def __init__(self, optimus): 
         super().__init__(optimus)
 
+
+    # warmup forwards + 1
+    @staticmethod
+    def num_in_flight(stage, tpl, mbsize):
+        return min(tpl.get_num_stage() - stage, mbsize)
+
     
     # run 1F1B schedule
     def run(self, data, labels):
@@ -751,6 +906,7 @@ class Schedule1F1B(Schedule):
 
         for i in range(num_warmup_microbatches):
             self.pre_fx_micro_forward_core(i)
+            self.prefetch_forward(i + 1)
             self.fx_micro_forward_core(i)
             result = self.post_fx_micro_forward_core(i)
             next(result)
@@ -766,6 +922,9 @@ class Schedule1F1B(Schedule):
                 next(result)
                 reorder_mbi = -1
 
+            # after the reorder send, so both sides of the previous link see the same message order
+            self.prefetch_forward(forward_i + 1)
+
             self.fx_micro_forward_core(forward_i)
             result = self.post_fx_micro_forward_core(forward_i)
             next(result)
@@ -796,11 +955,13 @@ class Schedule1F1B(Schedule):
                 reorder_mbi = -1
 
             grads = self.pre_fx_micro_backward_core(backward_i)
+            self.prefetch_backward(backward_i + 1)
             self.fx_micro_backward_core(backward_i, grads)
 
             result = self.post_fx_micro_backward_core(backward_i)
             next(result)
 
+        self.complete_sends()
 
         if self.optimus.force_free_mem == True:
             self.optimus.run_info.clean_run_info(self.optimus.mbsize)
@@ -814,3 +975,480 @@ class Schedule1F1B(Schedule):
                         print(f" >>>>>> [rank:{self.optimus.tpl.rank}], load optimizer ...")
                 optimizer_offloaded = False
 
+
+
+class ScheduleGPipeAsync(ScheduleGPipe):
+
+    def __init__(self, optimus): 
+        super().__init__(optimus)
+        self.async_comm = True
+
+
+
+class Schedule1F1BAsync(Schedule1F1B):
+
+    def __init__(self, optimus): 
+        super().__init__(optimus)
+        self.async_comm = True
+
+
+
+class ScheduleInterleaved1F1B(Schedule):
+
+    def __init__(self, optimus): 
+        super().__init__(optimus)
+        # sends never block, so the interleaved order cannot deadlock on a send
+        self.async_comm = True
+
+
+    # warmup steps + 1 of the stage's rank, spread over its num_chunks chunks
+    @staticmethod
+    def num_in_flight(stage, tpl, mbsize):
+        pp_size = tpl.pp_size
+        num_chunks = tpl.num_chunks
+        pp_rank = stage % pp_size
+
+        total_steps = mbsize * num_chunks
+        if mbsize == pp_size:
+            num_steps = total_steps
+        else:
+            num_steps = min((pp_size - pp_rank - 1) * 2 + (num_chunks - 1) * pp_size + 1, total_steps)
+        return min(-(-num_steps // num_chunks), mbsize)
+
+
+    # k-th forward/backward step of this rank --> (chunk, mb_idx)
+    def get_step_chunk_mb(self, k, forward):
+        pp_size = self.optimus.tpl.pp_size
+        num_chunks = self.optimus.tpl.num_chunks
+
+        chunk = (k // pp_size) % num_chunks
+        if forward == False:
+            chunk = num_chunks - 1 - chunk
+        mb_idx = (k // (pp_size * num_chunks)) * pp_size + k % pp_size
+
+        return chunk, mb_idx
+
+
+    def forward_step(self, k):
+        chunk, mb_idx = self.get_step_chunk_mb(k, forward=True)
+        self.optimus.set_chunk(chunk)
+
+        self.pre_fx_micro_forward_core(mb_idx)
+        self.fx_micro_forward_core(mb_idx)
+        result = self.post_fx_micro_forward_core(mb_idx)
+        next(result)
+
+
+    def backward_step(self, k):
+        chunk, mb_idx = self.get_step_chunk_mb(k, forward=False)
+        self.optimus.set_chunk(chunk)
+
+        if self.optimus.tpl.is_last_stage():
+            self.run_loss(mb_idx)
+
+        grads = self.pre_fx_micro_backward_core(mb_idx)
+        self.fx_micro_backward_core(mb_idx, grads)
+        result = self.post_fx_micro_backward_core(mb_idx)
+        next(result)
+
+
+    # run interleaved 1F1B schedule (virtual stages, num_chunks per rank)
+    def run(self, data, labels):
+        global model_offloaded
+        global optimizer_offloaded
+
+        pp_size = self.optimus.tpl.pp_size
+        num_chunks = self.optimus.tpl.num_chunks
+        pp_rank = self.optimus.tpl.stages[0]
+
+        assert self.optimus.mbsize % pp_size == 0, f"mbsize:[{self.optimus.mbsize}] must be a multiple of pp_size:[{pp_size}]"
+
+        total_steps = self.optimus.mbsize * num_chunks
+
+        if self.optimus.mbsize == pp_size:
+            num_warmup_steps = total_steps
+        else:
+            num_warmup_steps = (pp_size - pp_rank - 1) * 2 + (num_chunks - 1) * pp_size
+            num_warmup_steps = min(num_warmup_steps, total_steps)
+        remaining = total_steps - num_warmup_steps
+
+        self.optimus.set_chunk(0)
+        if self.optimus.tpl.is_first_stage():
+            self.get_input(data)
+
+        for c in range(num_chunks):
+            self.optimus.set_chunk(c)
+            for i in range(self.optimus.mbsize):
+                self.init_env_mark(i)
+                self.init_env_grad_mark(i)
+
+        if self.optimus.force_free_mem == True:
+            self.cond_free_mem_()
+            if self.optimus.swap_model_in_optstep == True and model_offloaded == True:
+                self.load_model()
+
+                if optimizer_offloaded == True and model_offloaded == False:
+                    self.load_optimizer()
+                    optimizer_offloaded = False
+                    if self.optimus.display_mem == True:
+                        print(f" >>> [rank:{self.optimus.tpl.rank}], load optimizer ...")
+
+                model_offloaded = False
+
+        for k in range(num_warmup_steps):
+            self.forward_step(k)
+
+        for k in range(remaining): # steady
+            self.forward_step(k + num_warmup_steps)
+            self.backward_step(k)
+
+        for k in range(remaining, total_steps):
+            self.backward_step(k)
+
+        self.complete_sends()
+        self.optimus.set_chunk(0)
+
+        if self.optimus.force_free_mem == True:
+            self.optimus.run_info.clean_run_info(self.optimus.mbsize)
+            if self.optimus.swap_model_in_optstep == True:
+                self.check_swap_model_in_optstep()
+            self.force_free_mem()
+            if optimizer_offloaded == True and model_offloaded == False:
+                if self.optimus.swap_opt_in_fwdbwd == True:
+                    self.load_optimizer()
+                    if self.optimus.display_mem == True:
+                        print(f" >>>>>> [rank:{self.optimus.tpl.rank}], load optimizer ...")
+                optimizer_offloaded = False
+
+
+
+# Zero-bubble pipeline schedule (ZB-H1)
+#
+#   The backward of a micro-batch is split into B (gradient of the stage input, sent upstream
+#   at once) and W (gradient of the parameters). W is deferred: a stage runs its pending W's
+#   while it waits for the next gradient from downstream, which fills the cooldown bubbles of
+#   1F1B. A stage defers at most (warmup forwards) W's; the graph of a micro-batch is kept
+#   until its W has run.
+#
+class ScheduleZeroBubble(Schedule1F1B):
+
+    warned_fallback = False # per process: a schedule is created per run()
+
+    def __init__(self, optimus): 
+        super().__init__(optimus)
+        # sends never block, so a stage can run W's while its gradient sends are in flight
+        self.async_comm = True
+        self.pending_weight = [] # [ (mb_idx, W step, forward outputs), ] in the order of B
+
+
+    # 1F1B + the deferred W's, whose graphs are kept
+    @staticmethod
+    def num_in_flight(stage, tpl, mbsize):
+        return min(2 * (tpl.get_num_stage() - stage) - 1, mbsize)
+
+
+    # B: gradient of the stage input only; returns the same as core_backward and
+    #   queues the W step of the parameters
+    def core_backward_input(self, mb_idx, forward_output, forward_output_gradient, forward_input, valid_index: List[int],):
+
+        forward_output_list, forward_output_gradient_list = self.get_backward_tensors(forward_output, forward_output_gradient, valid_index)
+
+        submod = self.optimus.run_info.submod
+        if isinstance(submod, DistributedDataParallel):
+            submod = submod.module
+        weights = {id(p): p for p in submod.parameters() if p.requires_grad}
+        inputs = [v for v in forward_input if isinstance(v, torch.Tensor) and v.requires_grad]
+
+        # autograd nodes reachable from the outputs
+        roots = [t.grad_fn for t in forward_output_list if t.grad_fn is not None]
+        children = {}
+        stack = list(roots)
+        while len(stack) > 0:
+            fn = stack.pop()
+            if fn in children:
+                continue
+            children[fn] = [c for c, _ in fn.next_functions if c is not None]
+            stack.extend(children[fn])
+
+        # post-order: does the node lead to a stage input / a parameter?
+        input_ids = set(id(v) for v in inputs)
+        to_input, to_weight = {}, {}
+        weight_nodes = []
+        for fn in self.get_post_order(roots, children):
+            var = getattr(fn, "variable", None) # AccumulateGrad
+            if var is not None:
+                to_input[fn] = id(var) in input_ids
+                to_weight[fn] = id(var) in weights
+                if to_weight[fn]:
+                    weight_nodes.append(var)
+            else:
+                to_input[fn] = any(to_input[c] for c in children[fn])
+                to_weight[fn] = any(to_weight[c] for c in children[fn])
+
+        # B runs the nodes leading to an input. W restarts from each of them that feeds a
+        #   parameter through nodes B does not run (with the gradients it got in B), and from
+        #   the outputs B does not reach; each restart only asks for its own parameters, so
+        #   no gradient flows twice through the input-side nodes.
+        restarts = {}  # { node or output tensor : [weights reached through W-only nodes] }
+        for fn in children:
+            if to_input[fn] and any(to_weight[c] and not to_input[c] for c in children[fn]):
+                restarts[fn] = self.get_weights_below([c for c in children[fn] if to_weight[c] and not to_input[c]], children, to_input, weights)
+        for t in forward_output_list:
+            if t.grad_fn is None:
+                if id(t) in weights:
+                    restarts[t] = [t]
+            elif not to_input[t.grad_fn] and to_weight[t.grad_fn]:
+                restarts[t] = self.get_weights_below([t.grad_fn], children, to_input, weights)
+
+        num_weights = sum(len(ws) for ws in restarts.values())
+        separable = GradientEdge is not None and num_weights == len(set(id(w) for ws in restarts.values() for w in ws))
+
+        captured = {}
+        handles = []
+        if separable:
+            for fn in restarts:
+                if not isinstance(fn, torch.Tensor):
+                    def hook(grad_outputs, fn=fn):
+                        captured[fn] = grad_outputs
+                    handles.append(fn.register_prehook(hook))
+
+        if len(inputs) > 0:
+            torch.autograd.backward(forward_output_list, grad_tensors=forward_output_gradient_list, inputs=inputs, retain_graph=True)
+
+        for h in handles:
+            h.remove()
+
+        w_steps = []  # [ (roots, gradients, weights), ]
+        if separable:
+            output_grads = {id(t): g for t, g in zip(forward_output_list, forward_output_gradient_list)}
+            for fn, ws in restarts.items():
+                if isinstance(fn, torch.Tensor):
+                    w_steps.append(([fn], [output_grads[id(fn)]], ws))
+                elif fn in captured:
+                    edges = [(GradientEdge(fn, i), g) for i, g in enumerate(captured[fn]) if g is not None]
+                    if len(edges) > 0:
+                        w_steps.append(([e for e, _ in edges], [g for _, g in edges], ws))
+        elif len(weight_nodes) > 0:
+            # a parameter is shared by several restarts (or no GradientEdge):
+            #   W recomputes the input-side gradients it needs
+            if ScheduleZeroBubble.warned_fallback == False:
+                reason = "torch.autograd.graph.GradientEdge not available (torch < 2.4)" if GradientEdge is None else "a parameter is shared by several restarts"
+                logging.warning(f" [rank:{self.optimus.tpl.rank}] zb_h1: {reason}, W runs a full backward of the stage (input-side gradients computed twice)")
+                ScheduleZeroBubble.warned_fallback = True
+            w_steps.append((forward_output_list, forward_output_gradient_list, weight_nodes))
+
+        def weight_step():
+            for roots, grads, ws in w_steps:
+                torch.autograd.backward(roots, grad_tensors=grads, inputs=ws)
+
+        self.pending_weight.append((mb_idx, weight_step, forward_output_list))
+
+        forward_input_gradient = []
+        for v in forward_input:
+            if isinstance(v, torch.Tensor):
+                forward_input_gradient.append(v.grad)
+            else:
+                forward_input_gradient.append(None)
+
+        return forward_input_gradient, None
+
+
+    # parameters reached from nodes without passing a node that leads to a stage input
+    def get_weights_below(self, nodes, children, to_input, weights):
+        found = []
+        visited = set()
+        stack = list(nodes)
+        while len(stack) > 0:
+            fn = stack.pop()
+            if fn in visited or to_input[fn]:
+                continue
+            visited.add(fn)
+            var = getattr(fn, "variable", None)
+            if var is not None and id(var) in weights:
+                found.append(var)
+            stack.extend(children[fn])
+        return found
+
+
+    def get_post_order(self, roots, children):
+        order = []
+        visited = set()
+        for root in roots:
+            if root in visited:
+                continue
+            visited.add(root)
+            stack = [(root, iter(children[root]))]
+            while len(stack) > 0:
+                fn, it = stack[-1]
+                c = next(it, None)
+                if c is None:
+                    order.append(fn)
+                    stack.pop()
+                elif c not in visited:
+                    visited.add(c)
+                    stack.append((c, iter(children[c])))
+        return order
+
+
+    def run_core_backward(self, mb_idx, node, grads):
+
+        # nothing waits for the gradients of the last stage: B and W at once
+        if self.optimus.tpl.is_last_stage():
+            return super().run_core_backward(mb_idx, node, grads)
+
+        if self.optimus.force_free_mem == True:
+            self.cond_free_mem_()
+
+        if mb_idx == self.optimus.mbsize - 1 and self.optimus.force_free_mem == True:
+            self.prefetch_optimizer()
+
+        kwargs = self.get_backward_args(mb_idx, node, grads)
+        result = self.core_backward_input(mb_idx, **kwargs)
+
+        if self.optimus.force_free_mem == True:
+            self.cond_free_mem_()
+
+        return result
+
+
+    # run the oldest deferred W
+    def weight_step(self):
+        mb_idx, weight_step, forward_output = self.pending_weight.pop(0)
+
+        if isinstance(self.optimus.run_info.submod, DistributedDataParallel):
+            # W's run in micro-batch order, so the last one reduces the gradients
+            if mb_idx == self.optimus.mbsize - 1:
+                self.optimus.run_info.submod.reducer.prepare_for_backward(list(torch.nn.parallel.distributed._find_tensors(forward_output)))
+                weight_step()
+            else:
+                with self.optimus.run_info.submod.no_sync():
+                    weight_step()
+        elif self.optimus.run_info.reducer is not None:
+            with self.optimus.run_info.reducer.sync(mb_idx == self.optimus.mbsize - 1):
+                weight_step()
+        else:
+            weight_step()
+
+
+    def grad_arrived(self, mb_idx):
+        if self.optimus.tpl.is_last_stage():
+            return True
+        node_name = self.get_next_node_name()
+        if self.optimus.run_info.env_grad_recv_mark[mb_idx][node_name] is not None:
+            return True
+        pending = self.pending_recv.get((self.optimus.tpl.get_next_rank(), node_name, mb_idx))
+        return pending is not None and pending.is_completed()
+
+
+    # fill the wait for the gradient of mb_idx with deferred W's
+    def fill_bubble(self, mb_idx, max_pending):
+        self.prefetch_backward(mb_idx)
+        while len(self.pending_weight) > 0 and (len(self.pending_weight) > max_pending or not self.grad_arrived(mb_idx)):
+            self.weight_step()
+
+
+    # run ZB-H1 schedule
+    def run(self, data, labels):
+        global model_offloaded
+        global optimizer_offloaded
+
+        num_warmup_microbatches = self.optimus.tpl.get_last_stage() - self.optimus.tpl.stage
+        num_warmup_microbatches = min(num_warmup_microbatches, self.optimus.mbsize)
+        remaining = self.optimus.mbsize - num_warmup_microbatches
+
+        if self.optimus.tpl.is_first_stage():
+            self.get_input(data)
+
+        for i in range(self.optimus.mbsize):
+            self.init_env_mark(i)
+            self.init_env_grad_mark(i)
+
+        if self.optimus.force_free_mem == True:
+            self.cond_free_mem_()
+            if self.optimus.swap_model_in_optstep == True and model_offloaded == True:
+                self.load_model()
+
+                if optimizer_offloaded == True and model_offloaded == False:
+                    self.load_optimizer()
+                    optimizer_offloaded = False
+                    if self.optimus.display_mem == True:
+                        print(f" >>> [rank:{self.optimus.tpl.rank}], load optimizer ...")
+
+                model_offloaded = False
+
+        for i in range(num_warmup_microbatches):
+            self.pre_fx_micro_forward_core(i)
+            self.prefetch_forward(i + 1)
+            self.fx_micro_forward_core(i)
+            result = self.post_fx_micro_forward_core(i)
+            next(result)
+
+        # same message order as 1F1B; only the W's move
+        reorder_mbi = -1
+        for i in range(remaining): # steady
+            forward_i = i + num_warmup_microbatches
+            backward_i = i
+
+            self.pre_fx_micro_forward_core(forward_i)
+            if reorder_mbi >= 0:
+                result = self.post_fx_micro_backward_core(reorder_mbi)
+                next(result)
+                reorder_mbi = -1
+
+            self.prefetch_forward(forward_i + 1)
+
+            self.fx_micro_forward_core(forward_i)
+            result = self.post_fx_micro_forward_core(forward_i)
+            next(result)
+
+            if self.optimus.tpl.is_last_stage():
+                self.run_loss(backward_i)
+
+            self.fill_bubble(backward_i, num_warmup_microbatches)
+
+            grads = self.pre_fx_micro_backward_core(backward_i)
+            self.fx_micro_backward_core(backward_i, grads)
+
+            reorder_mbi = backward_i
+
+        if num_warmup_microbatches == 0 and reorder_mbi >= 0: 
+            result = self.post_fx_micro_backward_core(reorder_mbi)
+            next(result)
+            reorder_mbi = -1
+
+        for i in range(num_warmup_microbatches):
+            backward_i = i + remaining
+
+            if self.optimus.tpl.is_last_stage():
+                self.run_loss(backward_i)
+
+            if reorder_mbi >= 0:
+                result = self.post_fx_micro_backward_core(reorder_mbi)
+                next(result)
+                reorder_mbi = -1
+
+            self.fill_bubble(backward_i, num_warmup_microbatches)
+
+            grads = self.pre_fx_micro_backward_core(backward_i)
+            self.prefetch_backward(backward_i + 1)
+            self.fx_micro_backward_core(backward_i, grads)
+
+            result = self.post_fx_micro_backward_core(backward_i)
+            next(result)
+
+        while len(self.pending_weight) > 0:
+            self.weight_step()
+
+        self.complete_sends()
+
+        if self.optimus.force_free_mem == True:
+            self.optimus.run_info.clean_run_info(self.optimus.mbsize)
+            if self.optimus.swap_model_in_optstep == True:
+                self.check_swap_model_in_optstep()
+            self.force_free_mem()
+            if optimizer_offloaded == True and model_offloaded == False:
+                if self.optimus.swap_opt_in_fwdbwd == True:
+                    self.load_optimizer()
+                    if self.optimus.display_mem == True:
+                        print(f" >>>>>> [rank:{self.optimus.tpl.rank}], load optimizer ...")
+                optimizer_offloaded = False
@@ -0,0 +1,232 @@
+#
+# Copyright (c) 2024-present, ETRI, All rights reserved.
+#
+
+import json
+import time
+import functools
+from collections import defaultdict
+
+import torch
+import torch.distributed as dist
+
+
+#
+# Step-level tracing of the pipeline schedules
+#
+#   Every forward, backward, loss, send, recv and swap phase of a schedule is recorded per
+#   rank and micro-batch: with CUDA events on GPU (compute phases are asynchronous), with
+#   perf_counter on CPU. export() merges the spans of all ranks into a Chrome trace
+#   (chrome://tracing, https://ui.perfetto.dev) and print_summary() reports, per rank, the time
+#   spent computing, in communication and idle (bubble).
+#
+#   Time 0 of every rank is taken right after a barrier, so the spans of all ranks share a
+#   time axis (to within the barrier skew).
+#
+
+# schedule method --> (span name, category); post_* are generators sending on next()
+TRACED_PHASES = {
+    "pre_fx_micro_forward_core": ("recv_act", "comm"),
+    "fx_micro_forward_core": ("forward", "compute"),
+    "post_fx_micro_forward_core": ("send_act", "comm"),
+    "run_loss": ("loss", "compute"),
+    "pre_fx_micro_backward_core": ("recv_grad", "comm"),
+    "fx_micro_backward_core": ("backward", "compute"),
+    "post_fx_micro_backward_core": ("send_grad", "comm"),
+    "weight_step": ("backward_weight", "compute"),
+    "complete_sends": ("wait_sends", "comm"),
+    "load_model": ("load_model", "swap"),
+    "offload_model": ("offload_model", "swap"),
+    "load_optimizer": ("load_optimizer", "swap"),
+    "prefetch_optimizer": ("prefetch_optimizer", "swap"),
+    "offload_optimizer": ("offload_optimizer", "swap"),
+}
+
+GENERATOR_PHASES = ("post_fx_micro_forward_core", "post_fx_micro_backward_core")
+
+
+class StepTracer:
+
+    def __init__(self, rank, device):
+        self.rank = rank
+        self.device = device
+        self.use_cuda = device.type == "cuda"
+
+        self.spans = []  # [ (name, cat, step, stage, mb_idx, start, end), ] start/end: seconds or CUDA events
+        self.steps = []  # [ (start, end), ] wall time of each run() in seconds
+        self.step = -1
+        self.stage = 0
+
+        if dist.is_initialized():
+            dist.barrier()
+        self.t0 = time.perf_counter()
+
+        if self.use_cuda:
+            self.step_base = []  # [ (CUDA event, seconds from t0), ] recorded at the start of each step
+
+
+    def now(self):
+        if self.use_cuda:
+            ev = torch.cuda.Event(enable_timing=True)
+            ev.record()
+            return ev
+        return time.perf_counter() - self.t0
+
+
+    def begin_step(self):
+        self.step = self.step + 1
+        if self.use_cuda:
+            torch.cuda.synchronize(self.device)
+            base_event = torch.cuda.Event(enable_timing=True)
+            base_event.record()
+            self.step_base.append((base_event, time.perf_counter() - self.t0))
+        self.steps.append([time.perf_counter() - self.t0, None])
+
+
+    def end_step(self):
+        if self.use_cuda:
+            torch.cuda.synchronize(self.device)
+        self.steps[-1][1] = time.perf_counter() - self.t0
+
+
+    def record(self, name, cat, mb_idx, start, end):
+        self.spans.append((name, cat, self.step, self.stage, mb_idx, start, end))
+
+
+    # wrap the traced methods of a Schedule instance
+    def instrument(self, schedule):
+        for method, (name, cat) in TRACED_PHASES.items():
+            fn = getattr(schedule, method, None)
+            if fn is None:
+                continue
+            if method in GENERATOR_PHASES:
+                setattr(schedule, method, self.wrap_generator(fn, name, cat, schedule))
+            else:
+                setattr(schedule, method, self.wrap(fn, name, cat, schedule))
+
+        run = schedule.run
+
+        @functools.wraps(run)
+        def traced_run(*args, **kwargs):
+            self.begin_step()
+            try:
+                return run(*args, **kwargs)
+            finally:
+                self.end_step()
+
+        schedule.run = traced_run
+
+
+    def wrap(self, fn, name, cat, schedule):
+        @functools.wraps(fn)
+        def traced(*args, **kwargs):
+            mb_idx = args[0] if len(args) > 0 and isinstance(args[0], int) else -1
+            self.stage = schedule.optimus.tpl.stage
+            start = self.now()
+            result = fn(*args, **kwargs)
+            self.record(name, cat, mb_idx, start, self.now())
+            return result
+        return traced
+
+
+    def wrap_generator(self, fn, name, cat, schedule):
+        @functools.wraps(fn)
+        def traced(mb_idx, *args, **kwargs):
+            gen = fn(mb_idx, *args, **kwargs)
+            self.stage = schedule.optimus.tpl.stage
+            start = self.now()
+            value = next(gen)
+            self.record(name, cat, mb_idx, start, self.now())
+            yield value
+            yield from gen
+        return traced
+
+
+    # spans in seconds from t0
+    def resolve(self):
+        if not self.use_cuda:
+            return list(self.spans)
+
+        torch.cuda.synchronize(self.device)
+        spans = []
+        for name, cat, step, stage, mb_idx, start, end in self.spans:
+            base_event, base_time = self.step_base[step]
+            spans.append((name, cat, step, stage, mb_idx, base_time + base_event.elapsed_time(start) / 1000, base_time + base_event.elapsed_time(end) / 1000))
+        return spans
+
+
+    def gather(self):
+        local = {"rank": self.rank, "spans": self.resolve(), "steps": [tuple(s) for s in self.steps]}
+        if not dist.is_initialized() or dist.get_world_size() == 1:
+            return [local]
+
+        gathered = [None for _ in range(dist.get_world_size())] if self.rank == 0 else None
+        dist.gather_object(local, gathered, dst=0)
+        return gathered
+
+
+    # write the merged Chrome trace of all ranks at rank 0 (call on every rank)
+    def export(self, path):
+        gathered = self.gather()
+        if self.rank != 0:
+            return None
+
+        events = []
+        for g in gathered:
+            events.append({"name": "process_name", "ph": "M", "pid": g["rank"], "args": {"name": f"rank {g['rank']}"}})
+            for i, (start, end) in enumerate(g["steps"]):
+                events.append({"name": f"step {i}", "cat": "step", "ph": "X", "pid": g["rank"], "tid": "step",
+                               "ts": start * 1e6, "dur": (end - start) * 1e6})
+            for name, cat, step, stage, mb_idx, start, end in g["spans"]:
+                events.append({"name": name if mb_idx < 0 else f"{name} {mb_idx}", "cat": cat, "ph": "X",
+                               "pid": g["rank"], "tid": f"stage {stage} {cat}",
+                               "ts": start * 1e6, "dur": (end - start) * 1e6,
+                               "args": {"step": step, "stage": stage, "mb": mb_idx}})
+
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+        print(f" ### trace of {len(gathered)} ranks saved: {path}")
+        self.print_summary(gathered)
+        return gathered
+
+
+    # per rank: step time, compute/comm/swap time, bubble fraction; per-stage imbalance
+    def print_summary(self, gathered):
+        print(f" ------------------------------------------------------------")
+        print(f"  {'rank':>4} {'steps':>5} {'step(ms)':>9} {'compute':>8} {'comm':>8} {'swap':>8} {'bubble':>7}")
+
+        busy = {}
+        for g in gathered:
+            num_steps = len([s for s in g["steps"] if s[1] is not None])
+            if num_steps == 0:
+                continue
+            step_time = sum(end - start for start, end in g["steps"] if end is not None) / num_steps
+
+            per_cat = defaultdict(float)
+            for name, cat, step, stage, mb_idx, start, end in g["spans"]:
+                per_cat[cat] += (end - start)
+            compute = per_cat["compute"] / num_steps
+            comm = per_cat["comm"] / num_steps
+            swap = per_cat["swap"] / num_steps
+
+            # idle: time of the step not spent computing (blocking comm, waits and gaps)
+            bubble = 1 - compute / step_time if step_time > 0 else 0
+            busy[g["rank"]] = compute
+
+            print(f"  {g['rank']:4d} {num_steps:5d} {step_time * 1e3:9.2f} {compute * 1e3:8.2f} {comm * 1e3:8.2f} {swap * 1e3:8.2f} {bubble * 100:6.1f}%")
+
+        if len(busy) > 0:
+            mean = sum(busy.values()) / len(busy)
+            slowest = max(busy, key=busy.get)
+            imbalance = busy[slowest] / mean if mean > 0 else 1
+            print(f"  compute imbalance (max/mean): {imbalance:.2f}, slowest rank: {slowest}")
+        print(f" ------------------------------------------------------------")
+
+
+    def reset(self):
+        self.spans = []
+        self.steps = []
+        self.step = -1
+        if self.use_cuda:
+            self.step_base = []
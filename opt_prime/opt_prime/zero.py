@@ -0,0 +1,107 @@
+#
+# Copyright (c) 2024-present, ETRI, All rights reserved.
+#
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+
+from opt_prime.dp_reducer import split_flat
+
+
+#
+# ZeRO-1/2 optimizer of a pipeline rank (Optimus_p(..., zero_stage=1|2))
+#
+#   Every gradient bucket of the DPReducers is reduce-scattered over the DP group of its stage;
+#   each replica then owns 1/dp_size of the flat parameters of the bucket: the optimizer
+#   updates a copy of that shard only (optimizer states / dp_size), and the updated shards
+#   are all-gathered back into the parameters, which are views of a flat buffer per bucket.
+#
+#   zero_stage=2 also releases the gradient buckets once the shard of the rank is copied out:
+#   the gradients of the micro-batches are accumulated in full (pipeline), but take no memory
+#   between the optimizer step and the next backward.
+#
+
+class ZeroOptimizer:
+
+    def __init__(self, reducers, optimizer_class, zero_stage=1, **kwargs):
+        self.reducers = reducers
+        self.zero_stage = zero_stage
+
+        self.shards = []  # [ (reducer, bucket, flat parameters, parameter shard), ]
+        for reducer in reducers:
+            for bucket in reducer.buckets:
+                flat = torch.zeros(bucket.shard_size * reducer.dp_size, dtype=bucket.dtype, device=bucket.device)
+                with torch.no_grad():
+                    for p, view in zip(bucket.params, split_flat(flat, bucket.params)):
+                        view.copy_(p)
+                        p.data = view
+                start = reducer.dp_rank * bucket.shard_size
+                shard = nn.Parameter(flat[start:start + bucket.shard_size].clone())
+                self.shards.append((reducer, bucket, flat, shard))
+
+        self.optimizer = optimizer_class([shard for _, _, _, shard in self.shards], **kwargs)
+
+
+    @property
+    def param_groups(self):
+        return self.optimizer.param_groups
+
+    @property
+    def state(self):
+        return self.optimizer.state
+
+    def state_dict(self):
+        return self.optimizer.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.optimizer.load_state_dict(state_dict)
+
+
+    # after DPReducer.finish(): gradient of every parameter shard
+    def collect_grads(self):
+        for reducer, bucket, _, shard in self.shards:
+            if bucket.buffer is None: # no backward since the last release
+                continue
+            grad = bucket.shard(reducer.dp_rank)
+            if self.zero_stage == 2:
+                shard.grad = grad.clone()
+                bucket.release()
+            else:
+                shard.grad = grad
+
+
+    # reduced gradients of this rank, for clipping
+    def get_grads(self):
+        return [shard.grad for _, _, _, shard in self.shards if shard.grad is not None]
+
+
+    def step(self):
+        self.optimizer.step()
+
+        works = []
+        for reducer, _, flat, shard in self.shards:
+            works.append(dist.all_gather_into_tensor(flat, shard.detach(), group=reducer.process_group, async_op=True))
+        for work in works:
+            work.wait()
+
+        # parameters moved since (e.g. swap_model_in_optstep): copy, then bind again
+        with torch.no_grad():
+            for _, bucket, flat, _ in self.shards:
+                for p, view in zip(bucket.params, split_flat(flat, bucket.params)):
+                    if p.data_ptr() != view.data_ptr():
+                        if p.device == view.device:
+                            p.data = view
+                        else:
+                            p.copy_(view)
+
+
+    # keep the gradient buckets bound to the parameters: zeroed in place
+    def zero_grad(self, set_to_none=True):
+        for _, bucket, _, shard in self.shards:
+            shard.grad = None
+            if bucket.buffer is not None:
+                bucket.buffer.zero_()
+                for p, view in zip(bucket.params, bucket.views):
+                    if p.grad is not None and p.grad.data_ptr() != view.data_ptr():
+                        p.grad = None